@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare the text/json and application/x-rov-state control frames.
+
+Reports bytes per frame (and how many of them are content payload) and
+encode/decode time for the robot_state and sensor_data frames, built and
+parsed exactly the way libclient/libserver do it, both with the json
+header of the first frame and the binary header used after the handshake.
+
+    python bench/bench_codec.py [iterations]
+"""
+
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+
+import libclient
+import libcodec
+import libframe
+
+ROBOT_STATE = {"horizontal_motors": (0.25, -0.5, 0.75, -1.0), "vertical_motors": (0.1, -0.1), "enabled": True}
+SENSOR_DATA = {"IMU": (0.01, -0.02, 9.81)}
+HEADERS = {"seq": 1234, "ack": 1233, "ts": 5678.25}
+
+
+def _make_message(binary_framing):
+    # The framing helpers never touch the selector or socket
+    request = {"type": "text/json", "encoding": "utf-8", "content": ROBOT_STATE}
+    message = libclient.Message(None, None, None, request, ROBOT_STATE, SENSOR_DATA)
+    message.binary_framing = binary_framing
+    return message
+
+
+def _encoders(message):
+    def frame(content_bytes, content_type, content_encoding):
+        message._queue_message(
+            content_bytes=content_bytes,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            headers=HEADERS,
+        )
+        data = bytes(message._send_buffer)
+        message._send_buffer.clear()
+        return data
+
+    def json_frame(content):
+        return frame(message._json_encode(content, "utf-8"), "text/json", "utf-8")
+
+    def binary_frame(pack):
+        return lambda content: frame(pack(content), libcodec.ROV_STATE_CONTENT_TYPE, "binary")
+
+    return {
+        ("text/json", "robot_state"): (json_frame, ROBOT_STATE),
+        ("text/json", "sensor_data"): (json_frame, SENSOR_DATA),
+        ("x-rov-state", "robot_state"): (binary_frame(libcodec.pack_robot_state), ROBOT_STATE),
+        ("x-rov-state", "sensor_data"): (binary_frame(libcodec.pack_sensor_data), SENSOR_DATA),
+    }
+
+
+def _split(message, frame):
+    """Header dict and content of a frame."""
+    if message.binary_framing:
+        size = libframe.FRAME_HEADER.size
+        header = libframe.header_from_fields(*libframe.FRAME_HEADER.unpack_from(frame))
+        return header, memoryview(frame)[size:]
+    jsonheader_len = struct.unpack(">H", frame[:2])[0]
+    jsonheader = message._json_decode(frame[2:2 + jsonheader_len], "utf-8")
+    return jsonheader, memoryview(frame)[2 + jsonheader_len:]
+
+
+def _decode(message, frame):
+    header, content = _split(message, frame)
+    if header["content-type"] == "text/json":
+        return message._json_decode(content, header["content-encoding"])
+    return libcodec.unpack(content)
+
+
+def main(iterations):
+    print(f"{'header':<7} {'codec':<12} {'frame':<12} {'bytes':>6} {'payload':>8} {'encode us':>10} {'decode us':>10}")
+    for binary_framing in (False, True):
+        message = _make_message(binary_framing)
+        framing = "binary" if binary_framing else "json"
+        for (codec, kind), (encode, content) in _encoders(message).items():
+            frame = encode(content)
+            payload = len(_split(message, frame)[1])
+            encode_us = timeit.timeit(lambda: encode(content), number=iterations) / iterations * 1e6
+            decode_us = timeit.timeit(lambda: _decode(message, frame), number=iterations) / iterations * 1e6
+            print(
+                f"{framing:<7} {codec:<12} {kind:<12} {len(frame):>6} {payload:>8} "
+                f"{encode_us:>10.2f} {decode_us:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
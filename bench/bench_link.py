@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Run the control link end to end over loopback and report it as JSON.
+
+For every combination of transport, content type and send rate the server
+and client RelayThread are started in child processes of their own. The
+client setters are driven like a motor controller would drive them, and
+the report has frames/s, round trip percentiles, CPU% of each side and
+bytes per frame. --delay, --jitter and --loss put a lossy_proxy between
+the two sides to compare designs as if on the tether.
+
+"max" sends as fast as the link allows over tcp. udp always sends on a
+tick, there "max" is a UDP_MAX_RATE tick. A ticking sender skips state
+that didn't change, so its frame rate is also capped by --app-rate, how
+often the simulated application calls the setters. udp picks its frame
+format per datagram, so it runs once instead of once per content type.
+
+    python bench/bench_link.py [--seconds 3] [--rates 50,max] [--transports tcp,udp]
+        [--codecs json,rov-state,delta] [--max-in-flight 1] [--app-rate 100]
+        [--delay 0] [--jitter 0] [--loss 0] [--output results.json]
+"""
+
+import argparse
+import logging
+import math
+import os
+import socket
+import sys
+import threading
+import time
+
+import harness
+from lossy_proxy import DelayedTcpProxy, LossyUdpProxy
+
+UDP_MAX_RATE = 1000
+# Connection setup and content type negotiation stay out of the numbers
+WARMUP = 0.5
+
+
+def _drive(period, update):
+    """Call update(t) every period seconds on a daemon thread."""
+    def loop():
+        start = time.monotonic()
+        while True:
+            update(time.monotonic() - start)
+            time.sleep(period)
+    threading.Thread(target=loop, daemon=True).start()
+
+
+def run_server(args):
+    # Every run ends with the client hanging up, decode errors are counted in the stats
+    logging.disable(logging.ERROR)
+    relay_module = harness.load_relay("server")
+    relay = relay_module.RelayThread()
+    relay.port = args.port
+    relay.transport = args.transport
+    relay.begin_thread()
+    while not relay.sel.get_map():
+        time.sleep(0.01)
+    _drive(1 / args.app_rate, lambda t: relay.set_IMU_data(math.sin(t), math.cos(t), 9.81))
+    cpu = harness.CpuMeter()
+    harness.report({"ready": True})
+    sys.stdin.readline()
+    harness.report({"cpu_percent": cpu.percent(), "stats": relay.get_stats()})
+    os._exit(0)
+
+
+def run_client(args):
+    relay_module = harness.load_relay("client")
+    if args.codec == "json":
+        # Only offer text/json in the accept header
+        relay_module.libclient.SUPPORTED_CONTENT_TYPES = ("text/json",)
+    relay = relay_module.RelayThread()
+    relay.port = args.port
+    relay.transport = args.transport
+    relay.delta_sync = args.codec == "delta"
+    relay.max_in_flight = args.max_in_flight
+    relay.control_rate = None if args.rate == "max" else float(args.rate)
+    if args.transport == "udp" and args.rate == "max":
+        relay.control_rate = UDP_MAX_RATE
+    relay.begin_thread()
+
+    def update(t):
+        relay.set_horizontal_motors(math.sin(t), math.cos(t), -math.sin(t), -math.cos(t))
+        relay.set_vertical_motors(math.sin(t / 2), math.cos(t / 2))
+    _drive(1 / args.app_rate, update)
+
+    time.sleep(WARMUP)
+    before = relay.get_stats()
+    cpu = harness.CpuMeter()
+    time.sleep(args.seconds)
+    after = relay.get_stats()
+    cpu_percent = cpu.percent()
+    # The server may hang up first from here on
+    logging.disable(logging.ERROR)
+    rates = relay_module.libmetrics.rates(before, after)
+    sent = after["frames_sent"] - before["frames_sent"]
+    received = after["frames_received"] - before["frames_received"]
+    rtt = after["rtt"]
+    harness.report({
+        "frames_per_s": {"sent": rates["frames_sent"], "received": rates["frames_received"]},
+        "bytes_per_frame": {
+            "sent": (after["bytes_sent"] - before["bytes_sent"]) / sent if sent else None,
+            "received": (after["bytes_received"] - before["bytes_received"]) / received if received else None,
+        },
+        "rtt_ms": {
+            key: rtt[key] * 1000 if rtt[key] is not None else None
+            for key in ("p50", "p95", "p99", "max")
+        },
+        "cpu_percent": cpu_percent,
+        "decode_errors": after["decode_errors"],
+        "out_of_order": after.get("out_of_order"),
+        "stale": after.get("stale"),
+    })
+    os._exit(0)
+
+
+def _start_proxy(args, transport, port):
+    if not (args.delay or args.jitter or args.loss):
+        return None
+    upstream = ("localhost", port)
+    if transport == "udp":
+        return LossyUdpProxy(upstream, args.loss, args.delay, args.jitter, seed=1).start()
+    return DelayedTcpProxy(upstream, args.delay, args.jitter, seed=1).start()
+
+
+def run_one(args, transport, codec, rate):
+    port = harness.free_port(socket.SOCK_DGRAM if transport == "udp" else socket.SOCK_STREAM)
+    server = harness.spawn(
+        __file__, "--role", "server", "--transport", transport, "--port", port,
+        "--app-rate", args.app_rate,
+    )
+    harness.read_result(server)
+    proxy = _start_proxy(args, transport, port)
+    client = harness.spawn(
+        __file__, "--role", "client", "--transport", transport, "--port",
+        proxy.address[1] if proxy else port, "--codec", codec, "--rate", rate,
+        "--seconds", args.seconds, "--max-in-flight", args.max_in_flight,
+        "--app-rate", args.app_rate,
+    )
+    result = harness.read_result(client)
+    # The client has to be gone first or it logs the server hanging up on it
+    client.wait()
+    server.stdin.write("stop\n") # type: ignore
+    server.stdin.flush() # type: ignore
+    server_result = harness.read_result(server)
+    server.wait()
+    if proxy is not None:
+        proxy.stop()
+    result["cpu_percent"] = {"client": result["cpu_percent"], "server": server_result["cpu_percent"]}
+    return {
+        "bench": "link",
+        "transport": transport,
+        "codec": codec,
+        "rate": rate,
+        "max_in_flight": args.max_in_flight,
+        "app_rate": args.app_rate,
+        # tcp retransmits, the proxy only loses datagrams
+        "link": {"delay": args.delay, "jitter": args.jitter, "loss": args.loss if transport == "udp" else 0.0},
+        **result,
+    }
+
+
+def run(args):
+    results = []
+    for transport in args.transports.split(","):
+        codecs = ["datagram"] if transport == "udp" else args.codecs.split(",")
+        for codec in codecs:
+            for rate in args.rates.split(","):
+                result = run_one(args, transport, codec, rate)
+                rtt = result["rtt_ms"]["p50"]
+                print(
+                    f"{transport:<4} {codec:<10} rate {rate:<5} "
+                    f"{result['frames_per_s']['received']:>8.0f} frames/s "
+                    f"{result['bytes_per_frame']['sent'] or 0:>6.1f} B/frame "
+                    f"rtt p50 {'-' if rtt is None else f'{rtt:.2f}ms'} "
+                    f"cpu {result['cpu_percent']['client']:.0f}%/{result['cpu_percent']['server']:.0f}%",
+                    file=sys.stderr,
+                )
+                results.append(result)
+    return results
+
+
+def add_arguments(parser):
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--rates", default="50,max")
+    parser.add_argument("--transports", default="tcp,udp")
+    parser.add_argument("--codecs", default="json,rov-state,delta")
+    parser.add_argument("--max-in-flight", type=int, default=1)
+    parser.add_argument("--app-rate", type=float, default=100)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output")
+    # Used by the child processes
+    parser.add_argument("--role", choices=("server", "client"), help=argparse.SUPPRESS)
+    parser.add_argument("--transport", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--codec", help=argparse.SUPPRESS)
+    parser.add_argument("--rate", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == "server":
+        run_server(args)
+    elif args.role == "client":
+        run_client(args)
+    else:
+        harness.emit(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Feed back-to-back control frames through the receive path.
+
+Compares the old ``bytes`` buffer, which re-slices everything still unread
+after each header and payload, against libbuffer.RecvBuffer. The backlog
+case hands the parser the whole stream in big reads, the way a topside
+that fell behind would see it.
+
+    python bench/bench_recv_buffer.py [frames]
+"""
+
+import json
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+import libbuffer
+import libcodec
+
+ROBOT_STATE = {"horizontal_motors": (0.25, -0.5, 0.75, -1.0), "vertical_motors": (0.1, -0.1), "enabled": True}
+
+
+class StreamSocket:
+    """Stands in for a connected socket that already holds the whole stream."""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+
+    def recv(self, nbytes):
+        chunk = bytes(self._data[self._pos:self._pos + nbytes])
+        self._pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer, nbytes=0):
+        nbytes = min(nbytes or len(buffer), len(self._data) - self._pos)
+        buffer[:nbytes] = self._data[self._pos:self._pos + nbytes]
+        self._pos += nbytes
+        return nbytes
+
+
+def _frame():
+    content = libcodec.pack_robot_state(ROBOT_STATE)
+    jsonheader = json.dumps({
+        "byteorder": sys.byteorder,
+        "content-type": libcodec.ROV_STATE_CONTENT_TYPE,
+        "content-encoding": "binary",
+        "content-length": len(content),
+    }).encode("utf-8")
+    return struct.pack(">H", len(jsonheader)) + jsonheader + content
+
+
+def parse_bytes(sock, chunk):
+    """The receive path as it was, bytes concatenation and slicing."""
+    buffer = b""
+    frames = 0
+    while True:
+        data = sock.recv(chunk)
+        if not data:
+            return frames
+        buffer += data
+        while len(buffer) >= 2:
+            hdrlen = struct.unpack(">H", buffer[:2])[0]
+            if len(buffer) < 2 + hdrlen:
+                break
+            jsonheader = json.loads(buffer[2:2 + hdrlen])
+            content_len = jsonheader["content-length"]
+            if len(buffer) < 2 + hdrlen + content_len:
+                break
+            buffer = buffer[2 + hdrlen:]
+            libcodec.unpack(buffer[:content_len])
+            buffer = buffer[content_len:]
+            frames += 1
+
+
+def parse_recv_buffer(sock, chunk):
+    buffer = libbuffer.RecvBuffer()
+    protoheader = struct.Struct(">H")
+    frames = 0
+    while True:
+        if not buffer.recv_into(sock, chunk):
+            return frames
+        while len(buffer) >= 2:
+            hdrlen = buffer.unpack_from(protoheader)[0]
+            if len(buffer) < 2 + hdrlen:
+                break
+            jsonheader = json.loads(bytes(buffer.peek(2 + hdrlen)[2:]))
+            content_len = jsonheader["content-length"]
+            if len(buffer) < 2 + hdrlen + content_len:
+                break
+            buffer.consume(2 + hdrlen)
+            libcodec.unpack(buffer.consume(content_len))
+            frames += 1
+
+
+def main(count):
+    stream = _frame() * count
+    print(f"{count} frames, {len(stream)} bytes")
+    print(f"{'receive path':<14} {'read size':>10} {'total ms':>10} {'us/frame':>10}")
+    for read_size in (4096, len(stream)):
+        for name, parse in (("bytes", parse_bytes), ("RecvBuffer", parse_recv_buffer)):
+            start = time.perf_counter()
+            frames = parse(StreamSocket(stream), read_size)
+            elapsed = time.perf_counter() - start
+            assert frames == count, frames
+            print(f"{name:<14} {read_size:>10} {elapsed * 1e3:>10.2f} {elapsed / count * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
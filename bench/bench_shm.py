@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Measure the shared memory transport between processes on one machine.
+
+The robot state half publishes states into a libshm.SharedState at
+--rate and a reader in a process of its own waits for each of them like
+a motor driver would, the report has the publish to observe latency and
+the CPU% of both sides. The frame half writes 640x480 camera frames into
+a libframering.FrameRing as fast as it can, the reader takes the newest
+one every time and touches its pixels. The frame half needs numpy and is
+skipped without it.
+
+    python bench/bench_shm.py [--seconds 3] [--rate 1000] [--poll-interval 0.0005] [--output results.json]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import harness
+
+sys.path.insert(0, os.path.join(harness.ROOT, "server"))
+sys.path.insert(0, os.path.join(harness.ROOT, "camera-server"))
+
+import libshm
+
+STATE_NAME = "rov-bench-state"
+RING_NAME = "rov-bench-ring"
+FRAME_SHAPE = (480, 640, 3)
+
+
+def _state(value):
+    # The latency rides in a motor value, float32 in the codec, so it is sent relative to a base
+    return {"horizontal_motors": (value, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": True}
+
+
+def run_state_reader(args):
+    shared = libshm.SharedState(STATE_NAME)
+    cell = shared.robot_state
+    latencies = []
+    version = cell.version
+    cpu = harness.CpuMeter()
+    end = time.monotonic() + args.seconds
+    while time.monotonic() < end:
+        snapshot = cell.wait_newer(version, 0.1, args.poll_interval)
+        if snapshot is None:
+            continue
+        latencies.append(time.perf_counter() - args.base - snapshot.state["horizontal_motors"][0])
+        version = snapshot.version
+    harness.report({
+        "states": len(latencies),
+        "latency_us": {k: v and v * 1e6 for k, v in harness.percentiles(latencies).items()},
+        "cpu_percent": cpu.percent(),
+    })
+    shared.close()
+
+
+def run_frame_reader(args):
+    import libframering
+
+    ring = libframering.FrameRing(RING_NAME)
+    frames = 0
+    seq = 0
+    cpu = harness.CpuMeter()
+    end = time.monotonic() + args.seconds
+    while time.monotonic() < end:
+        frame = ring.wait_newer(seq, 0.1, args.poll_interval)
+        if frame is None:
+            continue
+        seq, timestamp, image = frame
+        # What the pipeline does first, anything that reads every pixel
+        image.sum(dtype="uint64")
+        frames += 1
+    harness.report({"frames": frames, "cpu_percent": cpu.percent()})
+    ring.close()
+
+
+def run_states(args):
+    shared = libshm.SharedState(STATE_NAME, create=True)
+    base = time.perf_counter()
+    reader = harness.spawn(
+        __file__, "--role", "state-reader", "--seconds", args.seconds,
+        "--poll-interval", args.poll_interval, "--base", repr(base),
+    )
+    # Let the reader attach before the clock starts
+    time.sleep(0.5)
+    cpu = harness.CpuMeter()
+    interval = 1 / args.rate
+    next_due = time.perf_counter()
+    published = 0
+    end = time.monotonic() + args.seconds
+    while time.monotonic() < end:
+        delay = next_due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        next_due += interval
+        shared.robot_state.publish(_state(time.perf_counter() - base))
+        published += 1
+    writer_cpu = cpu.percent()
+    result = harness.read_result(reader)
+    reader.wait()
+    shared.close()
+    return {
+        "transport": "shm-state",
+        "rate": args.rate,
+        "published": published,
+        "observed": result["states"],
+        "latency_us": result["latency_us"],
+        "cpu_percent": {"writer": writer_cpu, "reader": result["cpu_percent"]},
+    }
+
+
+def run_frames(args):
+    import libframering
+    import numpy as np
+
+    ring = libframering.FrameRing(RING_NAME, FRAME_SHAPE, create=True)
+    image = np.random.default_rng(0).integers(0, 256, FRAME_SHAPE, dtype=np.uint8)
+    reader = harness.spawn(
+        __file__, "--role", "frame-reader", "--seconds", args.seconds, "--poll-interval", args.poll_interval,
+    )
+    time.sleep(0.5)
+    cpu = harness.CpuMeter()
+    writes = []
+    end = time.monotonic() + args.seconds
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        ring.write(image)
+        writes.append(time.perf_counter() - start)
+    writer_cpu = cpu.percent()
+    result = harness.read_result(reader)
+    reader.wait()
+    ring.close()
+    return {
+        "transport": "shm-frames",
+        "frame_bytes": image.nbytes,
+        "written_per_s": len(writes) / args.seconds,
+        "read_per_s": result["frames"] / args.seconds,
+        "write_us": {k: v and v * 1e6 for k, v in harness.percentiles(writes).items()},
+        "cpu_percent": {"writer": writer_cpu, "reader": result["cpu_percent"]},
+    }
+
+
+def run(args):
+    results = [run_states(args)]
+    try:
+        results.append(run_frames(args))
+    except ImportError as e:
+        print(f"Skipping the frame ring: {e}", file=sys.stderr)
+    return results
+
+
+def add_arguments(parser):
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--rate", type=float, default=1000)
+    parser.add_argument("--poll-interval", type=float, default=libshm.DEFAULT_POLL_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output")
+    # Used by the child processes
+    parser.add_argument("--role", choices=("state-reader", "frame-reader"), help=argparse.SUPPRESS)
+    parser.add_argument("--base", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == "state-reader":
+        run_state_reader(args)
+    elif args.role == "frame-reader":
+        run_frame_reader(args)
+    else:
+        harness.emit(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
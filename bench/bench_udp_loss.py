@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Run the udp transport through a lossy, reordering loopback link.
+
+The client sends a counting robot state on a fixed tick through
+lossy_proxy.LossyUdpProxy to the server. The check fails if the server
+ever applies a command older than one it already applied, then reports
+how many datagrams were lost, dropped as out of order or as stale.
+
+    python bench/bench_udp_loss.py [--loss 0.1] [--delay 0.005] [--jitter 0.03] [--rate 200] [--seconds 3]
+"""
+
+import argparse
+import os
+import selectors
+import socket
+import sys
+import time
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(_ROOT, "server"), os.path.join(_ROOT, "client")]
+
+import libclient
+import libserver
+from lossy_proxy import LossyUdpProxy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--loss", type=float, default=0.1)
+    parser.add_argument("--delay", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.03)
+    parser.add_argument("--rate", type=float, default=200)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--max-age", type=float, default=0.02)
+    args = parser.parse_args()
+
+    sel = selectors.DefaultSelector()
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("localhost", 0))
+    server_sock.setblocking(False)
+    server = libserver.DatagramMessage(sel, server_sock, {}, {"IMU": (0.0, 0.0, 0.0)}, max_age=args.max_age)
+    sel.register(server_sock, selectors.EVENT_READ, data=server)
+
+    proxy = LossyUdpProxy(server_sock.getsockname(), args.loss, args.delay, args.jitter, seed=1).start()
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_sock.connect(proxy.address)
+    client_sock.setblocking(False)
+    state = {"horizontal_motors": (0.0, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": True}
+    client = libclient.DatagramMessage(sel, client_sock, proxy.address, {}, state, {"IMU": (0.0, 0.0, 0.0)}, max_age=args.max_age)
+    sel.register(client_sock, selectors.EVENT_READ, data=client)
+
+    applied = []
+    count = 0
+    end = time.monotonic() + args.seconds
+    next_tick = time.monotonic()
+    while time.monotonic() < end + 0.5:
+        for key, mask in sel.select(max(next_tick - time.monotonic(), 0)):
+            before = server.robot_state
+            key.data.process_events(mask, state if key.data is client else server.sensor_data)
+            if key.data is server and server.robot_state is not before:
+                applied.append(server.robot_state["horizontal_motors"][0])
+        now = time.monotonic()
+        if now >= next_tick and now < end:
+            count += 1
+            state = dict(state, horizontal_motors=(float(count), 0.0, 0.0, 0.0))
+            client.robot_state = state
+            client.send_request()
+            next_tick += 1 / args.rate
+    proxy.stop()
+
+    in_order = all(a < b for a, b in zip(applied, applied[1:]))
+    (seq_filter,) = server.filters.values()
+    print(f"sent {count}, lost by the link {proxy.lost}, applied {len(applied)}")
+    print(f"dropped out of order {seq_filter.out_of_order}, dropped as stale {seq_filter.stale}")
+    print(f"commands applied strictly in order: {in_order}")
+    return 0 if in_order else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
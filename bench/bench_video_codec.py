@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Compare the video codecs on synthetic camera frames.
+
+Reports bytes per frame, encode/decode time and the frame rate the codec
+alone could sustain, plus the frame rate a link of --link-mbps could carry.
+The old pickle framing is included as the baseline.
+
+    python bench/bench_video_codec.py [--width 350] [--frames 100] [--link-mbps 10]
+"""
+
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "camera-server"))
+
+import libvideo
+
+
+def synthetic_frames(width, height, count):
+    """Gradient with a moving blob and sensor noise, roughly what a camera produces."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.dstack(((x * 255 // width), (y * 255 // height), np.full_like(x, 96))).astype(np.int16)
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        cx, cy = (i * 7) % width, height // 2
+        frame[(x - cx) ** 2 + (y - cy) ** 2 < (height // 6) ** 2] = (30, 200, 220)
+        frame += rng.integers(-6, 7, frame.shape, dtype=np.int16)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+
+def bench_codec(name, encode, decode, frames):
+    payloads = []
+    start = time.perf_counter()
+    for frame in frames:
+        payloads.append(encode(frame))
+    encode_ms = (time.perf_counter() - start) / len(frames) * 1e3
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    decode_ms = (time.perf_counter() - start) / len(frames) * 1e3
+    size = sum(len(payload) for payload in payloads) / len(payloads)
+    return name, size, encode_ms, decode_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--width", type=int, default=350)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--link-mbps", type=float, default=10.0)
+    args = parser.parse_args()
+    height = args.height or args.width * 3 // 4
+    frames = synthetic_frames(args.width, height, args.frames)
+
+    def codec(name, quality=80):
+        encoder = libvideo.FrameEncoder(name, quality)
+
+        def encode(frame):
+            payload = encoder.encode(frame)
+            return libvideo.pack_frame(name, args.width, height, 0, 0.0, payload)
+
+        def decode(message):
+            header = libvideo.unpack_header(message)
+            return libvideo.decode_frame(header, memoryview(message)[libvideo.FRAME_HEADER.size:])
+
+        return encode, decode
+
+    results = [bench_codec("pickle", pickle.dumps, pickle.loads, frames)]
+    results.append(bench_codec("raw", *codec("raw"), frames))
+    for quality in (50, 80, 95):
+        results.append(bench_codec(f"jpeg q{quality}", *codec("jpeg", quality), frames))
+    results.append(bench_codec("png", *codec("png"), frames))
+
+    link_bytes = args.link_mbps * 1e6 / 8
+    print(f"{args.width}x{height}, {args.frames} frames, {args.link_mbps:g} Mbit/s link")
+    print(f"{'codec':<10} {'bytes':>9} {'ratio':>7} {'enc ms':>8} {'dec ms':>8} {'cpu fps':>8} {'link fps':>9}")
+    baseline = results[0][1]
+    for name, size, encode_ms, decode_ms in results:
+        cpu_fps = 1e3 / (encode_ms + decode_ms)
+        link_fps = link_bytes / size
+        print(
+            f"{name:<10} {size:>9.0f} {baseline / size:>6.1f}x {encode_ms:>8.2f} "
+            f"{decode_ms:>8.2f} {cpu_fps:>8.1f} {link_fps:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Run the video link end to end over loopback and report it as JSON.
+
+VideoServer and VideoClient run in one child process per codec and camera
+rate. VideoServer gets a synthetic source in place of cv2.VideoCapture(0).
+The report has received frames/s, bytes per frame and per second and
+capture to decoded latency percentiles, plus CPU%: the client is the
+receiving thread and the server is everything else in the process.
+--changes has the server send only the tiles that changed.
+
+    python bench/bench_video_link.py [--seconds 3] [--codecs jpeg,png,raw] [--fps 30,max]
+        [--width 350] [--quality 80] [--changes] [--output results.json]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import harness
+from bench_video_codec import synthetic_frames
+
+sys.path[:0] = [os.path.join(harness.ROOT, "camera-server"), os.path.join(harness.ROOT, "camera-client")]
+
+# Resolution of the synthetic camera, VideoServer scales it down to --width
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+WARMUP = 0.5
+
+
+class SyntheticCapture:
+    """Stands in for cv2.VideoCapture, cycles through pregenerated frames at fps."""
+
+    def __init__(self, fps=None, count=30):
+        self.frames = synthetic_frames(CAMERA_WIDTH, CAMERA_HEIGHT, count)
+        self.interval = 1 / fps if fps else 0.0
+        self._next = time.monotonic()
+        self._index = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        if self.interval:
+            delay = self._next - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next = max(self._next + self.interval, time.monotonic())
+        frame = self.frames[self._index % len(self.frames)]
+        self._index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+def run_child(args):
+    import CamClient
+    import CamServer
+    import libpipeline
+    import libvideo
+
+    fps = None if args.rate == "max" else float(args.rate)
+    port = harness.free_port()
+    server = CamServer.VideoServer(
+        "localhost", port, codec=args.codec, quality=args.quality, width=args.width,
+        open_capture=lambda: SyntheticCapture(fps),
+        changes=libpipeline.ChangeDetector() if args.changes else None,
+    )
+    server.start_thread()
+    client = CamClient.VideoClient("localhost", port)
+
+    end = time.monotonic() + WARMUP
+    while time.monotonic() < end:
+        client.receive_frame()
+
+    frames = 0
+    size = 0
+    latencies = []
+    cpu = harness.CpuMeter()
+    client_cpu = time.thread_time()
+    end = time.monotonic() + args.seconds
+    while time.monotonic() < end:
+        if client.receive_frame() is None:
+            break
+        header = client.frame_header
+        frames += 1
+        size += libvideo.FRAME_HEADER.size + header.length
+        latencies.append((time.time() - header.timestamp) * 1000)
+    elapsed = args.seconds
+    total_cpu = cpu.percent()
+    client_cpu = 100 * (time.thread_time() - client_cpu) / elapsed
+    harness.report({
+        "frames_per_s": frames / elapsed,
+        "bytes_per_frame": size / frames if frames else None,
+        "bytes_per_s": size / elapsed,
+        "latency_ms": {**harness.percentiles(latencies), "max": max(latencies, default=None)},
+        "cpu_percent": {"client": client_cpu, "server": total_cpu - client_cpu},
+        "stages": server.get_stats(),
+    })
+    os._exit(0)
+
+
+def run(args):
+    results = []
+    for codec in args.codecs.split(","):
+        for rate in args.fps.split(","):
+            child = harness.spawn(
+                __file__, "--role", "run", "--codec", codec, "--rate", rate,
+                "--seconds", args.seconds, "--width", args.width, "--quality", args.quality,
+                *(["--changes"] if args.changes else []),
+            )
+            result = harness.read_result(child)
+            child.wait()
+            result = {
+                "bench": "video", "codec": codec, "fps": rate, "width": args.width, "changes": args.changes,
+                **result,
+            }
+            latency = result["latency_ms"]["p50"]
+            print(
+                f"{codec:<5} fps {rate:<4} {result['frames_per_s']:>7.1f} frames/s "
+                f"{result['bytes_per_frame'] or 0:>9.0f} B/frame {result['bytes_per_s'] / 1e3:>8.0f} kB/s "
+                f"latency p50 {'-' if latency is None else f'{latency:.1f}ms'} "
+                f"cpu {result['cpu_percent']['client']:.0f}%/{result['cpu_percent']['server']:.0f}%",
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+def add_arguments(parser):
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--codecs", default="jpeg,png,raw")
+    parser.add_argument("--fps", default="30,max")
+    parser.add_argument("--width", type=int, default=350)
+    parser.add_argument("--quality", type=int, default=80)
+    parser.add_argument("--changes", action="store_true")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output")
+    # Used by the child processes
+    parser.add_argument("--role", choices=("run",), help=argparse.SUPPRESS)
+    parser.add_argument("--codec", help=argparse.SUPPRESS)
+    parser.add_argument("--rate", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == "run":
+        run_child(args)
+    else:
+        harness.emit(run(args), args.output)
+
+
+if __name__ == "__main__":
+    main()
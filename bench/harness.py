@@ -0,0 +1,127 @@
+"""Helpers shared by the loopback link benchmarks.
+
+Every measured configuration runs in child processes of its own, so CPU%
+is per side and per configuration and one run can't warm up or slow down
+the next. Children report back with a single JSON line on stdout.
+"""
+
+import ast
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def load_relay(side):
+    """RelayThread module of "client" or "server" without the instance it starts on import.
+
+    Only imports, constants, functions and classes are run, the module level
+    transmission = RelayThread() and the calls on it are left out, so the
+    benchmark can configure host, port and transport before starting it.
+    """
+    directory = os.path.join(ROOT, side)
+    sys.path.insert(0, directory)
+    path = os.path.join(directory, "RelayThread.py")
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    tree.body = [
+        node for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))
+        or (isinstance(node, ast.Assign) and not _creates_relay(node.value))
+    ]
+    module = types.ModuleType("RelayThread")
+    module.__file__ = path
+    exec(compile(tree, path, "exec"), module.__dict__)
+    return module
+
+
+def _creates_relay(value):
+    return isinstance(value, ast.Call) and getattr(value.func, "id", None) == "RelayThread"
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class CpuMeter:
+    """CPU time of this whole process, all threads, as a percentage of one core."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def percent(self):
+        wall = time.perf_counter() - self._wall
+        return 100 * (time.process_time() - self._cpu) / wall if wall > 0 else 0.0
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """Nearest rank percentiles of a list of samples, None for an empty list."""
+    ordered = sorted(samples)
+    result = {}
+    for p in points:
+        if ordered:
+            result[f"p{p}"] = ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+        else:
+            result[f"p{p}"] = None
+    return result
+
+
+def spawn(script, *args):
+    """Start script as a child in role mode, its stdout is a pipe of JSON lines."""
+    return subprocess.Popen(
+        [sys.executable, script, *map(str, args)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+
+
+def read_result(child):
+    """Next JSON line a child printed, skipping anything else it wrote."""
+    for line in child.stdout:
+        if line.startswith("{"):
+            return json.loads(line)
+    raise RuntimeError(f"Child {child.args!r} exited with {child.wait()} before reporting.")
+
+
+def report(result):
+    """Called in a child, hands one result to the parent."""
+    print(json.dumps(result), flush=True)
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def emit(results, output=None):
+    """Write results with enough context to compare them with a later run."""
+    document = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    text = json.dumps(document, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w") as f:
+            f.write(text + "\n")
@@ -0,0 +1,171 @@
+"""In-process proxies that emulate a bad tether.
+
+Datagrams are forwarded in both directions with a configurable loss rate,
+base delay and random jitter. Jitter larger than the send interval
+reorders datagrams the same way a flaky link does, no tc/netem needed.
+DelayedTcpProxy does the same for a TCP connection, minus the loss.
+"""
+
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+
+
+class LossyUdpProxy:
+    def __init__(self, upstream, loss=0.0, delay=0.0, jitter=0.0, host="localhost", port=0, seed=None):
+        self.upstream = upstream
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._front.bind((host, port))
+        self._back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._back.connect(upstream)
+        self.address = self._front.getsockname()
+        self._client = None
+        self._pending = []
+        self._order = itertools.count()
+        self._running = False
+        self.forwarded = 0
+        self.lost = 0
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self, sock, data, addr):
+        if self._random.random() < self.loss:
+            self.lost += 1
+            return
+        due = time.monotonic() + self.delay + self._random.uniform(0, self.jitter)
+        heapq.heappush(self._pending, (due, next(self._order), sock, data, addr))
+
+    def _run(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self._front, selectors.EVENT_READ)
+        sel.register(self._back, selectors.EVENT_READ)
+        while self._running:
+            timeout = 0.05
+            if self._pending:
+                timeout = max(min(self._pending[0][0] - time.monotonic(), timeout), 0)
+            for key, _ in sel.select(timeout):
+                try:
+                    if key.fileobj is self._front:
+                        data, self._client = self._front.recvfrom(65536)
+                        self._schedule(self._back, data, None)
+                    else:
+                        data = self._back.recv(65536)
+                        if self._client is not None:
+                            self._schedule(self._front, data, self._client)
+                except ConnectionRefusedError:
+                    pass
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self._pending)
+                try:
+                    if addr is None:
+                        sock.send(data)
+                    else:
+                        sock.sendto(data, addr)
+                    self.forwarded += 1
+                except OSError:
+                    pass
+        sel.close()
+        self._front.close()
+        self._back.close()
+
+
+class DelayedTcpProxy:
+    """In-process TCP proxy that delays one connection in both directions.
+
+    TCP retransmits what a link loses, so only delay and jitter are emulated.
+    Bytes keep their order, a chunk is never forwarded before the one in
+    front of it even when its own jitter came out smaller.
+    """
+
+    def __init__(self, upstream, delay=0.0, jitter=0.0, host="localhost", port=0, seed=None):
+        self.upstream = upstream
+        self.delay = delay
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen()
+        self.address = self._listener.getsockname()
+        self._pending = []
+        self._order = itertools.count()
+        # Due time of the last chunk scheduled towards each socket
+        self._last_due = {}
+        self._running = False
+        self.forwarded = 0
+
+    def start(self):
+        self._running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self, sock, data):
+        due = time.monotonic() + self.delay + self._random.uniform(0, self.jitter)
+        due = max(due, self._last_due.get(sock, 0.0))
+        self._last_due[sock] = due
+        heapq.heappush(self._pending, (due, next(self._order), sock, data))
+
+    def _run(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self._listener, selectors.EVENT_READ)
+        peers = {}
+        while self._running:
+            timeout = 0.05
+            if self._pending:
+                timeout = max(min(self._pending[0][0] - time.monotonic(), timeout), 0)
+            for key, _ in sel.select(timeout):
+                if key.fileobj is self._listener:
+                    front, _ = self._listener.accept()
+                    back = socket.create_connection(self.upstream)
+                    for sock in (front, back):
+                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    peers[front], peers[back] = back, front
+                    sel.register(front, selectors.EVENT_READ)
+                    sel.register(back, selectors.EVENT_READ)
+                    continue
+                if key.fileobj not in peers:
+                    # Closed along with its peer earlier in this batch
+                    continue
+                try:
+                    data = key.fileobj.recv(65536)
+                except OSError:
+                    data = b""
+                if data:
+                    self._schedule(peers[key.fileobj], data)
+                else:
+                    for sock in (key.fileobj, peers.pop(key.fileobj)):
+                        peers.pop(sock, None)
+                        sel.unregister(sock)
+                        sock.close()
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                _, _, sock, data = heapq.heappop(self._pending)
+                try:
+                    sock.sendall(data)
+                    self.forwarded += 1
+                except OSError:
+                    pass
+        sel.close()
+        self._listener.close()
+        for sock in peers:
+            sock.close()
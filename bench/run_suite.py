@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Run the control and video link benchmarks into one JSON document.
+
+Every configuration of bench_link.py and bench_video_link.py with their
+default options, tagged with the commit and machine, so two runs can be
+diffed to spot regressions. The video half needs numpy and opencv and is
+skipped without them.
+
+    python bench/run_suite.py [--seconds 3] [--delay 0] [--jitter 0] [--loss 0] [--output results.json]
+"""
+
+import argparse
+import sys
+
+import bench_link
+import harness
+
+
+def _options(module, argv):
+    parser = argparse.ArgumentParser()
+    module.add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", default="3")
+    parser.add_argument("--delay", default="0")
+    parser.add_argument("--jitter", default="0")
+    parser.add_argument("--loss", default="0")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = bench_link.run(_options(bench_link, [
+        "--seconds", args.seconds, "--delay", args.delay, "--jitter", args.jitter, "--loss", args.loss,
+    ]))
+    try:
+        import bench_video_link
+    except ImportError as e:
+        print(f"Skipping the video link: {e}", file=sys.stderr)
+    else:
+        results += bench_video_link.run(_options(bench_video_link, ["--seconds", args.seconds]))
+    harness.emit(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,302 @@
-import socket, cv2, pickle, struct
+import socket, cv2
+import logging
 import threading
-from tkinter import Tk, Label
+from tkinter import Tk, Label, TclError
+import numpy as np
 from PIL import Image, ImageTk
 
+import libvideo
+import libvideorecord
+
+logger = logging.getLogger(__name__)
+
 class VideoClient:
     def __init__(self, host_ip, port):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((host_ip, port))
-        self.data = b""
-        self.payload_size = struct.calcsize("Q")
+        self.header_buffer = bytearray(libvideo.FRAME_HEADER.size)
+        self.payload_buffer = bytearray(256 * 1024)
+        # Header of the last frame received: codec, resolution, seq and capture time
+        self.frame_header = None
+        # stream -> FrameAssembler, pastes the tiles of a camera sending only
+        # what changed onto its keyframe
+        self.assemblers = {}
+        # libvideorecord.VideoRecorder that gets every frame received, or None
+        self.recorder = None
+    
+    def _recv_exact(self, buffer, size):
+        """Fill the first size bytes of buffer, False if the server went away."""
+        view = memoryview(buffer)[:size]
+        while view:
+            received = self.client_socket.recv_into(view)
+            if not received:
+                return False
+            view = view[received:]
+        return True
         
-    def receive_frame(self):
+    def receive_frame(self, copy=True, streams=None):
+        """Next frame of any camera as a BGR array, None once the server is gone.
+
+        frame_header.stream tells the cameras apart. With streams only
+        frames of those are decoded and returned, the others are skipped.
+        With copy=False a raw frame or one put together from tiles is a
+        buffer that the next call overwrites.
+        """
+        while True:
+            if not self._recv_exact(self.header_buffer, libvideo.FRAME_HEADER.size):
+                return None
+            header = libvideo.unpack_header(self.header_buffer)
+
+            if header.length > len(self.payload_buffer):
+                self.payload_buffer = bytearray(header.length)
+            if not self._recv_exact(self.payload_buffer, header.length):
+                return None
+
+            self.frame_header = header
+            if self.recorder is not None:
+                # The buffers get reused, the recorder needs bytes of its own
+                self.recorder.record(
+                    header.seq, header.timestamp,
+                    bytes(self.header_buffer) + bytes(memoryview(self.payload_buffer)[:header.length]),
+                )
+            if streams is not None and header.stream not in streams:
+                continue
+            payload = memoryview(self.payload_buffer)[:header.length]
+            if header.codec != libvideo.CODEC_TILES:
+                return libvideo.decode_frame(header, payload, copy)
+            assembler = self.assemblers.get(header.stream)
+            if assembler is None:
+                assembler = self.assemblers[header.stream] = libvideo.FrameAssembler()
+            frame = assembler.assemble(header, payload, copy)
+            if frame is not None:
+                return frame
+            # Tiles for a keyframe we missed, the server follows up with a new one
+
+    def run(self, callbacks, copy=False):
+        """Call callbacks[stream](frame, header) with every frame until the server is gone.
+
+        Runs on the calling thread. Frames of streams without a callback
+        are not decoded, with copy=False see receive_frame.
+        """
+        streams = set(callbacks)
         while True:
-            while len(self.data) < self.payload_size:
-                packet = self.client_socket.recv(4*1024) # 4K
-                if not packet:
-                    return None
-                self.data += packet
-            packed_msg_size = self.data[:self.payload_size]
-            self.data = self.data[self.payload_size:]
-            msg_size = struct.unpack("Q", packed_msg_size)[0]
-            
-            while len(self.data) < msg_size:
-                self.data += self.client_socket.recv(4*1024)
-            
-            frame_data = self.data[:msg_size]
-            self.data = self.data[msg_size:]
-            frame = pickle.loads(frame_data)
-            return frame
+            frame = self.receive_frame(copy, streams)
+            if frame is None:
+                return
+            callbacks[self.frame_header.stream](frame, self.frame_header)
+
+    def start_recording(self, path):
+        """Append every frame received from now on to path, with an index at path + ".idx".
+
+        Frames of all cameras go into the one recording, see
+        libvideorecord.VideoReader for reading a single one back.
+        """
+        self.stop_recording()
+        self.recorder = libvideorecord.VideoRecorder(path)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
     def close(self):
+        self.stop_recording()
         self.client_socket.close()
 
+def _format_value(value):
+    if isinstance(value, (tuple, list)):
+        return " ".join(_format_value(v) for v in value)
+    if isinstance(value, float):
+        return f"{value:+.2f}"
+    return str(value)
+
+
+class TelemetryOverlay:
+    """Draws telemetry text in the corner of every frame.
+
+    source is called once per frame and returns {label: value}, e.g. the
+    IMU and motor values of the relay. The text is only rendered when it
+    changed, into a patch on a dark box of its own, every frame then gets
+    it with a single copy.
+    """
+
+    def __init__(self, source, origin=(8, 8), font_scale=0.45, color=(255, 255, 0)):
+        self.source = source
+        self.origin = origin
+        self.font_scale = font_scale
+        # The frames are RGB by the time they get here
+        self.color = color
+        self._lines = None
+        self._patch = None
+
+    def _render(self, lines):
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        sizes = [cv2.getTextSize(line, font, self.font_scale, 1) for line in lines]
+        line_height = max((h + baseline for (w, h), baseline in sizes), default=0) + 4
+        width = max((w for (w, h), baseline in sizes), default=0) + 4
+        # The dark box keeps the text readable on any background
+        patch = np.zeros((line_height * len(lines) + 2, width, 3), dtype=np.uint8)
+        for i, line in enumerate(lines):
+            position = (2, (i + 1) * line_height - 4)
+            cv2.putText(patch, line, position, font, self.font_scale, self.color, 1, cv2.LINE_AA)
+        self._patch = patch
+        self._lines = lines
+
+    def draw(self, frame):
+        lines = tuple(f"{label}: {_format_value(value)}" for label, value in self.source().items())
+        if lines != self._lines:
+            self._render(lines)
+        x, y = self.origin
+        height = min(self._patch.shape[0], frame.shape[0] - y)
+        width = min(self._patch.shape[1], frame.shape[1] - x)
+        if height <= 0 or width <= 0:
+            return
+        frame[y:y + height, x:x + width] = self._patch[:height, :width]
+
+
+class _StreamBuffers:
+    def __init__(self):
+        self.buffers = []
+        self.ready = None
+        self.shown = None
+
+
+class FrameWorker:
+    """Receives, decodes and converts frames for display on a thread of its own.
+
+    Frames are converted to RGB into one of three preallocated buffers per
+    camera: one the display shows, one holding the newest finished frame
+    and one being written. A frame the display didn't take in time is
+    replaced by the next one. on_frame(stream) is called on this thread
+    whenever a finished frame is waiting and the display hasn't been told
+    yet, and on_frame(None) once the connection ends. streams limits the
+    cameras received, overlay is drawn on the frames of all of them.
+    """
+
+    def __init__(self, video_client, on_frame=None, overlay=None, streams=None):
+        self.video_client = video_client
+        self.on_frame = on_frame
+        self.overlay = overlay
+        self.streams = streams
+        self.running = False
+        self.frames = 0
+        # Finished frames replaced before the display took them
+        self.skipped = 0
+        self._lock = threading.Lock()
+        # stream -> _StreamBuffers
+        self._streams = {}
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def _free_buffer(self, stream, shape):
+        with self._lock:
+            buffers = self._streams.get(stream)
+            if buffers is None:
+                buffers = self._streams[stream] = _StreamBuffers()
+            if not buffers.buffers or buffers.buffers[0].shape != shape:
+                # New resolution, the display keeps the old buffer it holds alive
+                buffers.buffers = [np.empty(shape, dtype=np.uint8) for _ in range(3)]
+            for buffer in buffers.buffers:
+                if buffer is not buffers.ready and buffer is not buffers.shown:
+                    return buffer
+
+    def _run(self):
+        try:
+            while self.running:
+                frame = self.video_client.receive_frame(copy=False, streams=self.streams)
+                if frame is None:
+                    logger.info("No frame received, stopping")
+                    break
+                stream = self.video_client.frame_header.stream
+                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._free_buffer(stream, frame.shape))
+                if self.overlay is not None:
+                    self.overlay.draw(rgb)
+                self.frames += 1
+                with self._lock:
+                    buffers = self._streams[stream]
+                    notify = buffers.ready is None
+                    if not notify:
+                        self.skipped += 1
+                    buffers.ready = rgb
+                if notify and self.on_frame is not None:
+                    self.on_frame(stream)
+        except OSError as e:
+            logger.info("Connection lost: %s", e)
+        finally:
+            self.running = False
+            if self.on_frame is not None:
+                self.on_frame(None)
+
+    def received_streams(self):
+        with self._lock:
+            return sorted(self._streams)
+
+    def take(self, stream=0):
+        """Newest finished RGB frame of stream, None if there is nothing new. Valid until the next take."""
+        with self._lock:
+            buffers = self._streams.get(stream)
+            if buffers is None or buffers.ready is None:
+                return None
+            buffers.shown, buffers.ready = buffers.ready, None
+            return buffers.shown
+
+
 class VideoDisplay:
-    def __init__(self, video_client):
+    """One window showing every camera, or those in streams, side by side."""
+
+    def __init__(self, video_client, overlay=None, streams=None):
         self.video_client = video_client
         self.root = Tk()
         self.root.title("Receiving Video")
-        self.label = Label(self.root)
-        self.label.pack()
-        self.update_frame()
-
-    def update_frame(self):
-        frame = self.video_client.receive_frame()
-        if frame is None:
-            print("No frame received. Exiting ...")
+        # stream -> Label and its PhotoImage, added as the cameras' first frames arrive
+        self._labels = {}
+        self._photos = {}
+        # The worker only posts an event, Tk itself is only used on this thread
+        self.worker = FrameWorker(video_client, on_frame=self._frame_ready, overlay=overlay, streams=streams)
+        self.root.bind("<<FrameReady>>", self.update_frame)
+
+    def _frame_ready(self, stream):
+        try:
+            self.root.event_generate("<<FrameReady>>", when="tail")
+        except (TclError, RuntimeError):
+            # The window is gone
+            pass
+
+    def update_frame(self, event=None):
+        for stream in self.worker.received_streams():
+            frame = self.worker.take(stream)
+            if frame is not None:
+                self._show(stream, frame)
+        if not self.worker.running:
+            logger.info("No frame received, exiting")
             self.root.quit()
-            return
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(frame)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.label.image = imgtk
-        self.label.configure(image=imgtk)
-        self.label.after(10, self.update_frame)
+
+    def _show(self, stream, frame):
+        height, width = frame.shape[:2]
+        # Shares the worker's buffer instead of copying it into a new image
+        image = Image.frombuffer("RGB", (width, height), frame, "raw", "RGB", 0, 1)
+        photo = self._photos.get(stream)
+        if photo is None or (photo.width(), photo.height()) != (width, height):
+            label = self._labels.get(stream)
+            if label is None:
+                label = self._labels[stream] = Label(self.root)
+                label.pack(side="left")
+            photo = self._photos[stream] = ImageTk.PhotoImage(image=image)
+            label.configure(image=photo)
+        else:
+            photo.paste(image)
 
     def start(self):
+        # Tk only takes events from other threads once the main loop runs
+        self.root.after(0, self.worker.start)
         self.root.mainloop()
+        self.worker.running = False
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     host_ip = 'localhost' # paste your server ip address here
     port = 9999
     video_client = VideoClient(host_ip, port)
@@ -0,0 +1,150 @@
+import collections
+import struct
+
+import cv2
+import numpy as np
+
+# Every frame on the video socket is this header followed by the encoded payload
+FRAME_VERSION = 2
+# version, stream, codec, width, height, sequence number, capture timestamp,
+# payload length. The stream is the camera, every one counts its own seq
+FRAME_HEADER = struct.Struct(">BBBHHIdI")
+
+CODEC_RAW = 0
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODECS = {"raw": CODEC_RAW, "jpeg": CODEC_JPEG, "png": CODEC_PNG}
+# Parts of a frame pasted onto a keyframe, see pack_tiles
+CODEC_TILES = 3
+
+# In front of a CODEC_TILES payload: seq of the keyframe the tiles go on,
+# codec of the tiles, number of tiles. A keyframe has its own seq there
+TILES_HEADER = struct.Struct(">IBH")
+# x, y, width, height, payload length of a tile. All entries come first,
+# then the tile payloads in the same order
+TILE_ENTRY = struct.Struct(">HHHHI")
+
+FrameHeader = collections.namedtuple(
+    "FrameHeader", ["version", "stream", "codec", "width", "height", "seq", "timestamp", "length"]
+)
+
+
+class FrameEncoder:
+    """Compresses BGR frames, JPEG for the live feed or PNG when it has to be lossless."""
+
+    def __init__(self, codec="jpeg", quality=80, png_compression=1):
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported video codec {codec!r}.")
+        self.codec = codec
+        self.quality = quality
+        self.png_compression = png_compression
+
+    def encode(self, frame):
+        if self.codec == "raw":
+            return np.ascontiguousarray(frame).tobytes()
+        if self.codec == "jpeg":
+            ok, payload = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        else:
+            ok, payload = cv2.imencode(".png", frame, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+        if not ok:
+            raise ValueError(f"Could not encode frame as {self.codec}.")
+        return payload.tobytes()
+
+
+def pack_frame(codec, width, height, seq, timestamp, payload, stream=0):
+    return FRAME_HEADER.pack(FRAME_VERSION, stream, CODECS[codec], width, height, seq, timestamp, len(payload)) + payload
+
+
+def pack_tiles(codec, width, height, seq, timestamp, key_seq, tiles, stream=0):
+    """Frame of width x height made of the keyframe key_seq and tiles, [(x, y, w, h, payload)].
+
+    With key_seq == seq the frame is a keyframe, its tiles cover all of it.
+    """
+    parts = [TILES_HEADER.pack(key_seq, CODECS[codec], len(tiles))]
+    parts += [TILE_ENTRY.pack(x, y, w, h, len(payload)) for x, y, w, h, payload in tiles]
+    parts += [payload for x, y, w, h, payload in tiles]
+    length = sum(len(part) for part in parts)
+    header = FRAME_HEADER.pack(FRAME_VERSION, stream, CODEC_TILES, width, height, seq, timestamp, length)
+    return header + b"".join(parts)
+
+
+def unpack_tiles(payload):
+    """key_seq, tile codec id and [(x, y, w, h, payload)] of a CODEC_TILES payload."""
+    key_seq, codec, count = TILES_HEADER.unpack_from(payload)
+    offset = TILES_HEADER.size + count * TILE_ENTRY.size
+    view = memoryview(payload)
+    tiles = []
+    for i in range(count):
+        x, y, w, h, length = TILE_ENTRY.unpack_from(payload, TILES_HEADER.size + i * TILE_ENTRY.size)
+        tiles.append((x, y, w, h, view[offset:offset + length]))
+        offset += length
+    if offset > len(payload):
+        raise ValueError("Tiles run past the end of the video frame.")
+    return key_seq, codec, tiles
+
+
+def unpack_header(data):
+    header = FrameHeader._make(FRAME_HEADER.unpack_from(data))
+    if header.version != FRAME_VERSION:
+        raise ValueError(f"Unsupported video frame version {header.version}.")
+    return header
+
+
+def decode_frame(header, payload, copy=True):
+    """Turn a payload back into a BGR frame.
+
+    With copy=False a raw frame is a view into payload, for callers that
+    are done with it before the buffer is reused.
+    """
+    if header.codec == CODEC_RAW:
+        frame = np.frombuffer(payload, dtype=np.uint8).reshape(header.height, header.width, 3)
+        # The payload may live in a receive buffer that gets reused, so copy it out
+        return frame.copy() if copy else frame
+    if header.codec in (CODEC_JPEG, CODEC_PNG):
+        frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError("Could not decode video frame.")
+        return frame
+    if header.codec == CODEC_TILES:
+        raise ValueError("Tiles need the keyframe they go on, use FrameAssembler.")
+    raise ValueError(f"Unsupported video codec id {header.codec}.")
+
+
+class FrameAssembler:
+    """Rebuilds the CODEC_TILES frames of one stream in buffers that live as long as it.
+
+    The last keyframe is kept, every update is that keyframe with the
+    update's tiles pasted over it. Updates carry all tiles that differ from
+    the keyframe, so one that never arrived costs nothing but its frame.
+    """
+
+    def __init__(self):
+        self.key_seq = None
+        self._key = None
+        self._canvas = None
+
+    def _paste(self, target, codec, tiles):
+        for x, y, w, h, payload in tiles:
+            header = FrameHeader(FRAME_VERSION, 0, codec, w, h, 0, 0.0, len(payload))
+            target[y:y + h, x:x + w] = decode_frame(header, payload, copy=False)
+
+    def assemble(self, header, payload, copy=True):
+        """The frame as a BGR array, None for an update to a keyframe we don't have.
+
+        With copy=False the array is a buffer that the next call overwrites.
+        """
+        key_seq, codec, tiles = unpack_tiles(payload)
+        shape = (header.height, header.width, 3)
+        if key_seq == header.seq:
+            if self._key is None or self._key.shape != shape:
+                self._key = np.zeros(shape, dtype=np.uint8)
+                self._canvas = np.empty_like(self._key)
+            self._paste(self._key, codec, tiles)
+            self.key_seq = key_seq
+            np.copyto(self._canvas, self._key)
+        else:
+            if key_seq != self.key_seq or self._key.shape != shape:
+                return None
+            np.copyto(self._canvas, self._key)
+            self._paste(self._canvas, codec, tiles)
+        return self._canvas.copy() if copy else self._canvas
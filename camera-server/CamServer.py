@@ -2,15 +2,87 @@
 
 # This code is for the server 
 # Lets import the libraries
-import socket, cv2, pickle, struct, imutils
+import socket, cv2, time
+import logging
+import select
 import threading
 
+import libadapt
+import libpipeline
+import libvideo
+import libvideorecord
+
+logger = logging.getLogger(__name__)
+
+# Unsent bytes below which a viewer's socket with several cameras counts as
+# ready for the next frame. The frame is picked only then, by when every
+# camera has had the time to deliver its newest one
+UNSENT_LIMIT = 4 * 1024
+
+class Camera:
+    """One capture source of a VideoServer and how its video is made.
+
+    stream is the id its frames carry on the connection, weight its share
+    of a viewer's link while the cameras compete for it. Every camera has
+    its own capture thread, encoder and settings.
+    """
+
+    def __init__(
+        self, name, stream=0, device=0, codec="jpeg", quality=80, width=350, encode_workers=2,
+        preview=False, open_capture=None, adaptive=None, changes=None, weight=1.0,
+    ):
+        if not 0 <= stream <= 0xFF:
+            raise ValueError(f"Stream id {stream} does not fit in a byte.")
+        self.name = name
+        self.stream = stream
+        # jpeg for the live feed, png if it has to be lossless, raw to skip compression
+        self.encoder = libvideo.FrameEncoder(codec, quality)
+        self.width = width
+        # libadapt.AdaptiveController with the bounds for width, quality and
+        # frame rate, it then picks them from how the viewers keep up instead
+        self.adaptive = adaptive
+        # libpipeline.ChangeDetector, frames then only carry the tiles that
+        # changed and unchanged ones are not sent at all
+        self.changes = changes
+        self.encode_workers = encode_workers
+        # The local preview window runs on its own thread, off the send path
+        self.preview = preview
+        # Called to open the camera when the first viewer connects, anything
+        # with read/isOpened/release works, e.g. a recorded or synthetic source
+        self.open_capture = open_capture or (lambda: cv2.VideoCapture(device))
+        self.weight = weight
+        # One capture and encode pipeline shared by every connected viewer
+        self.pipeline = None
+        # Records what the pipeline sends while anyone is watching
+        self.recorder = None
+
+
 class VideoServer:
-    def __init__(self, host_ip, port):
+    """Sends the video of one or more cameras to every viewer over one connection each.
+
+    Without cameras the other arguments describe a single camera, stream
+    0 on device 0. Every frame carries the stream of its camera, a viewer's
+    sender picks the next one to go out with a libpipeline.StreamQueue.
+    """
+
+    def __init__(self, host_ip, port, codec="jpeg", quality=80, width=350, encode_workers=2, preview=False, open_capture=None, adaptive=None, changes=None, cameras=None):
+        if cameras is None:
+            cameras = [Camera(
+                "main", codec=codec, quality=quality, width=width, encode_workers=encode_workers,
+                preview=preview, open_capture=open_capture, adaptive=adaptive, changes=changes,
+            )]
+        self.cameras = {}
+        names = set()
+        for camera in cameras:
+            if camera.stream in self.cameras or camera.name in names:
+                raise ValueError(f"Camera {camera.name!r} or stream {camera.stream} is already taken.")
+            self.cameras[camera.stream] = camera
+            names.add(camera.name)
+        self._pipeline_lock = threading.Lock()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((host_ip, port))
         self.server_socket.listen(5)
-        print("LISTENING AT:", (host_ip, port))
+        logger.info("Listening at %s", (host_ip, port))
     
     def start_thread(self):
         thread = threading.Thread(target=self._start)
@@ -20,26 +92,140 @@ class VideoServer:
     def _start(self):
         while True:
             client_socket, addr = self.server_socket.accept()
-            print('GOT CONNECTION FROM:', addr)
+            logger.info("Got connection from %s", addr)
             if client_socket:
-                self.send_video(client_socket)
-
-    def send_video(self, client_socket):
-        vid = cv2.VideoCapture(0)
-        while vid.isOpened():
-            img, frame = vid.read()
-            frame = imutils.resize(frame, width=350)
-            a = pickle.dumps(frame)
-            message = struct.pack("Q", len(a)) + a
-            client_socket.sendall(message)
-            
-            cv2.imshow('TRANSMITTING VIDEO', frame)
-            key = cv2.waitKey(1) & 0xFF
-            if key == ord('q'):
-                client_socket.close()
-                break
+                # Every viewer gets its own sender so a slow one only drops its own frames
+                thread = threading.Thread(target=self.send_video, args=(client_socket, addr))
+                thread.daemon = True
+                thread.start()
+
+    def get_stats(self):
+        """{camera name: stats}, average and worst time per stage plus frames dropped between stages.
+
+        With an adaptive controller also its current settings, what it
+        measured per viewer and its last changes with the reasons.
+        """
+        stats = {}
+        for camera in self.cameras.values():
+            pipeline = camera.pipeline
+            camera_stats = stats[camera.name] = {} if pipeline is None else pipeline.get_stats()
+            if camera.adaptive is not None:
+                camera_stats["adaptive"] = camera.adaptive.get_stats()
+        return stats
+
+    def start_recording(self, path):
+        """Append every frame sent from now on to path, with an index at path + ".idx".
+
+        With several cameras each gets a recording of its own, path needs a
+        {camera} field for the camera's name.
+        """
+        if len(self.cameras) > 1 and "{camera}" not in path:
+            raise ValueError(f"Recording {len(self.cameras)} cameras needs a {{camera}} field in {path!r}.")
+        self.stop_recording()
+        with self._pipeline_lock:
+            for camera in self.cameras.values():
+                camera_path = path.format(camera=camera.name) if len(self.cameras) > 1 else path
+                camera.recorder = libvideorecord.VideoRecorder(camera_path)
+                if camera.pipeline is not None:
+                    camera.pipeline.recorder = camera.recorder
+
+    def stop_recording(self):
+        recorders = []
+        with self._pipeline_lock:
+            for camera in self.cameras.values():
+                if camera.recorder is not None:
+                    recorders.append(camera.recorder)
+                    camera.recorder = None
+                if camera.pipeline is not None:
+                    camera.pipeline.recorder = None
+        for recorder in recorders:
+            recorder.close()
+
+    def _subscribe(self, addr, frames):
+        pipelines = {}
+        with self._pipeline_lock:
+            for stream, camera in self.cameras.items():
+                if camera.pipeline is None or not camera.pipeline.running:
+                    # First viewer opens the camera, later ones share its frames
+                    title = 'TRANSMITTING VIDEO' if len(self.cameras) == 1 else f'TRANSMITTING VIDEO ({camera.name})'
+                    camera.pipeline = libpipeline.VideoPipeline(
+                        camera.open_capture(), camera.encoder, camera.width,
+                        workers=camera.encode_workers, preview=camera.preview, controller=camera.adaptive,
+                        detector=camera.changes, stream=stream, title=title,
+                    )
+                    camera.pipeline.recorder = camera.recorder
+                    camera.pipeline.start()
+                camera.pipeline.subscribe(addr, queue=frames.inlet(stream))
+                pipelines[stream] = camera.pipeline
+        return pipelines
+
+    def _unsubscribe(self, pipelines, addr):
+        with self._pipeline_lock:
+            for stream, pipeline in pipelines.items():
+                adaptive = self.cameras[stream].adaptive
+                if adaptive is not None:
+                    adaptive.forget(addr)
+                if not pipeline.unsubscribe(addr):
+                    # Last viewer left, let go of the camera
+                    pipeline.stop()
+
+    def send_video(self, client_socket, addr=None):
+        send_buffers = [
+            camera.adaptive.send_buffer for camera in self.cameras.values()
+            if camera.adaptive is not None and camera.adaptive.send_buffer
+        ]
+        if send_buffers:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, max(send_buffers))
+        wait_for_link = len(self.cameras) > 1
+        if wait_for_link:
+            option = getattr(socket, "TCP_NOTSENT_LOWAT", None)
+            try:
+                client_socket.setsockopt(socket.IPPROTO_TCP, option, UNSENT_LIMIT)
+            except (OSError, TypeError):
+                # Picks the next frame as soon as the last one is in the kernel buffer
+                wait_for_link = False
+        frames = libpipeline.StreamQueue({stream: camera.weight for stream, camera in self.cameras.items()})
+        pipelines = self._subscribe(addr, frames)
+        try:
+            # Capture and encode keep going on their own threads, this one only
+            # sends, whatever was encoded while sendall blocked is dropped
+            key_seqs = {}
+            while True:
+                if wait_for_link:
+                    # Leave the choice of camera until the link can take the frame
+                    select.select([], [client_socket], [], 1)
+                item = frames.get(timeout=1)
+                if item is None:
+                    if not any(pipeline.running for pipeline in pipelines.values()):
+                        break
+                    continue
+                stream, frame = item
+                pipeline = pipelines[stream]
+                adaptive = self.cameras[stream].adaptive
+                if frame.key_seq is not None:
+                    if frame.key_seq == frame.seq:
+                        key_seqs[stream] = frame.seq
+                    elif frame.key_seq != key_seqs.get(stream):
+                        # This viewer never got the keyframe the tiles go on
+                        pipeline.request_keyframe()
+                        continue
+                if adaptive is not None:
+                    queued = libadapt.send_queue_bytes(client_socket)
+                start = time.perf_counter()
+                client_socket.sendall(frame.message)
+                seconds = time.perf_counter() - start
+                pipeline.stats.record("send", seconds)
+                if adaptive is not None:
+                    adaptive.record_send(addr, len(frame.message), seconds, frames.dropped[stream], queued)
+                pipeline.stats.record("latency", time.time() - frame.timestamp)
+        except OSError as e:
+            logger.info("Connection lost from %s: %s", addr, e)
+        finally:
+            self._unsubscribe(pipelines, addr)
+            client_socket.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     host_ip = 'localhost'
     port = 9999
     video_server = VideoServer(host_ip, port)
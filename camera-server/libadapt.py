@@ -0,0 +1,214 @@
+import collections
+import logging
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # Windows has neither, the queue delay just isn't measured there
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+Settings = collections.namedtuple("Settings", ["width", "quality", "fps"])
+
+# Kernel send buffer for the viewers' sockets. Left to autotuning it grows to
+# megabytes, seconds of video at tether speeds that anything else sent on
+# the tether waits behind. Small, sendall blocks instead and the frames
+# nobody can take are dropped before they are queued.
+DEFAULT_SEND_BUFFER = 64 * 1024
+
+
+def send_queue_bytes(sock):
+    """Bytes the kernel still holds for sock, sent but not acked or not sent yet, None if unknown."""
+    if fcntl is None:
+        return None
+    try:
+        queued = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, struct.pack("i", 0))
+    except (OSError, AttributeError):
+        return None
+    return struct.unpack("i", queued)[0]
+
+
+def build_ladder(min_width, max_width, min_quality, max_quality, min_fps, max_fps, quality_step=10, scale_step=0.75):
+    """Settings from best to worst, every step lowers one knob.
+
+    JPEG quality goes first since it costs the least to give up, then the
+    frame rate, then the resolution.
+    """
+    width, quality, fps = max_width, max_quality, max_fps
+    ladder = [Settings(width, quality, fps)]
+    while quality > min_quality:
+        quality = max(quality - quality_step, min_quality)
+        ladder.append(Settings(width, quality, fps))
+    while fps > min_fps:
+        fps = max(round(fps * scale_step), min_fps)
+        ladder.append(Settings(width, quality, fps))
+    while width > min_width:
+        width = max(int(width * scale_step), min_width)
+        ladder.append(Settings(width, quality, fps))
+    return ladder
+
+
+class _ClientWindow:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.dropped = None
+        self.dropped_at_start = None
+        self.queue_bytes = None
+
+
+class AdaptiveController:
+    """Picks resolution, JPEG quality and frame rate from how the viewers' links keep up.
+
+    Every sender reports each frame it sent: bytes, seconds spent in
+    sendall, how many frames its queue dropped so far and how much the
+    kernel still held for it before the frame. Once per interval every
+    viewer is judged on what its link achieved:
+
+    - queue delay, the smallest send queue seen in the interval over the
+      achieved throughput. A queue that never drains means the tether is
+      full and everything else on it, the control link included, waits
+      behind the video
+    - busy, the share of the interval spent blocked in sendall
+    - frames dropped because the sender couldn't keep up
+
+    One congested viewer steps the settings down the ladder, two steps
+    when it is far over. Once all viewers had headroom for hold_intervals
+    in a row the settings step up by one, and again after every further
+    interval with headroom. A step too far is undone by the next interval.
+    The encoder is shared, the viewer with the worst link decides for all.
+    """
+
+    def __init__(
+        self, min_width=160, max_width=640, min_quality=30, max_quality=85, min_fps=5, max_fps=30,
+        interval=1.0, max_queue_delay=0.1, high_busy=0.6, low_busy=0.25, hold_intervals=3,
+        send_buffer=DEFAULT_SEND_BUFFER,
+    ):
+        self.ladder = build_ladder(min_width, max_width, min_quality, max_quality, min_fps, max_fps)
+        self.interval = interval
+        self.max_queue_delay = max_queue_delay
+        self.high_busy = high_busy
+        self.low_busy = low_busy
+        self.hold_intervals = hold_intervals
+        self.send_buffer = send_buffer
+        self.level = 0
+        self.settings = self.ladder[0]
+        self.changes = collections.deque(maxlen=20)
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._measured = {}
+        self._good_intervals = 0
+        self._window_start = time.monotonic()
+
+    def record_send(self, client, size, seconds, dropped, queue_bytes=None):
+        """Called by a sender after every frame, dropped is its queue's running count.
+
+        queue_bytes is what the kernel held before the frame was sent,
+        from send_queue_bytes.
+        """
+        with self._lock:
+            window = self._clients.get(client)
+            if window is None:
+                window = self._clients[client] = _ClientWindow()
+            window.frames += 1
+            window.bytes += size
+            window.busy += seconds
+            if window.dropped_at_start is None:
+                window.dropped_at_start = dropped
+            window.dropped = dropped
+            if queue_bytes is not None and (window.queue_bytes is None or queue_bytes < window.queue_bytes):
+                # Only the part that never drains counts, bursts come and go
+                window.queue_bytes = queue_bytes
+            now = time.monotonic()
+            if now - self._window_start >= self.interval:
+                self._update(now)
+
+    def forget(self, client):
+        with self._lock:
+            self._clients.pop(client, None)
+            self._measured.pop(client, None)
+
+    def _judge(self, client, window, elapsed):
+        if not window.frames:
+            # Another sender got its frames out, this one is stuck in sendall
+            self._measured[client] = {"throughput_bps": 0.0, "busy": 1.0, "dropped": 0, "queue_delay_ms": None}
+            return 2, f"{client} sent nothing for {elapsed:.1f} s"
+        throughput = window.bytes / elapsed
+        busy = window.busy / elapsed
+        dropped = window.dropped - window.dropped_at_start
+        queue_delay = None
+        if window.queue_bytes is not None and throughput:
+            queue_delay = window.queue_bytes / throughput
+        self._measured[client] = {
+            "throughput_bps": throughput * 8,
+            "busy": busy,
+            "dropped": dropped,
+            "queue_delay_ms": None if queue_delay is None else queue_delay * 1e3,
+        }
+        if queue_delay is not None and queue_delay > self.max_queue_delay:
+            steps = 2 if queue_delay > 4 * self.max_queue_delay else 1
+            return steps, f"{client} queue delay {queue_delay * 1e3:.0f} ms"
+        if busy > self.high_busy:
+            steps = 2 if busy > 0.9 else 1
+            return steps, f"{client} busy sending {busy:.0%} of the time"
+        # Two encode workers finishing close together can cost a frame on any link
+        if dropped > max(1, window.frames // 10):
+            return 1, f"{client} dropped {dropped} frames"
+        if busy < self.low_busy and (queue_delay is None or queue_delay < self.max_queue_delay / 4):
+            return 0, None
+        # Neither congested nor clearly idle, hold
+        return None, None
+
+    def _update(self, now):
+        elapsed = now - self._window_start
+        self._window_start = now
+        down, reason, idle = 0, None, bool(self._clients)
+        for client, window in self._clients.items():
+            steps, why = self._judge(client, window, elapsed)
+            if steps is None:
+                idle = False
+            elif steps:
+                idle = False
+                if steps > down:
+                    down, reason = steps, why
+        # Start the next window, the drop counters keep running
+        for client, window in list(self._clients.items()):
+            fresh = self._clients[client] = _ClientWindow()
+            fresh.dropped_at_start = window.dropped
+            fresh.dropped = window.dropped
+        if down:
+            self._good_intervals = 0
+            self._move(min(self.level + down, len(self.ladder) - 1), reason)
+        elif idle:
+            self._good_intervals += 1
+            if self._good_intervals >= self.hold_intervals and self.level > 0:
+                self._move(self.level - 1, f"headroom for {self._good_intervals} intervals")
+        else:
+            self._good_intervals = 0
+
+    def _move(self, level, reason):
+        if level == self.level:
+            return
+        before = self.settings
+        self.level = level
+        self.settings = self.ladder[level]
+        logger.info("Video %s -> %s: %s", tuple(before), tuple(self.settings), reason)
+        self.changes.append({
+            "time": time.time(), "from": before._asdict(), "to": self.settings._asdict(), "reason": reason,
+        })
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "settings": self.settings._asdict(),
+                "level": self.level,
+                "levels": len(self.ladder),
+                "clients": {str(client): dict(m) for client, m in self._measured.items()},
+                "changes": list(self.changes),
+            }
@@ -0,0 +1,208 @@
+import logging
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Start of the segment, the number is the layout version
+MAGIC = b"ROVRING\x01"
+# Frames the ring holds, a reader's view stays valid while SLOTS - 1 newer ones are written
+DEFAULT_SLOTS = 4
+
+# Magic, height, width, channels, slots, seq of the newest complete frame
+RING_HEADER = struct.Struct("<8sIIIIQ")
+_LATEST_OFFSET = 24
+# Seq of the frame in the slot, 0 while it is being written, capture time
+SLOT_HEADER = struct.Struct("<Qd")
+# Slots and their pixels start on cache line boundaries
+ALIGNMENT = 64
+
+_SEQ = struct.Struct("<Q")
+
+# Seconds between looks at the newest seq while waiting for a frame
+DEFAULT_POLL_INTERVAL = 0.001
+
+
+def _align(size):
+    return size + -size % ALIGNMENT
+
+
+def open_segment(name, size=0, create=False):
+    """SharedMemory name, attached ones are left alone by this process' resource tracker.
+
+    Only the creator should remove a segment. Before Python 3.13 every
+    process that attaches registers it too and unlinks it when it exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=create)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name, create, size)
+        if not create:
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+class FrameRing:
+    """Camera frames in shared memory, written by one process and read by others without copies.
+
+    The capture process creates the ring with the frame shape and writes
+    every frame into the next slot. Readers attach by name and get numpy
+    views straight into the slots. A slot is reused after slots - 1 newer
+    frames, a reader that holds on to a view longer checks holds(seq)
+    afterwards. Frames are uint8 like everything cv2 captures. A frame
+    torn by the writer is a glitch in one picture, unlike the robot state
+    there is no checksum.
+    """
+
+    def __init__(self, name, shape=None, slots=DEFAULT_SLOTS, create=False):
+        self.name = name
+        self._created = create
+        if create:
+            height, width, channels = shape
+            size = RING_HEADER.size + slots * self._slot_size(height, width, channels)
+            try:
+                self._segment = open_segment(name, size, create=True)
+            except FileExistsError:
+                # Left behind by a capture process that was killed, its readers reattach
+                logger.warning("Replacing the stale frame ring %s", name)
+                stale = open_segment(name)
+                stale.close()
+                stale.unlink()
+                self._segment = open_segment(name, size, create=True)
+            buffer = self._segment.buf
+            buffer[:RING_HEADER.size] = bytes(RING_HEADER.size)
+            RING_HEADER.pack_into(buffer, 0, MAGIC, height, width, channels, slots, 0)
+        else:
+            self._segment = open_segment(name)
+            magic, height, width, channels, slots, _ = RING_HEADER.unpack_from(self._segment.buf)
+            if magic != MAGIC:
+                self._segment.close()
+                raise ValueError(f"Shared memory {name!r} is not a frame ring.")
+        self.shape = (height, width, channels)
+        self.slots = slots
+        slot_size = self._slot_size(height, width, channels)
+        self._headers = []
+        self._images = []
+        for n in range(slots):
+            offset = RING_HEADER.size + n * slot_size
+            self._headers.append(offset)
+            self._images.append(np.ndarray(
+                self.shape, np.uint8, self._segment.buf, offset + _align(SLOT_HEADER.size),
+            ))
+
+    @staticmethod
+    def _slot_size(height, width, channels):
+        return _align(_align(SLOT_HEADER.size) + height * width * channels)
+
+    @property
+    def latest(self):
+        """Seq of the newest complete frame, 0 before the first one."""
+        return _SEQ.unpack_from(self._segment.buf, _LATEST_OFFSET)[0]
+
+    def write(self, image, timestamp=None):
+        """Copy image into the next slot and return its seq."""
+        seq = self.latest + 1
+        n = seq % self.slots
+        buffer = self._segment.buf
+        SLOT_HEADER.pack_into(buffer, self._headers[n], 0, 0.0)
+        np.copyto(self._images[n], image)
+        SLOT_HEADER.pack_into(buffer, self._headers[n], seq, time.time() if timestamp is None else timestamp)
+        _SEQ.pack_into(buffer, _LATEST_OFFSET, seq)
+        return seq
+
+    def holds(self, seq):
+        """Whether the slot of seq still holds that frame."""
+        return SLOT_HEADER.unpack_from(self._segment.buf, self._headers[seq % self.slots])[0] == seq
+
+    def read(self, seq=None):
+        """(seq, timestamp, image) of frame seq or the newest, None if it is gone or not there yet.
+
+        image is a view into the ring, copy it to keep it.
+        """
+        if seq is None:
+            seq = self.latest
+            if not seq:
+                return None
+        n = seq % self.slots
+        slot_seq, timestamp = SLOT_HEADER.unpack_from(self._segment.buf, self._headers[n])
+        if slot_seq != seq:
+            return None
+        return seq, timestamp, self._images[n]
+
+    def wait_newer(self, seq, timeout=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        """The newest frame after seq as read returns it, None if there was none within timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.latest > seq:
+                frame = self.read()
+                if frame is not None:
+                    return frame
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        """Detach, the creator also removes the segment."""
+        # The views keep the buffer exported, those have to go first
+        self._images = []
+        self._segment.close()
+        if self._created:
+            self._segment.unlink()
+
+
+class SharedCapture:
+    """Reads a FrameRing like a cv2.VideoCapture, for VideoServer(open_capture=...).
+
+    The camera is opened by a capture process of its own, the server only
+    encodes what it finds in the ring. read waits for a frame newer than
+    the last one and returns a view into the ring, the pipeline resizes
+    it, which copies, long before the slot is reused. When nothing new
+    came for stall_timeout the ring is attached again, a restarted
+    capture process creates a fresh one under the same name.
+    """
+
+    def __init__(self, name, stall_timeout=1.0, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.name = name
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+        self.ring = None
+        self._seq = 0
+        self._opened = True
+        self._attach()
+
+    def _attach(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        try:
+            self.ring = FrameRing(self.name)
+        except (FileNotFoundError, ValueError) as e:
+            logger.warning("No frame ring %s: %s", self.name, e)
+            return
+        if self.ring.latest < self._seq:
+            # A new ring counts from the start again
+            self._seq = 0
+
+    def isOpened(self):
+        return self._opened
+
+    def read(self):
+        if self.ring is None:
+            time.sleep(self.stall_timeout)
+            self._attach()
+            return False, None
+        frame = self.ring.wait_newer(self._seq, self.stall_timeout, self.poll_interval)
+        if frame is None:
+            self._attach()
+            return False, None
+        self._seq = frame[0]
+        return True, frame[2]
+
+    def release(self):
+        self._opened = False
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
@@ -0,0 +1,493 @@
+import collections
+import logging
+import threading
+import time
+
+import cv2
+import imutils
+import numpy as np
+
+import libvideo
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait after a failed camera read, doubled while it keeps failing
+READ_BACKOFF = 0.01
+READ_BACKOFF_MAX = 0.5
+# Failed reads in a row, about 20 s with the backoff, after which the camera
+# counts as gone and capture stops like it does when it is closed
+MAX_READ_FAILURES = 50
+
+# key_seq and tiles are set for frames the ChangeDetector cut into tiles,
+# tiles is [(x, y, w, h)] and a keyframe has key_seq == seq
+Frame = collections.namedtuple("Frame", ["seq", "timestamp", "image", "key_seq", "tiles"], defaults=(None, None))
+EncodedFrame = collections.namedtuple("EncodedFrame", ["seq", "timestamp", "message", "key_seq"], defaults=(None,))
+
+
+class LatestQueue:
+    """Bounded queue that drops the oldest item instead of blocking the producer."""
+
+    def __init__(self, maxlen=1):
+        self._items = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Oldest item still queued, None on timeout or once closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self._closed, timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StreamQueue:
+    """The newest frame of every camera for one viewer, sent in a weighted fair share.
+
+    Each stream keeps only its newest frame, like a LatestQueue of one.
+    get hands out the waiting frame of the stream that is furthest behind
+    its share of the bytes sent lately, weights is {stream: weight} and
+    sets the shares. What a stream sent counts half after half_life
+    seconds: cameras deliver in bursts, a stream that had no frame ready
+    when the link was free makes up for it with its next ones, but one
+    that stayed quiet for long has no credit saved up. The later get is
+    called, the more streams have a frame to choose from. Pipelines
+    publish to inlet(stream).
+    """
+
+    def __init__(self, weights, half_life=1.0):
+        self._weights = dict(weights)
+        self.half_life = half_life
+        self._items = dict.fromkeys(self._weights)
+        # Bytes sent per stream, decayed to the time of the last get
+        self._sent = dict.fromkeys(self._weights, 0.0)
+        self._decayed_at = time.monotonic()
+        self._open = set(self._weights)
+        self._cond = threading.Condition()
+        self.dropped = dict.fromkeys(self._weights, 0)
+
+    def inlet(self, stream):
+        return _StreamInlet(self, stream)
+
+    def put(self, stream, item):
+        with self._cond:
+            if self._items[stream] is not None:
+                self.dropped[stream] += 1
+            self._items[stream] = item
+            self._cond.notify()
+
+    def _waiting(self):
+        return [stream for stream, item in self._items.items() if item is not None]
+
+    def get(self, timeout=None):
+        """(stream, frame) to send next, None on timeout or once every stream is closed."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._waiting() or not self._open, timeout)
+            waiting = self._waiting()
+            if not waiting:
+                return None
+            now = time.monotonic()
+            decay = 0.5 ** ((now - self._decayed_at) / self.half_life)
+            self._decayed_at = now
+            for stream in self._sent:
+                self._sent[stream] *= decay
+            stream = min(waiting, key=lambda s: self._sent[s] / self._weights[s])
+            item, self._items[stream] = self._items[stream], None
+            self._sent[stream] += len(item.message)
+            return stream, item
+
+    def close(self, stream):
+        with self._cond:
+            self._open.discard(stream)
+            self._cond.notify_all()
+
+
+class _StreamInlet:
+    """One stream of a StreamQueue, looks like a LatestQueue to the pipeline."""
+
+    def __init__(self, queue, stream):
+        self.queue = queue
+        self.stream = stream
+
+    @property
+    def dropped(self):
+        return self.queue.dropped[self.stream]
+
+    def put(self, item):
+        self.queue.put(self.stream, item)
+
+    def close(self):
+        self.queue.close(self.stream)
+
+
+class StageStats:
+    """Per-stage timings so it's visible where the frame budget goes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "avg_ms": total / count * 1e3,
+                    "max_ms": worst * 1e3,
+                }
+                for stage, (count, total, worst) in self._stages.items()
+            }
+
+
+class ChangeDetector:
+    """Finds the tiles of a frame that differ from the last keyframe.
+
+    Frames are compared at 1/scale of their size, area averaged so that
+    sensor noise cancels out. A tile of tile_size pixels is dirty once a
+    cell of it differs from the keyframe by more than threshold in any
+    color. Frames in which nothing changed since the last one sent are
+    skipped, the others go out as the tiles dirty against the keyframe,
+    merged into rectangles. Every update holds all of them, not only what
+    changed since the previous frame, so a viewer that missed some updates
+    is right again with the next one.
+
+    A new keyframe is due every refresh_interval seconds, when more than
+    max_dirty of the tiles are dirty, when the resolution changes and when
+    a sender asks for one. Updates only refer to it once it was published,
+    until then frames are skipped.
+    """
+
+    # Seconds a keyframe may take to be published before another one is planned
+    PENDING_TIMEOUT = 1.0
+
+    def __init__(self, tile_size=64, scale=8, threshold=10, max_dirty=0.5, refresh_interval=2.0):
+        if tile_size % scale:
+            raise ValueError(f"Tile size {tile_size} is not a multiple of the scale {scale}.")
+        self.tile_size = tile_size
+        self.scale = scale
+        self.threshold = threshold
+        self.max_dirty = max_dirty
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._key = None
+            self._pending = None
+            self._last_sent = None
+            self._requested = True
+            self.keyframes = 0
+            self.updates = 0
+            self.skipped = 0
+            self._dirty_total = 0.0
+
+    def request_keyframe(self):
+        self._requested = True
+
+    def _dirty_tiles(self, small, reference):
+        # Worst color of every cell, then worst cell of every tile
+        diff = cv2.absdiff(small, reference).max(axis=2)
+        cells = self.tile_size // self.scale
+        rows = np.arange(0, diff.shape[0], cells)
+        cols = np.arange(0, diff.shape[1], cells)
+        worst = np.maximum.reduceat(np.maximum.reduceat(diff, rows, axis=0), cols, axis=1)
+        return worst > self.threshold
+
+    def _rectangles(self, dirty, width, height):
+        """(x, y, w, h) covering the dirty tiles, runs in a row merged, equal runs below each other too."""
+        size = self.tile_size
+        rects = []
+        open_runs = {}
+        for row in range(dirty.shape[0]):
+            runs = {}
+            flags = dirty[row]
+            col = 0
+            while col < len(flags):
+                if not flags[col]:
+                    col += 1
+                    continue
+                start = col
+                while col < len(flags) and flags[col]:
+                    col += 1
+                rect = open_runs.pop((start, col), None)
+                if rect is None:
+                    rect = [start * size, row * size, min(col * size, width) - start * size, 0]
+                    rects.append(rect)
+                rect[3] = min((row + 1) * size, height) - rect[1]
+                runs[(start, col)] = rect
+            open_runs = runs
+        return [tuple(rect) for rect in rects]
+
+    def plan(self, seq, image):
+        """(key_seq, tiles) for the frame seq, None to skip it."""
+        height, width = image.shape[:2]
+        small = cv2.resize(
+            image, (-(-width // self.scale), -(-height // self.scale)), interpolation=cv2.INTER_AREA
+        )
+        now = time.monotonic()
+        with self._lock:
+            if self._pending is not None:
+                if now - self._pending[2] < self.PENDING_TIMEOUT:
+                    self.skipped += 1
+                    return None
+                # Dropped somewhere, plan another one
+                self._pending = None
+            key = self._key
+            dirty = None
+            if not self._requested and key is not None and key[1].shape == small.shape \
+                    and now - key[2] < self.refresh_interval:
+                dirty = self._dirty_tiles(small, key[1])
+                if dirty.mean() > self.max_dirty:
+                    dirty = None
+            if dirty is None:
+                self._requested = False
+                self._pending = (seq, small, now)
+                self.keyframes += 1
+                return seq, [(0, 0, width, height)]
+            if not self._dirty_tiles(small, self._last_sent).any():
+                # The viewers already show this
+                self.skipped += 1
+                return None
+            self._last_sent = small
+            self.updates += 1
+            self._dirty_total += dirty.mean()
+            return key[0], self._rectangles(dirty, width, height)
+
+    def published(self, seq):
+        """Called once the frame seq went out, updates can refer to it if it was the keyframe."""
+        with self._lock:
+            if self._pending is not None and self._pending[0] == seq:
+                self._key = self._pending
+                self._last_sent = self._pending[1]
+                self._pending = None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "keyframes": self.keyframes,
+                "updates": self.updates,
+                "skipped": self.skipped,
+                "avg_dirty": float(self._dirty_total / self.updates) if self.updates else None,
+            }
+
+
+class VideoPipeline:
+    """Capture, resize and encode on their own threads.
+
+    The capture thread hands frames to a pool of encode workers and the
+    workers publish every finished frame once to all subscribers. Each
+    subscriber gets the same encoded bytes through its own queue. Every
+    queue only keeps the newest frames, so a slow viewer costs itself
+    dropped frames instead of stalling capture or the other viewers.
+    """
+
+    def __init__(
+        self, capture, encoder, width, workers=2, preview=False, controller=None, detector=None,
+        stream=0, title='TRANSMITTING VIDEO',
+    ):
+        self.capture = capture
+        self.encoder = encoder
+        self.width = width
+        # libadapt.AdaptiveController that overrides width, quality and frame rate
+        self.controller = controller
+        # ChangeDetector that sends only the tiles that changed, or None for whole frames
+        self.detector = detector
+        self.workers = workers
+        self.preview = preview
+        # Put in the header of every frame so viewers can tell the cameras apart
+        self.stream = stream
+        # Of the preview window
+        self.title = title
+        self.stats = StageStats()
+        self.running = False
+        self._encode_queue = LatestQueue(maxlen=workers)
+        self._preview_queue = LatestQueue()
+        self._subscribers = {}
+        self._last_published = 0
+        self._publish_lock = threading.Lock()
+        # libvideorecord.VideoRecorder that gets every published frame, or None
+        self.recorder = None
+        self._threads = []
+
+    def start(self):
+        self.running = True
+        if self.detector is not None:
+            self.detector.reset()
+        targets = [self._capture_loop] + [self._encode_loop] * self.workers
+        if self.preview:
+            targets.append(self._preview_loop)
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def subscribe(self, name, maxlen=1, queue=None):
+        """Queue that receives every encoded frame from now on.
+
+        A new LatestQueue unless queue is given, anything with put, close
+        and dropped works, e.g. StreamQueue.inlet.
+        """
+        if queue is None:
+            queue = LatestQueue(maxlen)
+        with self._publish_lock:
+            self._subscribers[name] = queue
+            if not self.running:
+                queue.close()
+        self.request_keyframe()
+        return queue
+
+    def request_keyframe(self):
+        """Have the next frame go out whole, for a viewer that has none to paste tiles on."""
+        if self.detector is not None:
+            self.detector.request_keyframe()
+
+    def unsubscribe(self, name):
+        """Returns how many subscribers are left."""
+        with self._publish_lock:
+            queue = self._subscribers.pop(name, None)
+            if queue is not None:
+                queue.close()
+            return len(self._subscribers)
+
+    def _close_subscribers(self):
+        with self._publish_lock:
+            for queue in self._subscribers.values():
+                queue.close()
+
+    def stop(self):
+        self.running = False
+        for queue in (self._encode_queue, self._preview_queue):
+            queue.close()
+        self._close_subscribers()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.capture.release()
+
+    def get_stats(self):
+        stats = self.stats.snapshot()
+        with self._publish_lock:
+            stats["dropped"] = {
+                "encode_queue": self._encode_queue.dropped,
+                "subscribers": {str(name): queue.dropped for name, queue in self._subscribers.items()},
+            }
+        if self.detector is not None:
+            stats["changes"] = self.detector.get_stats()
+        return stats
+
+    def _capture_loop(self):
+        seq = 0
+        next_due = 0.0
+        failures = 0
+        while self.running and self.capture.isOpened():
+            start = time.perf_counter()
+            ok, image = self.capture.read()
+            timestamp = time.time()
+            if not ok:
+                failures += 1
+                if failures >= MAX_READ_FAILURES:
+                    logger.error("Camera read failed %d times in a row, stopping capture", failures)
+                    break
+                # A USB camera hiccup or the end of a file, don't spin on it
+                time.sleep(min(READ_BACKOFF * 2 ** (failures - 1), READ_BACKOFF_MAX))
+                continue
+            failures = 0
+            width = self.width
+            if self.controller is not None:
+                settings = self.controller.settings
+                width = settings.width
+                self.encoder.quality = settings.quality
+                # Keep reading the camera so frames stay fresh, skip the ones over the rate
+                interval = 1 / settings.fps
+                if start < next_due - interval / 4:
+                    continue
+                next_due = max(next_due + interval, start)
+            captured = time.perf_counter()
+            image = imutils.resize(image, width=width)
+            resized = time.perf_counter()
+            self.stats.record("capture", captured - start)
+            self.stats.record("resize", resized - captured)
+            seq += 1
+            frame = Frame(seq, timestamp, image)
+            if self.detector is not None:
+                start = time.perf_counter()
+                plan = self.detector.plan(seq, image)
+                self.stats.record("detect", time.perf_counter() - start)
+                if plan is None:
+                    continue
+                frame = frame._replace(key_seq=plan[0], tiles=plan[1])
+            self._encode_queue.put(frame)
+            if self.preview:
+                self._preview_queue.put(frame)
+        self.running = False
+        self._close_subscribers()
+
+    def _encode_loop(self):
+        while self.running:
+            frame = self._encode_queue.get(timeout=0.5)
+            if frame is None:
+                continue
+            start = time.perf_counter()
+            height, width = frame.image.shape[:2]
+            if frame.tiles is None:
+                payload = self.encoder.encode(frame.image)
+                message = libvideo.pack_frame(
+                    self.encoder.codec, width, height, frame.seq, frame.timestamp, payload, self.stream
+                )
+            else:
+                tiles = [
+                    (x, y, w, h, self.encoder.encode(frame.image[y:y + h, x:x + w]))
+                    for x, y, w, h in frame.tiles
+                ]
+                message = libvideo.pack_tiles(
+                    self.encoder.codec, width, height, frame.seq, frame.timestamp, frame.key_seq, tiles, self.stream
+                )
+            self.stats.record("encode", time.perf_counter() - start)
+            self._publish(EncodedFrame(frame.seq, frame.timestamp, message, frame.key_seq))
+
+    def _publish(self, frame):
+        with self._publish_lock:
+            # Workers can finish out of order, never go back in time
+            if frame.seq <= self._last_published:
+                return
+            self._last_published = frame.seq
+            if self.detector is not None and frame.key_seq == frame.seq:
+                self.detector.published(frame.seq)
+            subscribers = list(self._subscribers.values())
+            if self.recorder is not None:
+                # Only queues the bytes, under the lock so the file stays in seq order
+                self.recorder.record(frame.seq, frame.timestamp, frame.message)
+        for queue in subscribers:
+            queue.put(frame)
+
+    def _preview_loop(self):
+        while self.running:
+            frame = self._preview_queue.get(timeout=0.5)
+            if frame is None:
+                continue
+            cv2.imshow(self.title, frame.image)
+            key = cv2.waitKey(1) & 0xFF
+            if key == ord('q'):
+                self.running = False
+                self._close_subscribers()
@@ -0,0 +1,222 @@
+import bisect
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import libvideo
+
+logger = logging.getLogger(__name__)
+
+# Start of the data file and of its index, the number is the format version
+DATA_MAGIC = b"ROVVID\x00\x01"
+INDEX_MAGIC = b"ROVIDX\x00\x01"
+INDEX_SUFFIX = ".idx"
+# Offset of the frame in the data file, seq, capture time, bytes of header and payload
+INDEX_ENTRY = struct.Struct("<QIdI")
+
+# Seconds between batched writes
+DEFAULT_FLUSH_INTERVAL = 0.5
+# Frames waiting for the writer before new ones are dropped, about 10 s at 30 fps
+DEFAULT_MAX_PENDING = 300
+
+
+class VideoRecorder:
+    """Appends encoded frames exactly as they go over the wire, plus an index.
+
+    The data file is every libvideo frame, header and payload, one after
+    the other. The index next to it has one INDEX_ENTRY per frame, so
+    frame n is found without reading anything else, and the capture
+    times are the same wall clock as the telemetry log's. Writing happens
+    in batches on a thread of our own, record only queues the bytes.
+    The index of a batch is written after its frames, it never points
+    past the end of the data. Recording to the same path again first cuts
+    off what a crash left half written, entries and frames alike, so the
+    new entries line up and every entry points at a whole frame.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL, max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.frames = 0
+        self.dropped = 0
+        self._data = open(path, "ab")
+        self._index = open(path + INDEX_SUFFIX, "ab")
+        if self._data.tell() or self._index.tell():
+            try:
+                self._truncate_to_complete()
+            except ValueError:
+                self._data.close()
+                self._index.close()
+                raise
+        if self._data.tell() == 0:
+            self._data.write(DATA_MAGIC)
+        if self._index.tell() == 0:
+            self._index.write(INDEX_MAGIC)
+        self._offset = self._data.tell()
+        self._pending = collections.deque()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="VideoRecorder", daemon=True)
+        self._thread.start()
+
+    def _truncate_to_complete(self):
+        data_size = self._data.tell()
+        with open(self.path, "rb") as f:
+            magic = f.read(len(DATA_MAGIC))
+        with open(self.path + INDEX_SUFFIX, "rb") as f:
+            index = f.read()
+        if (data_size and magic != DATA_MAGIC) or (index and index[:len(INDEX_MAGIC)] != INDEX_MAGIC):
+            raise ValueError(f"{self.path} is not a video recording.")
+        entries = index[len(INDEX_MAGIC):]
+        # A crash can leave half an entry behind
+        entries = entries[:len(entries) - len(entries) % INDEX_ENTRY.size]
+        data_end = len(DATA_MAGIC) if data_size else 0
+        index_end = len(INDEX_MAGIC) if index else 0
+        for offset, seq, timestamp, length in INDEX_ENTRY.iter_unpack(entries):
+            if offset < data_end or offset + length > data_size:
+                break
+            data_end = offset + length
+            index_end += INDEX_ENTRY.size
+        # Frames past the last entry never got theirs, without it no reader finds them
+        for f, size, end in ((self._data, data_size, data_end), (self._index, len(index), index_end)):
+            if end < size:
+                logger.warning("Cutting %d bytes a crash left half written off the end of %s", size - end, f.name)
+                f.truncate(end)
+                f.seek(0, os.SEEK_END)
+
+    def record(self, seq, timestamp, message):
+        """Queue one packed frame, message must not change afterwards."""
+        if len(self._pending) >= self.max_pending:
+            # The disk can't keep up, losing frames beats stalling the video
+            self.dropped += 1
+            return
+        self._pending.append((seq, timestamp, message))
+
+    def _write_pending(self):
+        pending = self._pending
+        messages = []
+        index = bytearray()
+        while pending:
+            seq, timestamp, message = pending.popleft()
+            messages.append(message)
+            index += INDEX_ENTRY.pack(self._offset, seq, timestamp, len(message))
+            self._offset += len(message)
+        if messages:
+            self._data.writelines(messages)
+            self._data.flush()
+            self._index.write(index)
+            self._index.flush()
+            self.frames += len(messages)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self._write_pending()
+            except OSError:
+                logger.error("Writing %s failed, recording stopped", self.path, exc_info=True)
+                return
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._write_pending()
+        self._data.close()
+        self._index.close()
+
+
+class VideoReader:
+    """Memory maps a recording, frames are read on demand and never all at once.
+
+    A recording of several cameras holds the frames of all their streams,
+    with stream only those of that one are seen. find relies on the capture
+    times going up, which only holds within a stream.
+    """
+
+    def __init__(self, path, stream=None):
+        self._data = self._map(path, DATA_MAGIC)
+        self._index = self._map(path + INDEX_SUFFIX, INDEX_MAGIC)
+        # A crash can leave half an index entry behind
+        self._count = (len(self._index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+        # Numbers in the file of the frames of stream, None for all frames
+        self._frames = None
+        if stream is not None:
+            self._frames = [n for n in range(self._count) if self._stream(self._entry(n)[0]) == stream]
+            self._count = len(self._frames)
+
+    @staticmethod
+    def _map(path, magic):
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:len(magic)] != magic:
+            mapped.close()
+            raise ValueError(f"{path} is not a video recording.")
+        return mapped
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, n):
+        return INDEX_ENTRY.unpack_from(self._index, len(INDEX_MAGIC) + n * INDEX_ENTRY.size)
+
+    def _stream(self, offset):
+        # The stream is the byte after the version in every frame header
+        return self._data[offset + 1]
+
+    def entry(self, n):
+        """(offset, seq, timestamp, length) of frame n."""
+        if not 0 <= n < self._count:
+            raise IndexError(n)
+        return self._entry(n if self._frames is None else self._frames[n])
+
+    def timestamp(self, n):
+        return self.entry(n)[2]
+
+    def find(self, timestamp):
+        """Number of the last frame captured at or before timestamp, -1 if there is none."""
+        return bisect.bisect_right(_Timestamps(self), timestamp) - 1
+
+    def read(self, n):
+        """Header and payload of frame n, the payload is a view into the map."""
+        offset, seq, timestamp, length = self.entry(n)
+        header = libvideo.unpack_header(self._data[offset:offset + libvideo.FRAME_HEADER.size])
+        start = offset + libvideo.FRAME_HEADER.size
+        return header, memoryview(self._data)[start:start + header.length]
+
+    def decode(self, n):
+        header, payload = self.read(n)
+        if header.codec != libvideo.CODEC_TILES:
+            return libvideo.decode_frame(header, payload)
+        # Tiles go on a keyframe recorded before them
+        key_seq = libvideo.unpack_tiles(payload)[0]
+        key = n
+        while key >= 0:
+            offset, seq = self.entry(key)[:2]
+            if seq == key_seq and self._stream(offset) == header.stream:
+                break
+            key -= 1
+        if key < 0:
+            raise ValueError(f"Keyframe {key_seq} of frame {n} is not in the recording.")
+        assembler = libvideo.FrameAssembler()
+        if key != n:
+            assembler.assemble(*self.read(key))
+        return assembler.assemble(header, payload)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+class _Timestamps:
+    """Lets bisect search the capture times in the index without copying them."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, n):
+        return self.reader.timestamp(n)
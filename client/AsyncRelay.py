@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import threading
+import time
+
+import libclient as libclient
+import libdelta
+import liblog
+import libmetrics
+
+logger = logging.getLogger(__name__)
+
+
+class TransportSocket:
+    """Lets a Message write to an asyncio transport as if it was its socket.
+
+    The transport buffers whatever it can't send yet, so send always takes
+    everything and the Message never has to wait for write readiness.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def send(self, data):
+        self.transport.write(bytes(data))
+        return len(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class NoSelector:
+    """Readiness is asyncio's job, there is nothing to register or modify."""
+
+    def modify(self, sock, events, data=None):
+        pass
+
+    def unregister(self, sock):
+        pass
+
+
+class RelayProtocol(asyncio.Protocol):
+    def __init__(self, relay, addr):
+        self.relay = relay
+        self.addr = addr
+        self.message = None
+        self.closed = asyncio.get_running_loop().create_future()
+        # Set while the transport's buffer is over its high water mark
+        self.paused = False
+
+    def connection_made(self, transport):
+        relay = self.relay
+        self.message = libclient.Message(
+            NoSelector(), TransportSocket(transport), self.addr,
+            relay._create_request(relay.robot_state), relay.robot_state, relay.sensor_data,
+            max_in_flight=relay.max_in_flight, paced=relay.control_rate is not None,
+            stats=relay.stats,
+        )
+        relay._protocol = self
+        if relay.control_rate is None:
+            self.fill_window()
+
+    def fill_window(self):
+        # Without a control rate, keep as many requests in flight as allowed
+        message = self.message
+        while not self.paused and message.can_send():
+            message.robot_state = self.relay.robot_state
+            message.send_request()
+
+    def data_received(self, data):
+        message = self.message
+        previous = message.sensor_data
+        try:
+            message.receive(data)
+        except Exception:
+            logger.error("Exception for %s", message.addr, exc_info=True)
+            message.close()
+            return
+        if message.sensor_data is not previous:
+            self.relay._publish_sensor_data(message.sensor_data)
+        if self.relay.control_rate is None:
+            self.fill_window()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.relay.control_rate is None:
+            self.fill_window()
+
+    def connection_lost(self, exc):
+        logger.info("Closing connection to %s", self.addr)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+
+class AsyncRelay:
+    """asyncio version of RelayThread.
+
+    Keeps the same set_/get_ methods, adds awaitable ones for code that is
+    already async, and runs its connection and control timer as tasks, so it
+    can share one event loop with the camera and any other sockets.
+    begin_thread runs it on a loop of its own for code that isn't async.
+    The set_ methods may be called from any thread, they publish a new
+    robot_state dict instead of changing the one the loop is sending.
+    """
+
+    def __init__(self, host='localhost', port=65432):
+        self.sensor_data = {"IMU": (0.0, 0.0, 0.0)}
+        self.robot_state = {"horizontal_motors": (0.0, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": False}
+
+        self.host = host
+        self.port = port
+        # Same knobs as RelayThread
+        self.max_in_flight = 1
+        self.control_rate = None
+        self.keepalive_interval = 0.1
+        self.delta_sync = False
+        # Seconds to wait before trying again when the server can't be reached
+        self.reconnect_delay = 0.5
+        self.stats = libmetrics.LinkStats()
+        # Setters on different threads would otherwise lose each other's fields
+        self._state_lock = threading.Lock()
+
+        self._protocol = None
+        self._tasks = []
+        self._waiters = []
+        self._last_sent_state = None
+        self._last_send_time = 0.0
+
+    def _update_robot_state(self, **fields):
+        with self._state_lock:
+            self.robot_state = {**self.robot_state, **fields}
+
+    def set_horizontal_motors(self, fl : float, fr : float, br : float, bl : float):
+        self._update_robot_state(horizontal_motors=(fl, fr, br, bl))
+
+    def set_vertical_motors(self, front : float, back : float):
+        self._update_robot_state(vertical_motors=(front, back))
+
+    def set_enabled(self, enabled : bool):
+        self._update_robot_state(enabled=enabled)
+
+    def get_imu_data(self):
+        return self.sensor_data["IMU"]
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    async def next_sensor_data(self):
+        """Wait for the next sensor data from the server."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return await waiter
+
+    def _publish_sensor_data(self, sensor_data):
+        self.sensor_data = dict(sensor_data)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(self.sensor_data)
+
+    def _create_request(self, robot_state):
+        accept = libclient.SUPPORTED_CONTENT_TYPES
+        if not self.delta_sync:
+            accept = tuple(t for t in accept if t != libdelta.DELTA_CONTENT_TYPE)
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=robot_state,
+            accept=accept,
+        )
+
+    async def _connection_loop(self):
+        loop = asyncio.get_running_loop()
+        addr = (self.host, self.port)
+        while True:
+            logger.info("Starting connection to %s", addr)
+            try:
+                _, protocol = await loop.create_connection(
+                    lambda: RelayProtocol(self, addr), self.host, self.port
+                )
+            except OSError as e:
+                logger.warning("Could not connect to %s: %r", addr, e)
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self.stats.connections += 1
+            self._last_sent_state = None
+            await protocol.closed
+            self._protocol = None
+
+    async def _control_loop(self):
+        """Send on a fixed tick, only when the state changed or the keepalive is due."""
+        next_tick = time.monotonic()
+        while True:
+            await asyncio.sleep(max(next_tick - time.monotonic(), 0))
+            next_tick = max(next_tick + 1 / self.control_rate, time.monotonic()) # type: ignore
+            protocol = self._protocol
+            if protocol is None or protocol.paused or not protocol.message.can_send():
+                continue
+            now = time.monotonic()
+            if (
+                self.robot_state == self._last_sent_state
+                and now - self._last_send_time < self.keepalive_interval
+            ):
+                continue
+            robot_state = self.robot_state
+            protocol.message.robot_state = robot_state
+            protocol.message.send_request()
+            # Never changed once published, no copy needed
+            self._last_sent_state = robot_state
+            self._last_send_time = now
+
+    async def start(self):
+        self._tasks.append(asyncio.create_task(self._connection_loop()))
+        if self.control_rate is not None:
+            self._tasks.append(asyncio.create_task(self._control_loop()))
+
+    async def run(self):
+        await self.start()
+        await asyncio.gather(*self._tasks)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._protocol is not None:
+            self._protocol.message.close()
+
+    def begin_thread(self):
+        # Must not keep the program alive once the code that started it is done
+        thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        thread.start()
+
+
+if __name__ == "__main__":
+    liblog.configure()
+    asyncio.run(AsyncRelay().run())
@@ -1,10 +1,27 @@
 
+import logging
+import random
 import selectors
 import socket
 import threading
-import traceback
+import time
 
+import libchannel
 import libclient as libclient
+import libcodec
+import libdatagram
+import libdelta
+import liblog
+import libmetrics
+import librecord
+import libstate
+import libtcp
+
+logger = logging.getLogger(__name__)
+
+# Datagrams are never answered unasked, so udp always sends on a control
+# tick and uses this rate when control_rate isn't set
+UDP_CONTROL_RATE = 50
 
 
 class RelayThread:
@@ -22,20 +39,152 @@ class RelayThread:
     
     def _start(self):
         self.sel = selectors.DefaultSelector()
-        self.sensor_data = {"IMU": (0.0, 0.0, 0.0)}
-        self.robot_state = {"horizontal_motors": (0.0, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": False}
+        # Setters publish a new robot state version, the network thread only
+        # ever reads whole snapshots and publishes every sensor data it receives
+        self._sensor_data = libstate.StateCell({"IMU": (0.0, 0.0, 0.0)})
+        self._robot_state = libstate.StateCell({"horizontal_motors": (0.0, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": False})
         
         self.host = 'localhost'
         self.port = 65432
+        # Requests allowed on the wire before the server answers, 1 waits for
+        # every response and higher values pipeline past the tether round trip
+        self.max_in_flight = 1
+        # Frames per second sent to the server, None sends as fast as the link allows.
+        # With a rate set, setter calls within one tick go out as a single frame
+        # and unchanged state is only resent every keepalive_interval seconds
+        self.control_rate = None
+        self.keepalive_interval = 0.1
+        # Ask the server for incremental sync, frames then only carry the
+        # fields that changed since the last acknowledged frame
+        self.delta_sync = False
+        # "tcp" or "udp", with udp every state frame is a datagram of its own and
+        # late or out of order frames are dropped instead of delivered after newer ones
+        self.transport = "tcp"
+        self.udp_max_age = libdatagram.DEFAULT_MAX_AGE
+        # Seconds between link stats lines in the log, None never logs them
+        self.stats_interval = None
+        # Seconds without a frame from the server before the link counts as dead
+        # and is reconnected, keep it well above keepalive_interval. None waits
+        # for the kernel to notice
+        self.link_timeout = 0.3
+        # Seconds before the first reconnect attempt, doubled after every failed
+        # one up to reconnect_max_delay and randomized by half either way
+        self.reconnect_delay = 0.05
+        self.reconnect_max_delay = 0.25
+        # True once the current connection delivered a frame
+        self.link_up = False
+        
+        self._message = None
+        self._backoff = self.reconnect_delay
+        self._next_connect = 0.0
+        # Message channels next to the robot state, kept across reconnects so
+        # messages sent while the link is down go out on the next connection
+        self.channels = libchannel.ChannelRouter()
+        self._recorder = None
+        # Link counters and round trip times, kept across reconnects
+        self.stats = libmetrics.LinkStats()
+        self._stats_logged = None
+        # Setters hand out the robot state version they published as a ticket,
+        # the ticket counts as sent once a frame carrying that version has been queued
+        self._send_cond = threading.Condition()
+        self._sent_update = 0
+        self._last_sent_state = None
+        self._last_send_time = 0.0
+        self._frame_log = liblog.SampledLogger(logger)
+        self.send_stats = {"frames_sent": 0, "updates": 0, "coalesced": 0, "skipped": 0, "keepalives": 0}
+    
+    @property
+    def robot_state(self):
+        return self._robot_state.get().state
+    
+    @property
+    def sensor_data(self):
+        return self._sensor_data.get().state
     
     def set_horizontal_motors(self, fl : float, fr : float, br : float, bl : float):
-        self.robot_state["horizontal_motors"] = (fl, fr, br, bl)
+        return self._robot_state.update(horizontal_motors=(fl, fr, br, bl))
     
     def set_vertical_motors(self, front : float, back : float):
-        self.robot_state["vertical_motors"] = (front, back)
+        return self._robot_state.update(vertical_motors=(front, back))
     
     def set_enabled(self, enabled : bool):
-        self.robot_state["enabled"] = enabled
+        return self._robot_state.update(enabled=enabled)
+    
+    def get_sensor_snapshot(self):
+        """Newest sensor data with its version, every field from the same frame."""
+        return self._sensor_data.get()
+    
+    def wait_for_sensor_data(self, version, timeout=None):
+        """Block until sensor data newer than version arrives, None on timeout."""
+        return self._sensor_data.wait_newer(version, timeout)
+    
+    def subscribe(self, callback, field=None, threshold=None, executor=None):
+        """Call callback on the relay thread as soon as new sensor data is decoded.
+
+        It gets the whole sensor data, or with a field like "IMU" only that
+        field and only when it moved by more than threshold. Callbacks that
+        take a while should pass an executor to keep the link running.
+        """
+        return self._sensor_data.subscribe(callback, field, threshold, executor)
+    
+    def unsubscribe(self, subscription):
+        self._sensor_data.unsubscribe(subscription)
+    
+    def register_channel(self, name, channel_id, priority=0, codec=libchannel.JSON_CODEC, on_receive=None, queue_limit=100):
+        """Add a message channel, the server has to register the same name and id.
+
+        Higher priorities go out first, the robot state always goes ahead of
+        every channel. on_receive is called on the relay thread with each
+        decoded message. queue_limit=1 keeps only the newest unsent message.
+        """
+        return self.channels.register(name, channel_id, priority, codec, on_receive, queue_limit)
+    
+    def send_channel(self, name, obj):
+        """Queue obj on a channel, it goes out behind the next robot state frame."""
+        self.channels.send(name, obj)
+    
+    def get_channel_stats(self):
+        """Messages sent, received and dropped per channel."""
+        return self.channels.get_stats()
+    
+    def start_recording(self, path):
+        """Append every robot state the application sets and all sensor data received to a log at path."""
+        self.stop_recording()
+        recorder = librecord.Recorder(path)
+        recorder.attach(self._robot_state, libcodec.KIND_ROBOT_STATE)
+        recorder.attach(self._sensor_data, libcodec.KIND_SENSOR_DATA)
+        self._recorder = recorder
+    
+    def stop_recording(self):
+        """Write out what is still buffered and close the log."""
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+    
+    def wait_for_send(self, ticket, timeout=None):
+        """Block until the update a setter returned as ticket has been sent, False on timeout."""
+        with self._send_cond:
+            return self._send_cond.wait_for(lambda: self._sent_update >= ticket, timeout)
+    
+    def get_send_stats(self):
+        with self._send_cond:
+            stats = dict(self.send_stats)
+            stats["updates"] = self._robot_state.version
+        return stats
+    
+    def get_stats(self):
+        """Snapshot of the link counters and the round trip time percentiles in seconds."""
+        stats = self.stats.snapshot()
+        message = self._message
+        if isinstance(message, libclient.DatagramMessage):
+            stats["out_of_order"] = message.filter.out_of_order
+            stats["stale"] = message.filter.stale
+        return stats
+    
+    def _log_stats(self):
+        stats = self.get_stats()
+        logger.info("Link stats: %s", libmetrics.format_stats(stats, self._stats_logged))
+        self._stats_logged = stats
     
     def get_imu_data(self):
         return self.sensor_data["IMU"]
@@ -45,24 +194,122 @@ class RelayThread:
         thread.start()
 
     def _create_request(self, robot_state):
+        accept = libclient.SUPPORTED_CONTENT_TYPES
+        if not self.delta_sync:
+            accept = tuple(t for t in accept if t != libdelta.DELTA_CONTENT_TYPE)
         return dict(
             type="text/json",
             encoding="utf-8",
             content=robot_state,
+            accept=accept,
+        )
+    
+    def _tick_rate(self):
+        if self.transport == "udp":
+            return self.control_rate or UDP_CONTROL_RATE
+        return self.control_rate
+    
+    def _start_datagram(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.connect(addr)
+        request = self._create_request(self.robot_state)
+        message = libclient.DatagramMessage(
+            self.sel, sock, addr, request, self.robot_state, self.sensor_data,
+            max_age=self.udp_max_age, stats=self.stats,
         )
+        self.sel.register(sock, selectors.EVENT_READ, data=message)
+        self._message = message
+        self._last_sent_state = None
     
     def _start_connection(self, host, port):
         addr = (host, port)
-        print(f"Starting connection to {addr}")
+        logger.info("Starting connection to %s", addr)
+        self.stats.connections += 1
+        if self.transport == "udp":
+            self._start_datagram(addr)
+            return
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        libtcp.tune_socket(sock)
         sock.setblocking(False)
         sock.connect_ex(addr)
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
         
         # Send intial message to establish connection with initial robot state
         request = self._create_request(self.robot_state)
-        message = libclient.Message(self.sel, sock, addr, request, self.robot_state, self.sensor_data)
+        message = libclient.Message(
+            self.sel, sock, addr, request, self.robot_state, self.sensor_data,
+            max_in_flight=self.max_in_flight, paced=self.control_rate is not None,
+            stats=self.stats, channels=self.channels.open_link(),
+        )
         self.sel.register(sock, events, data=message)
+        self._message = message
+        self._last_sent_state = None
+
+    def _connection_lost(self, now):
+        self._message = None
+        self.link_up = False
+        # Randomized so a bunch of clients don't all hit the server in step
+        self._next_connect = now + self._backoff * random.uniform(0.5, 1.5)
+        self._backoff = min(self._backoff * 2, self.reconnect_max_delay)
+    
+    def _check_link(self):
+        """Drop a closed or silent connection and reconnect once the backoff allows."""
+        now = time.monotonic()
+        message = self._message
+        if message is not None:
+            if message.last_received is not None and not self.link_up:
+                logger.info("Link to %s is up", message.addr)
+                self.link_up = True
+                self._backoff = self.reconnect_delay
+            silent = now - (message.last_received or message.connected_at)
+            if message.sock is not None and self.link_timeout and silent > self.link_timeout:
+                logger.warning("Nothing from %s for %.0f ms, reconnecting", message.addr, silent * 1000)
+                message.close()
+            if message.sock is None:
+                self._connection_lost(now)
+        if self._message is None and now >= self._next_connect:
+            self._start_connection(self.host, self.port)
+
+    def _mark_sent(self, update, frames=1):
+        with self._send_cond:
+            self.send_stats["frames_sent"] += frames
+            if update > self._sent_update:
+                self._sent_update = update
+                self._send_cond.notify_all()
+
+    def _control_tick(self):
+        """Send the newest robot state if it changed or the keepalive is due."""
+        message = self._message
+        if message is None or message.sock is None or not message.can_send():
+            # The last frame is still going out, pending updates wait for the next tick
+            return
+        snapshot = self._robot_state.get()
+        update = snapshot.version
+        pending = update - self._sent_update
+        now = time.monotonic()
+        if snapshot.state == self._last_sent_state and not message.has_channel_data():
+            if now - self._last_send_time < self.keepalive_interval:
+                with self._send_cond:
+                    self.send_stats["skipped"] += 1
+                    self.send_stats["coalesced"] += pending
+                    # Nothing new went out but nothing was lost either
+                    self._sent_update = update
+                    self._send_cond.notify_all()
+                return
+            keepalive = True
+        else:
+            keepalive = False
+        
+        message.robot_state = snapshot.state
+        message.send_request()
+        self._last_sent_state = snapshot.state
+        self._last_send_time = now
+        with self._send_cond:
+            self.send_stats["coalesced"] += max(pending - 1, 0)
+            if keepalive:
+                self.send_stats["keepalives"] += 1
+        self._mark_sent(update)
 
     def _run_client_socket(self):
         try:
@@ -70,28 +317,71 @@ class RelayThread:
             self._start_connection(self.host, self.port)
 
             # Send and recieve messages
+            next_tick = time.monotonic()
+            next_stats = time.monotonic() + (self.stats_interval or 0)
             while True:
-                events = self.sel.select(timeout=1)
+                rate = self._tick_rate()
+                if rate:
+                    timeout = max(next_tick - time.monotonic(), 0)
+                else:
+                    timeout = 1
+                if self.stats_interval:
+                    timeout = min(timeout, max(next_stats - time.monotonic(), 0))
+                if self._message is None:
+                    timeout = min(timeout, max(self._next_connect - time.monotonic(), 0))
+                elif self.link_timeout:
+                    timeout = min(timeout, self.link_timeout / 4)
+                events = self.sel.select(timeout=timeout)
+                snapshot = self._robot_state.get()
                 for key, mask in events:
                     message = key.data
+                    seq = message.seq
+                    previous = message.sensor_data
                     try:
-                        message.process_events(mask, self.robot_state)
-                        print(f"Received: {message.sensor_data}")
+                        message.process_events(mask, snapshot.state)
+                        self._frame_log.log("Received: %s", message.sensor_data)
+                    except ConnectionError as e:
+                        # Expected while the server is down, the backoff takes care of it
+                        logger.warning("Connection to %s failed: %s", message.addr, e)
+                        message.close()
                     except Exception:
-                        print(
-                            f"Main: Error: Exception for {message.addr}:\n"
-                            f"{traceback.format_exc()}"
-                        )
+                        logger.error("Exception for %s", message.addr, exc_info=True)
                         message.close()
-                # reconnect if there are no active connections
-                if not self.sel.get_map():
-                    self._start_connection(self.host, self.port)
+                    # Messages replace their sensor data instead of changing it, and
+                    # waiters only wake up for data that actually changed
+                    if message.sensor_data is not previous and message.sensor_data != self.sensor_data:
+                        self._sensor_data.publish(message.sensor_data)
+                    if message.seq != seq:
+                        self._mark_sent(snapshot.version, message.seq - seq)
+                
+                if rate:
+                    now = time.monotonic()
+                    if now >= next_tick:
+                        message = self._message
+                        try:
+                            self._control_tick()
+                        except ConnectionError as e:
+                            logger.warning("Connection to %s failed: %s", message.addr, e)
+                            message.close()
+                        except Exception:
+                            # Same as a failed event, the connection goes but the relay keeps running
+                            logger.error("Sending to %s failed", message.addr, exc_info=True)
+                            message.close()
+                        next_tick += 1 / rate
+                        if next_tick < now:
+                            # Fell behind, skip the missed ticks instead of bursting
+                            next_tick = now + 1 / rate
+                if self.stats_interval and time.monotonic() >= next_stats:
+                    self._log_stats()
+                    next_stats = time.monotonic() + self.stats_interval
+                self._check_link()
 
         except KeyboardInterrupt:
-            print("Caught keyboard interrupt, exiting")
+            logger.info("Caught keyboard interrupt, exiting")
         finally:
             self.sel.close()
 
+liblog.configure()
 transmission = RelayThread()
 transmission.begin_thread()
 transmission.set_horizontal_motors(1.0, 1.0, 1.0, 1.0)
\ No newline at end of file
@@ -0,0 +1,66 @@
+class RecvBuffer:
+    """Receive buffer backed by one preallocated bytearray.
+
+    Data is read straight into the free tail of the buffer with recv_into and
+    parsed frames are consumed by moving a start offset, so nothing is copied
+    when a frame is taken off the front. The unread bytes are only moved back
+    to the front (or into a bigger buffer) when the tail runs out of room.
+
+    Views returned by peek() and consume() point into the buffer and are only
+    valid until the next recv_into() or feed().
+    """
+
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def recv_into(self, sock, nbytes=4096):
+        """Read up to nbytes from the socket, returns 0 when the peer closed."""
+        self._reserve(nbytes)
+        received = sock.recv_into(self._view[self._end:self._end + nbytes])
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Append bytes that were received some other way."""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def peek(self, nbytes):
+        return self._view[self._start:self._start + nbytes]
+
+    def consume(self, nbytes):
+        """Take nbytes off the front and return them as a view."""
+        data = self._view[self._start:self._start + nbytes]
+        self._start += nbytes
+        if self._start == self._end:
+            # Everything has been read, start over at the front for free
+            self._start = self._end = 0
+        return data
+
+    def unpack_from(self, fmt, offset=0):
+        """Unpack a struct.Struct from the unread bytes without consuming them."""
+        return fmt.unpack_from(self._buf, self._start + offset)
+
+    def _reserve(self, nbytes):
+        if len(self._buf) - self._end >= nbytes:
+            return
+        pending = self._end - self._start
+        if pending + nbytes <= len(self._buf):
+            # Compact, only the unread bytes are copied
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            # Grow into a new buffer, the old one may still be exported by a view
+            size = max(2 * len(self._buf), pending + nbytes)
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
@@ -0,0 +1,223 @@
+import collections
+import json
+import logging
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Both peers put this in the "channels" header of their first frame, channel
+# frames only go out once the other side has confirmed it
+CHANNELS = "rov-channels/1"
+CHANNEL_CONTENT_TYPE = "application/x-rov-channel"
+
+# channel id, flags, in front of every fragment of a channel message
+CHANNEL_HEADER = struct.Struct(">BB")
+# More fragments of the same message follow on this channel
+FLAG_MORE = 0x01
+
+# Bytes of a message per frame, a control frame waits for at most one of these
+MAX_FRAGMENT = 1024
+# Bytes of channel messages queued behind each control frame, channel data is
+# clocked by the control exchange and never piles up in the socket buffers
+DEFAULT_FRAME_BUDGET = 4 * MAX_FRAGMENT
+
+Codec = collections.namedtuple("Codec", ["encode", "decode"])
+
+JSON_CODEC = Codec(
+    lambda obj: json.dumps(obj, ensure_ascii=False).encode("utf-8"),
+    lambda data: json.loads(str(data, "utf-8")),
+)
+RAW_CODEC = Codec(bytes, bytes)
+
+
+class Channel:
+    """One stream of messages next to the robot state, see ChannelRouter.register."""
+
+    def __init__(self, name, channel_id, priority, codec, on_receive, queue_limit):
+        self.name = name
+        self.channel_id = channel_id
+        self.priority = priority
+        self.codec = codec
+        self.on_receive = on_receive
+        self.queue_limit = queue_limit
+        # Messages, not frames. Dropped ones were pushed out of a full queue
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def deliver(self, data):
+        self.received += 1
+        if self.on_receive is None:
+            return
+        try:
+            self.on_receive(self.codec.decode(data))
+        except Exception:
+            # One broken receiver must not take the relay loop down
+            logger.error("Receiver of channel %r failed", self.name, exc_info=True)
+
+
+class ChannelLink:
+    """The channels of one connection: queued messages and half received ones."""
+
+    def __init__(self, router):
+        self.router = router
+        # channel id -> deque of encoded messages, the first one may be half sent
+        self._queues = {}
+        # channel id -> bytes of the first queued message already sent
+        self._offsets = {}
+        # channel id -> fragments of the message being received
+        self._partial = {}
+
+    def _queue(self, channel):
+        queue = self._queues.get(channel.channel_id)
+        if queue is None:
+            queue = self._queues[channel.channel_id] = collections.deque()
+        return queue
+
+    def _push(self, channel, data):
+        # Called with the router lock held
+        queue = self._queue(channel)
+        if channel.queue_limit and len(queue) >= channel.queue_limit:
+            # Drop the oldest message nobody started sending yet
+            if self._offsets.get(channel.channel_id):
+                if len(queue) > 1:
+                    del queue[1]
+                    channel.dropped += 1
+                else:
+                    return
+            else:
+                queue.popleft()
+                channel.dropped += 1
+        queue.append(data)
+
+    def pending(self):
+        # send adds queues from the application's threads
+        with self.router.lock:
+            return any(self._queues.values())
+
+    def fill(self, queue_frame, budget):
+        """Hand fragments to queue_frame(channel_id, flags, chunk), highest priority first.
+
+        Stops once budget bytes went out, a message that doesn't fit
+        continues with the next call.
+        """
+        with self.router.lock:
+            for channel in self.router.by_priority:
+                queue = self._queues.get(channel.channel_id)
+                while queue and budget > 0:
+                    data = queue[0]
+                    offset = self._offsets.get(channel.channel_id, 0)
+                    end = min(offset + MAX_FRAGMENT, len(data))
+                    if end < len(data):
+                        queue_frame(channel.channel_id, FLAG_MORE, data[offset:end])
+                        self._offsets[channel.channel_id] = end
+                    else:
+                        queue_frame(channel.channel_id, 0, data[offset:end])
+                        queue.popleft()
+                        self._offsets.pop(channel.channel_id, None)
+                        channel.sent += 1
+                    budget -= end - offset
+                if budget <= 0:
+                    return
+
+    def receive(self, content):
+        """Take one channel frame, delivers the message once its last fragment is in."""
+        if len(content) < CHANNEL_HEADER.size:
+            raise ValueError(f"Channel frame of {len(content)} bytes is too short.")
+        channel_id, flags = CHANNEL_HEADER.unpack_from(content)
+        chunk = content[CHANNEL_HEADER.size:]
+        partial = self._partial.get(channel_id)
+        if flags & FLAG_MORE:
+            if partial is None:
+                partial = self._partial[channel_id] = bytearray()
+            partial += chunk
+            return
+        if partial is not None:
+            partial += chunk
+            chunk = self._partial.pop(channel_id)
+        channel = self.router.channels_by_id.get(channel_id)
+        if channel is None:
+            logger.warning("Dropping message on unknown channel %d", channel_id)
+            return
+        channel.deliver(chunk)
+
+    def close(self):
+        self.router.close_link(self)
+
+
+class ChannelRouter:
+    """Message channels multiplexed over the control connection.
+
+    Every channel has an id both sides agree on, a priority and a codec.
+    Messages are encoded by whoever sends them and split into fragments of
+    at most MAX_FRAGMENT bytes. Each control frame is followed by up to
+    frame_budget bytes of fragments, highest priority channel first, so a
+    big message only ever holds the next motor command back by that much.
+
+    send puts a message on every open link, the server has one per client.
+    Messages sent while no link is open wait for the next one, a link that
+    closes hands its unsent messages back when it was the only one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.channels_by_id = {}
+        self.by_priority = ()
+        self.frame_budget = DEFAULT_FRAME_BUDGET
+        self._links = ()
+        # Holds messages while no link is open
+        self._backlog = ChannelLink(self)
+
+    def register(self, name, channel_id, priority=0, codec=JSON_CODEC, on_receive=None, queue_limit=100):
+        """Add a channel, higher priorities go out first.
+
+        on_receive is called on the relay thread with every decoded
+        message. With queue_limit messages waiting, the oldest one is
+        dropped, 1 turns a channel into "latest value wins".
+        """
+        if not 0 <= channel_id <= 0xFF:
+            raise ValueError(f"Channel id {channel_id} does not fit in a byte.")
+        channel = Channel(name, channel_id, priority, codec, on_receive, queue_limit)
+        with self.lock:
+            if name in self.channels or channel_id in self.channels_by_id:
+                raise ValueError(f"Channel {name!r} or id {channel_id} is already registered.")
+            self.channels[name] = channel
+            self.channels_by_id[channel_id] = channel
+            self.by_priority = tuple(sorted(self.channels.values(), key=lambda c: -c.priority))
+        return channel
+
+    def send(self, name, obj):
+        channel = self.channels[name]
+        data = channel.codec.encode(obj)
+        with self.lock:
+            for link in self._links or (self._backlog,):
+                link._push(channel, data)
+
+    def open_link(self):
+        link = ChannelLink(self)
+        with self.lock:
+            if not self._links:
+                # Take over what was sent while nothing was connected
+                link._queues, self._backlog._queues = self._backlog._queues, {}
+            self._links += (link,)
+        return link
+
+    def close_link(self, link):
+        with self.lock:
+            if link not in self._links:
+                return
+            self._links = tuple(l for l in self._links if l is not link)
+            if not self._links:
+                # Half sent messages start over on the next connection
+                self._backlog._queues = link._queues
+            link._queues = {}
+            link._offsets.clear()
+            link._partial.clear()
+
+    def get_stats(self):
+        return {
+            name: {"sent": c.sent, "received": c.received, "dropped": c.dropped}
+            for name, c in self.channels.items()
+        }
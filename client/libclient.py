@@ -1,19 +1,70 @@
-import io
 import json
+import logging
 import selectors
 import struct
 import sys
+import time
+
+import libbuffer
+import libchannel
+import libcodec
+import libdatagram
+import libdelta
+import libframe
+import liblog
+import libmetrics
+
+logger = logging.getLogger(__name__)
+
+# Content types this side can decode, in order of preference
+SUPPORTED_CONTENT_TYPES = (libdelta.DELTA_CONTENT_TYPE, libcodec.ROV_STATE_CONTENT_TYPE, "text/json")
+
+
+class PeerClosedError(ConnectionError):
+    """The other side closed the connection, an ordinary way for it to end."""
 
 
 class Message:
-    def __init__(self, selector, sock, addr, request, default_robot_state, default_sensor_data):
+    def __init__(self, selector, sock, addr, request, default_robot_state, default_sensor_data, max_in_flight=1, paced=False, stats=None, channels=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self.request = request
-        self._recv_buffer = b""
-        self._send_buffer = b""
-        self._request_queued = False
+        self._recv_buffer = libbuffer.RecvBuffer()
+        self._send_buffer = bytearray()
+        # Switched on once both peers agreed on libframe.FRAMING, every later
+        # frame then has a fixed binary header packed into _frame_header
+        self.binary_framing = False
+        self._frame_header = bytearray(libframe.FRAME_HEADER.size)
+        self._frame_log = liblog.SampledLogger(logger)
+        # RelayThread passes its own so the counters outlive reconnects
+        self.stats = stats if stats is not None else libmetrics.LinkStats()
+        # Requests the server has not answered yet, 1 is plain ping-pong and
+        # anything higher pipelines requests without waiting a round trip
+        self.max_in_flight = max_in_flight
+        # Paced messages only send when RelayThread calls send_request on its
+        # control tick, otherwise a new request goes out whenever the window allows
+        self.paced = paced
+        self.seq = 0
+        self._in_flight = 0
+        # Newest response "seq" from the server, acked back for delta sync
+        self._last_response_seq = None
+        self._delta_encoder = libdelta.DeltaEncoder()
+        self._delta_decoder = libdelta.DeltaDecoder()
+        # Set when a delta frame's base was missing, asks the server for a keyframe
+        self._keyframe_wanted = False
+        # RelayThread registers new connections for read and write events
+        self._events_mode = "rw"
+        # Set once the server has answered the "accept" header of our first request
+        self._negotiated = False
+        # libchannel.ChannelLink of this connection, its frames only go out
+        # once the server confirmed it understands them
+        self.channels = channels
+        self.channels_enabled = False
+        # When the connection was started and the last frame arrived, RelayThread
+        # declares the link dead when nothing arrives for too long
+        self.connected_at = time.monotonic()
+        self.last_received = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
@@ -31,24 +82,27 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
+        if mode == self._events_mode:
+            # Already listening for these, skip the syscall
+            return
         self.selector.modify(self.sock, events, data=self)
+        self._events_mode = mode
 
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096) # type: ignore
+            received = self._recv_buffer.recv_into(self.sock, 4096)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            if not received:
+                raise PeerClosedError("Peer closed.")
+            self.stats.bytes_received += received
 
     def _write(self):
         if self._send_buffer:
-            print(f"Sending {self._send_buffer!r} to {self.addr}")
+            self._frame_log.log("Sending %r to %s", self._send_buffer, self.addr)
             try:
                 # Should be ready to write
                 sent = self.sock.send(self._send_buffer) # type: ignore
@@ -56,21 +110,17 @@ class Message:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                del self._send_buffer[:sent]
+                self.stats.bytes_sent += sent
 
     def _json_encode(self, obj, encoding):
         return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        return json.loads(str(json_bytes, encoding))
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, headers=None
     ):
         jsonheader = {
             "byteorder": sys.byteorder,
@@ -78,11 +128,42 @@ class Message:
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        if headers:
+            jsonheader.update(headers)
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
         message = message_hdr + jsonheader_bytes + content_bytes
         return message
 
+    def _queue_message(
+        self, *, content_bytes, content_type, content_encoding, headers
+    ):
+        if self.binary_framing:
+            libframe.pack_header_into(
+                self._frame_header, 0, content_type, len(content_bytes), headers
+            )
+            self._send_buffer += self._frame_header
+            self._send_buffer += content_bytes
+        else:
+            self._send_buffer += self._create_message(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                headers=headers,
+            )
+
+    def _queue_channel_frame(self, channel_id, flags, chunk):
+        libframe.pack_header_into(
+            self._frame_header, 0, libchannel.CHANNEL_CONTENT_TYPE,
+            libchannel.CHANNEL_HEADER.size + len(chunk), {"seq": 0},
+        )
+        self._send_buffer += self._frame_header
+        self._send_buffer += libchannel.CHANNEL_HEADER.pack(channel_id, flags)
+        self._send_buffer += chunk
+
+    def has_channel_data(self):
+        return self.channels_enabled and self.channels.pending()
+
     def process_events(self, mask, robot_state):
         self.robot_state = robot_state
         
@@ -95,79 +176,179 @@ class Message:
 
     def read(self):
         self._read()
+        self.process_received()
+
+    def receive(self, data):
+        """Handle bytes that arrived some other way than through our socket, e.g. asyncio."""
+        self._recv_buffer.feed(data)
+        self.stats.bytes_received += len(data)
+        self.process_received()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+    def process_received(self):
+        try:
+            self._process_frames()
+        except ValueError:
+            # Garbled header or content, RelayThread drops the connection
+            self.stats.decode_errors += 1
+            raise
+
+    def _process_frames(self):
+        # Drain every complete frame, only the newest sensor data is decoded
+        latest = None
+        while True:
+            if self.binary_framing:
+                if self.jsonheader is None:
+                    self.process_frameheader()
+            else:
+                if self._jsonheader_len is None:
+                    self.process_protoheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+                if self._jsonheader_len is not None:
+                    if self.jsonheader is None:
+                        self.process_jsonheader()
 
-        if self.jsonheader:
-            if self.response is None:
-                self.process_response()
+            if not self.jsonheader:
+                break
+            if self.jsonheader["content-type"] == libchannel.CHANNEL_CONTENT_TYPE:
+                if not self.take_channel_frame():
+                    break
+                continue
+            frame = self.take_response()
+            if frame is None:
+                break
+            latest = frame
+
+        if latest is not None:
+            self.last_received = time.monotonic()
+            self.process_response(*latest)
+
+    def _window(self):
+        # Only one request goes out until the server has answered the first
+        return self.max_in_flight if self._negotiated else 1
+
+    def can_send(self):
+        """True when the previous request is on the wire and the window has room."""
+        return not self._send_buffer and self._in_flight < self._window()
+
+    def send_request(self):
+        """Queue the current robot state and start sending it straight away."""
+        self.request["content"] = self.robot_state
+        self.queue_request()
+        self._write()
+        if self._send_buffer:
+            self._set_selector_events_mask("rw")
 
     def write(self):
-        if not self._request_queued:
+        # Only queue the latest state once the previous request is on the wire
+        if not self.paced and self.can_send():
+            self.request["content"] = self.robot_state
             self.queue_request()
 
-        self.request["content"] = self.robot_state
         self._write()
 
-        if self._request_queued:
-            if not self._send_buffer:
-                # Set selector to listen for read events, we're done writing.
-                self._set_selector_events_mask("r")
+        if not self._send_buffer and (self.paced or self._in_flight >= self._window()):
+            # Set selector to listen for read events, we're done writing.
+            self._set_selector_events_mask("r")
 
     def close(self):
-        print(f"Closing connection to {self.addr}")
+        logger.info("Closing connection to %s", self.addr)
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
-            print(
-                f"Error: selector.unregister() exception for "
-                f"{self.addr}: {e!r}"
-            )
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close() # type: ignore
         except OSError as e:
-            print(f"Error: socket.close() exception for {self.addr}: {e!r}")
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+            if self.channels is not None:
+                self.channels.close()
 
     def queue_request(self):
         content = self.request["content"]
         content_type = self.request["type"]
         content_encoding = self.request["encoding"]
-        if content_type == "text/json":
+        self.seq += 1
+        if content_type == libdelta.DELTA_CONTENT_TYPE:
+            frame = self._delta_encoder.encode(content, self.seq)
             req = {
-                "content_bytes": self._json_encode(content, content_encoding),
+                "content_bytes": self._json_encode(frame, content_encoding),
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
+        elif (
+            content_type == libcodec.ROV_STATE_CONTENT_TYPE
+            and libcodec.fits_robot_state(content)
+        ):
+            req = {
+                "content_bytes": libcodec.pack_robot_state(content),
+                "content_type": content_type,
+                "content_encoding": "binary",
+            }
+        elif content_type in SUPPORTED_CONTENT_TYPES:
+            # robot state the binary layout can't hold always goes out as json
+            req = {
+                "content_bytes": self._json_encode(content, content_encoding),
+                "content_type": "text/json",
+                "content_encoding": content_encoding,
+            }
         else:
             raise ValueError(f"Unsupported request type: {content_type!r}")
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        # The server echoes the send time back, that is our round trip sample
+        req["headers"] = {"seq": self.seq, "ts": time.monotonic()}
+        if self._last_response_seq is not None:
+            req["headers"]["ack"] = self._last_response_seq
+        if self._keyframe_wanted:
+            req["headers"]["keyframe"] = True
+            self._keyframe_wanted = False
+        if not self._negotiated:
+            if "accept" in self.request:
+                req["headers"]["accept"] = list(self.request["accept"])
+            req["headers"]["framing"] = [libframe.FRAMING]
+            if self.channels is not None:
+                req["headers"]["channels"] = libchannel.CHANNELS
+        self._queue_message(**req)
+        self._in_flight += 1
+        self.stats.frames_sent += 1
+        # Channel messages only ever go out behind a control frame
+        if self.channels_enabled:
+            self.channels.fill(self._queue_channel_frame, self.channels.router.frame_budget)
+
+    def _negotiate_content_type(self, jsonheader):
+        # The server answers our first request in the type it picked from our
+        # "accept" list, an older server just keeps answering in text/json
+        self._negotiated = True
+        content_type = jsonheader["content-type"]
+        if content_type in self.request.get("accept", ()):
+            self.request["type"] = content_type
+        if "ack" not in jsonheader:
+            # An older server handles one request per round trip, don't pipeline
+            self.max_in_flight = 1
 
     def process_protoheader(self):
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
             self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
+                ">H", self._recv_buffer.consume(hdrlen)
             )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+
+    def process_frameheader(self):
+        hdrlen = libframe.FRAME_HEADER.size
+        if len(self._recv_buffer) >= hdrlen:
+            fields = self._recv_buffer.unpack_from(libframe.FRAME_HEADER)
+            self._recv_buffer.consume(hdrlen)
+            # Same shape as a json header so the rest of the parsing doesn't care
+            self.jsonheader = libframe.header_from_fields(*fields)
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen: # type: ignore
             self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
+                self._recv_buffer.consume(hdrlen), "utf-8" # type: ignore
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -177,26 +358,181 @@ class Message:
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
 
-    def process_response(self):
+    def take_channel_frame(self):
+        """Hand the current channel frame to our ChannelLink, False until it is complete."""
         content_len = self.jsonheader["content-length"] # type: ignore
         if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+            return False
+        if not self.channels_enabled:
+            raise ValueError("Channel frame before channels were confirmed.")
+        # Decoded or copied by receive before the next read
+        self.channels.receive(self._recv_buffer.consume(content_len))
+        self._jsonheader_len = None
+        self.jsonheader = None
+        return True
+
+    def take_response(self):
+        """Take the content of the current frame off the receive buffer without decoding it."""
+        content_len = self.jsonheader["content-length"] # type: ignore
+        if not len(self._recv_buffer) >= content_len:
+            return None
+        jsonheader = self.jsonheader
+        if jsonheader["content-type"] not in SUPPORTED_CONTENT_TYPES: # type: ignore
+            raise ValueError(f"Bad content type header.")
+        # A view into the receive buffer, decode it before the next read
+        data = self._recv_buffer.consume(content_len)
+        self.stats.frames_received += 1
+        if "echo" in jsonheader: # type: ignore
+            self.stats.rtt.record(time.monotonic() - jsonheader["echo"]) # type: ignore
+        
+        # The server acks the newest request it drained, an older one
+        # answers each request on its own
+        if "ack" in jsonheader: # type: ignore
+            self._in_flight = self.seq - jsonheader["ack"] # type: ignore
+        else:
+            self._in_flight = max(self._in_flight - 1, 0)
+            
+        if "seq" in jsonheader: # type: ignore
+            self._last_response_seq = jsonheader["seq"] # type: ignore
+        if "ack" in jsonheader: # type: ignore
+            self._delta_encoder.ack(jsonheader["ack"]) # type: ignore
+        if jsonheader.get("keyframe"): # type: ignore
+            # After the ack, which covers frames the server could not apply
+            self._delta_encoder.request_keyframe()
+        if jsonheader.get("framing") == libframe.FRAMING: # type: ignore
+            # The server confirmed, whatever it sends next has a binary header
+            self.binary_framing = True
+        if jsonheader.get("channels") == libchannel.CHANNELS and self.channels is not None: # type: ignore
+            self.channels_enabled = True
         
-        if self.jsonheader["content-type"] == "text/json": # type: ignore
-            encoding = self.jsonheader["content-encoding"] # type: ignore
+        # reset state to read the next message
+        self._jsonheader_len = None
+        self.jsonheader = None
+        return jsonheader, data
+
+    def process_response(self, jsonheader, data):
+        if jsonheader["content-type"] == "text/json":
+            encoding = jsonheader["content-encoding"]
             self.response = self._json_decode(data, encoding)
             
             self.sensor_data = dict(self.response)
+        elif jsonheader["content-type"] == libcodec.ROV_STATE_CONTENT_TYPE:
+            self.response = libcodec.unpack(data)
+            
+            self.sensor_data = dict(self.response)
+        elif jsonheader["content-type"] == libdelta.DELTA_CONTENT_TYPE:
+            encoding = jsonheader["content-encoding"]
+            self.response = self._delta_decoder.decode(self._json_decode(data, encoding))
+            
+            # Keep the old data until a keyframe arrives, the server only
+            # sends one early when asked to
+            if self.response is not None:
+                self.sensor_data = dict(self.response)
+            else:
+                self._keyframe_wanted = True
         else:
             raise ValueError(f"Bad content type header.")
         
-        # reset state to read the next message
-        self._request_queued = False
-        self._jsonheader_len = None
-        self.jsonheader = None
+        if not self._negotiated:
+            self._negotiate_content_type(jsonheader)
         self.response = None
         
-        self._set_selector_events_mask("w")  # Switch to write mode to send the response        
+        if not self.paced:
+            self._set_selector_events_mask("rw")  # Switch to write mode to send the next request
+
+
+class DatagramMessage:
+    """UDP counterpart of Message, every robot state goes out as one datagram.
+
+    There is no stream to fall behind on: datagrams that get lost are simply
+    superseded by the next one, and sensor data that arrives out of order or
+    late is dropped instead of being applied over newer values.
+    """
+
+    def __init__(self, selector, sock, addr, request, default_robot_state, default_sensor_data, max_age=libdatagram.DEFAULT_MAX_AGE, stats=None):
+        self.selector = selector
+        self.sock = sock
+        self.addr = addr
+        self.request = request
+        self.session = libdatagram.new_session()
+        self.seq = 0
+        self.filter = libdatagram.SequenceFilter(max_age)
+        # Datagrams the socket refused to take, the next tick sends newer state anyway
+        self.send_dropped = 0
+        # Datagrams carry no echo, so there are no round trip samples over udp
+        self.stats = stats if stats is not None else libmetrics.LinkStats()
+        self.connected_at = time.monotonic()
+        self.last_received = None
+        
+        self.sensor_data = default_sensor_data
+        self.robot_state = default_robot_state
 
+    def process_events(self, mask, robot_state):
+        self.robot_state = robot_state
+        
+        if mask & selectors.EVENT_READ:
+            self.read()
+        
+        return self.sensor_data
+
+    def read(self):
+        # Drain every queued datagram, only the newest accepted one is decoded
+        latest = None
+        while True:
+            try:
+                data = self.sock.recv(libdatagram.MAX_DATAGRAM_SIZE) # type: ignore
+            except BlockingIOError:
+                break
+            except ConnectionRefusedError:
+                # Nobody listening yet, our next datagram will try again
+                break
+            self.stats.frames_received += 1
+            self.stats.bytes_received += len(data)
+            try:
+                session, seq, timestamp, content_type, content = libdatagram.unpack_datagram(data)
+            except ValueError as e:
+                self.stats.decode_errors += 1
+                logger.warning("Dropping datagram from %s: %r", self.addr, e)
+                continue
+            if self.filter.accept(session, seq, timestamp):
+                latest = (content_type, content)
+        
+        if latest is not None:
+            self.last_received = time.monotonic()
+            self.sensor_data = dict(libdatagram.decode_content(*latest))
+
+    def can_send(self):
+        return True
+
+    def has_channel_data(self):
+        # Channels need the stream, datagrams only carry the robot state
+        return False
+
+    def send_request(self):
+        self.seq += 1
+        datagram = libdatagram.pack_datagram(
+            self.session, self.seq, self.robot_state,
+            libcodec.fits_robot_state, libcodec.pack_robot_state,
+        )
+        try:
+            self.sock.send(datagram) # type: ignore
+        except (BlockingIOError, ConnectionRefusedError):
+            self.send_dropped += 1
+        else:
+            self.stats.frames_sent += 1
+            self.stats.bytes_sent += len(datagram)
+
+    def close(self):
+        logger.info("Closing connection to %s", self.addr)
+        try:
+            self.selector.unregister(self.sock)
+        except Exception as e:
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
+
+        try:
+            self.sock.close() # type: ignore
+        except OSError as e:
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
+        finally:
+            # Delete reference to socket object for garbage collection
+            self.sock = None
@@ -0,0 +1,86 @@
+import numbers
+import struct
+
+# Compact binary content type for robot_state and sensor_data frames.
+# Both peers advertise it in the "accept" header of their first frame and
+# fall back to "text/json" when the other side does not know it.
+ROV_STATE_CONTENT_TYPE = "application/x-rov-state"
+CODEC_VERSION = 1
+
+KIND_ROBOT_STATE = 1
+KIND_SENSOR_DATA = 2
+
+# Every frame starts with the codec version and the kind of frame it holds
+_PREFIX = struct.Struct(">BB")
+# horizontal_motors (fl, fr, br, bl), vertical_motors (front, back), enabled
+_ROBOT_STATE = struct.Struct(">BB4f2f?")
+# IMU (x, y, z)
+_SENSOR_DATA = struct.Struct(">BB3f")
+
+ROBOT_STATE_KEYS = frozenset(("horizontal_motors", "vertical_motors", "enabled"))
+SENSOR_DATA_KEYS = frozenset(("IMU",))
+
+
+def _numbers(values, count):
+    try:
+        return len(values) == count and all(isinstance(value, numbers.Real) for value in values)
+    except TypeError:
+        return False
+
+
+def fits_robot_state(state):
+    """Return True if the dict can be packed without losing any fields."""
+    return (
+        state.keys() == ROBOT_STATE_KEYS
+        and _numbers(state["horizontal_motors"], 4)
+        and _numbers(state["vertical_motors"], 2)
+        and isinstance(state["enabled"], numbers.Integral)
+    )
+
+
+def fits_sensor_data(data):
+    """Return True if the dict can be packed without losing any fields."""
+    return data.keys() == SENSOR_DATA_KEYS and _numbers(data["IMU"], 3)
+
+
+def pack_robot_state(state):
+    return _ROBOT_STATE.pack(
+        CODEC_VERSION,
+        KIND_ROBOT_STATE,
+        *state["horizontal_motors"],
+        *state["vertical_motors"],
+        state["enabled"],
+    )
+
+
+def pack_sensor_data(data):
+    return _SENSOR_DATA.pack(CODEC_VERSION, KIND_SENSOR_DATA, *data["IMU"])
+
+
+def _check_length(data, layout):
+    # struct.error would not count as a decode error and close the connection
+    if len(data) < layout.size:
+        raise ValueError(f"Truncated {ROV_STATE_CONTENT_TYPE} frame of {len(data)} bytes.")
+
+
+def unpack(data):
+    """Decode a packed frame back into the dict it was built from."""
+    if len(data) < _PREFIX.size:
+        raise ValueError(f"Truncated {ROV_STATE_CONTENT_TYPE} frame.")
+    version, kind = _PREFIX.unpack_from(data)
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unsupported {ROV_STATE_CONTENT_TYPE} version {version}.")
+
+    if kind == KIND_ROBOT_STATE:
+        _check_length(data, _ROBOT_STATE)
+        values = _ROBOT_STATE.unpack_from(data)
+        return {
+            "horizontal_motors": values[2:6],
+            "vertical_motors": values[6:8],
+            "enabled": values[8],
+        }
+    if kind == KIND_SENSOR_DATA:
+        _check_length(data, _SENSOR_DATA)
+        values = _SENSOR_DATA.unpack_from(data)
+        return {"IMU": values[2:5]}
+    raise ValueError(f"Unknown {ROV_STATE_CONTENT_TYPE} frame kind {kind}.")
@@ -0,0 +1,93 @@
+# Incremental sync content type, each frame only holds the fields that
+# changed since the last frame the peer acknowledged:
+#   {"seq": 12, "base": 9, "fields": {"vertical_motors": [0.2, 0.2]}}
+# A base of 0 marks a keyframe carrying every field.
+DELTA_CONTENT_TYPE = "application/x-rov-delta+json"
+
+# Frames between full keyframes, lets a peer that lost track resync
+KEYFRAME_INTERVAL = 50
+# Applied states a decoder keeps for later frames to build on, with acks lost
+# for longer than this the next frames wait for a keyframe
+MAX_APPLIED = 4 * KEYFRAME_INTERVAL
+
+_MISSING = object()
+
+
+class DeltaEncoder:
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        # Snapshots of every frame sent but not acknowledged yet, by seq
+        self._unacked = {}
+        self._acked_seq = 0
+        self._acked_state = None
+        self._since_keyframe = 0
+
+    def encode(self, state, seq):
+        """Build the frame for state, seq has to grow with every frame."""
+        snapshot = dict(state)
+        if self._acked_state is None or self._since_keyframe >= self.keyframe_interval:
+            frame = {"seq": seq, "base": 0, "fields": snapshot}
+            self._since_keyframe = 0
+        else:
+            # Relative to the acknowledged state rather than the previous frame,
+            # the peer applies it on top of that state no matter which ones it skipped
+            fields = {
+                key: value
+                for key, value in snapshot.items()
+                if self._acked_state.get(key, _MISSING) != value
+            }
+            frame = {"seq": seq, "base": self._acked_seq, "fields": fields}
+        self._since_keyframe += 1
+        self._unacked[seq] = snapshot
+        return frame
+
+    def ack(self, seq):
+        """The peer has applied every frame up to seq."""
+        snapshot = self._unacked.get(seq)
+        if snapshot is None or seq <= self._acked_seq:
+            return
+        self._acked_seq = seq
+        self._acked_state = snapshot
+        for sent in [sent for sent in self._unacked if sent <= seq]:
+            del self._unacked[sent]
+
+    def request_keyframe(self):
+        """The peer is missing a base, start over with keyframes until one is acked.
+
+        Acks for the frames sent so far are ignored, the peer may not have
+        applied them.
+        """
+        self._acked_state = None
+        self._unacked.clear()
+
+
+class DeltaDecoder:
+    def __init__(self):
+        self.state = None
+        self.seq = 0
+        # State after every frame applied that a later frame may still build on, by seq
+        self._applied = {}
+
+    def decode(self, frame):
+        """Apply a frame, returns the full state or None while waiting for a keyframe."""
+        base = frame["base"]
+        if base == 0:
+            state = dict(frame["fields"])
+        else:
+            base_state = self._applied.get(base)
+            if base_state is None:
+                # Missing the frame this one builds on, wait for the next keyframe
+                return None
+            # On top of the base, not of the last frame: a field that went back to
+            # its acknowledged value since then is left out of this one
+            state = dict(base_state)
+            state.update(frame["fields"])
+            # Bases only grow, nothing older is needed anymore
+            for seq in [seq for seq in self._applied if seq < base]:
+                del self._applied[seq]
+        self._applied[frame["seq"]] = state
+        if len(self._applied) > MAX_APPLIED:
+            del self._applied[min(self._applied)]
+        self.state = state
+        self.seq = frame["seq"]
+        return state
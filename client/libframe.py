@@ -0,0 +1,80 @@
+import struct
+
+import libchannel
+import libcodec
+import libdelta
+
+# Name both peers put in the "framing" header of their first frame. Once the
+# server has confirmed it, every later frame in either direction starts with
+# FRAME_HEADER instead of a json header, content type and encoding can't
+# change on a connection anymore so there is no need to repeat them.
+FRAMING = "rov-binary/1"
+
+# content length, content type id, flags, seq, ack, timestamp
+FRAME_HEADER = struct.Struct(">HBBIId")
+
+# The timestamp is the sender's "ts" in a request and the echoed "echo" in a
+# response, the flags say which of the optional fields are set
+FLAG_ACK = 0x01
+FLAG_TS = 0x02
+FLAG_ECHO = 0x04
+# The receiver could not apply a delta frame and wants a keyframe
+FLAG_KEYFRAME = 0x08
+
+CONTENT_TYPE_IDS = {
+    "text/json": 0,
+    libcodec.ROV_STATE_CONTENT_TYPE: 1,
+    libdelta.DELTA_CONTENT_TYPE: 2,
+    libchannel.CHANNEL_CONTENT_TYPE: 3,
+}
+CONTENT_TYPES = {type_id: content_type for content_type, type_id in CONTENT_TYPE_IDS.items()}
+CONTENT_ENCODINGS = {
+    "text/json": "utf-8",
+    libcodec.ROV_STATE_CONTENT_TYPE: "binary",
+    libdelta.DELTA_CONTENT_TYPE: "utf-8",
+    libchannel.CHANNEL_CONTENT_TYPE: "binary",
+}
+
+
+def pack_header_into(buffer, offset, content_type, content_length, headers):
+    """Write the frame header for content_type and the seq/ack/ts/echo headers into buffer."""
+    if content_length > 0xFFFF:
+        raise ValueError(f"Frame content of {content_length} bytes is too long.")
+    flags = 0
+    ack = headers.get("ack")
+    if ack is not None:
+        flags |= FLAG_ACK
+    timestamp = headers.get("ts")
+    if timestamp is not None:
+        flags |= FLAG_TS
+    elif headers.get("echo") is not None:
+        timestamp = headers["echo"]
+        flags |= FLAG_ECHO
+    if headers.get("keyframe"):
+        flags |= FLAG_KEYFRAME
+    FRAME_HEADER.pack_into(
+        buffer, offset, content_length, CONTENT_TYPE_IDS[content_type], flags,
+        headers["seq"], ack or 0, timestamp or 0.0,
+    )
+
+
+def header_from_fields(content_length, type_id, flags, seq, ack, timestamp):
+    """The same dict a json frame header would have been decoded into."""
+    content_type = CONTENT_TYPES.get(type_id)
+    if content_type is None:
+        raise ValueError(f"Unsupported frame content type id {type_id}.")
+    header = {
+        "content-type": content_type,
+        "content-encoding": CONTENT_ENCODINGS[content_type],
+        "content-length": content_length,
+        "seq": seq,
+    }
+    if flags & FLAG_ACK:
+        header["ack"] = ack
+    if flags & FLAG_TS:
+        header["ts"] = timestamp
+    elif flags & FLAG_ECHO:
+        header["echo"] = timestamp
+    if flags & FLAG_KEYFRAME:
+        header["keyframe"] = True
+    return header
@@ -0,0 +1,209 @@
+import collections
+import json
+import logging
+import mmap
+import struct
+import threading
+import time
+
+import libcodec
+
+logger = logging.getLogger(__name__)
+
+# Start of every log file, the number is the format version
+MAGIC = b"ROVLOG\x00\x01"
+# wall clock time, libcodec.KIND_*, payload encoding, payload length
+RECORD_HEADER = struct.Struct("<dBBH")
+
+# Payloads are libcodec frames, states the binary layout can't hold are json
+ENCODING_CODEC = 0
+ENCODING_JSON = 1
+
+# Seconds between batched writes, the most a crash can lose
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+
+def encode_record(timestamp, kind, state):
+    if kind == libcodec.KIND_ROBOT_STATE and libcodec.fits_robot_state(state):
+        encoding, payload = ENCODING_CODEC, libcodec.pack_robot_state(state)
+    elif kind == libcodec.KIND_SENSOR_DATA and libcodec.fits_sensor_data(state):
+        encoding, payload = ENCODING_CODEC, libcodec.pack_sensor_data(state)
+    else:
+        encoding, payload = ENCODING_JSON, json.dumps(state).encode("utf-8")
+    return RECORD_HEADER.pack(timestamp, kind, encoding, len(payload)) + payload
+
+
+def decode_payload(encoding, payload):
+    if encoding == ENCODING_CODEC:
+        return libcodec.unpack(payload)
+    if encoding == ENCODING_JSON:
+        return json.loads(str(payload, "utf-8"))
+    raise ValueError(f"Unknown record encoding {encoding}.")
+
+
+class Recorder:
+    """Append-only flight log of every state published on some StateCells.
+
+    Publishers only append the snapshot to a deque, encoding and writing
+    happen in batches on a thread of our own so recording never holds the
+    relay thread up. Every record is a RECORD_HEADER and its payload, a
+    crash loses at most the last flush_interval and leaves at worst one
+    truncated record at the end. Recording to the same path again cuts
+    that record off before appending, so LogReader never reads past it.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = 0
+        self._file = open(path, "ab")
+        size = self._file.tell()
+        if size == 0:
+            self._file.write(MAGIC)
+        else:
+            try:
+                end = complete_length(path)
+            except ValueError:
+                self._file.close()
+                raise
+            if end < size:
+                logger.warning("Cutting a truncated record of %d bytes off the end of %s", size - end, path)
+                self._file.truncate(end)
+        # deque appends are atomic, publishers never take a lock of ours
+        self._pending = collections.deque()
+        self._subscriptions = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="Recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, kind, state):
+        self._pending.append((time.time(), kind, state))
+
+    def attach(self, cell, kind):
+        """Record the current state of cell and every one published after it."""
+        subscription = cell.subscribe(lambda state: self.record(kind, state))
+        self.record(kind, cell.get().state)
+        self._subscriptions.append((cell, subscription))
+
+    def _write_pending(self):
+        batch = bytearray()
+        pending = self._pending
+        while pending:
+            batch += encode_record(*pending.popleft())
+            self.records += 1
+        if batch:
+            self._file.write(batch)
+            self._file.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self._write_pending()
+            except OSError:
+                logger.error("Writing %s failed, recording stopped", self.path, exc_info=True)
+                return
+
+    def close(self):
+        for cell, subscription in self._subscriptions:
+            cell.unsubscribe(subscription)
+        self._subscriptions.clear()
+        self._stop.set()
+        self._thread.join()
+        self._write_pending()
+        self._file.close()
+
+
+def complete_length(path):
+    """Bytes at the start of the log at path up to the end of its last complete record."""
+    reader = LogReader(path)
+    try:
+        end = len(MAGIC)
+        for offset, timestamp, kind, encoding, length in reader.records():
+            end = offset + length
+    finally:
+        reader.close()
+    return end
+
+
+class LogReader:
+    """Memory maps a log written by Recorder."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a telemetry log.")
+
+    def records(self):
+        """(offset, timestamp, kind, encoding, length) of every complete record, payload at offset."""
+        data = self._map
+        end = len(data)
+        offset = len(MAGIC)
+        unpack_from = RECORD_HEADER.unpack_from
+        size = RECORD_HEADER.size
+        while offset + size <= end:
+            timestamp, kind, encoding, length = unpack_from(data, offset)
+            offset += size
+            if offset + length > end:
+                # Cut short by a crash
+                break
+            yield offset, timestamp, kind, encoding, length
+            offset += length
+
+    def __iter__(self):
+        """(timestamp, kind, state) of every record."""
+        data = self._map
+        for offset, timestamp, kind, encoding, length in self.records():
+            yield timestamp, kind, decode_payload(encoding, data[offset:offset + length])
+
+    def close(self):
+        self._map.close()
+
+
+def load_arrays(path):
+    """The robot states and sensor data of a log as NumPy structured arrays.
+
+    Returns {"robot_state": array, "sensor_data": array}, with a "time"
+    field next to the libcodec fields. Only the header scan runs in Python,
+    the payloads are gathered and converted in one go. States stored as
+    json don't have a fixed layout and are left out.
+    """
+    import numpy as np
+
+    dtypes = {
+        libcodec.KIND_ROBOT_STATE: np.dtype([
+            ("version", "u1"), ("kind", "u1"), ("horizontal_motors", ">f4", 4),
+            ("vertical_motors", ">f4", 2), ("enabled", "?"),
+        ]),
+        libcodec.KIND_SENSOR_DATA: np.dtype([("version", "u1"), ("kind", "u1"), ("IMU", ">f4", 3)]),
+    }
+    reader = LogReader(path)
+    try:
+        offsets = {kind: [] for kind in dtypes}
+        times = {kind: [] for kind in dtypes}
+        for offset, timestamp, kind, encoding, length in reader.records():
+            if encoding == ENCODING_CODEC and kind in dtypes:
+                offsets[kind].append(offset)
+                times[kind].append(timestamp)
+        raw = np.frombuffer(reader._map, dtype=np.uint8)
+        arrays = {}
+        for kind, name in ((libcodec.KIND_ROBOT_STATE, "robot_state"), (libcodec.KIND_SENSOR_DATA, "sensor_data")):
+            dtype = dtypes[kind]
+            starts = np.asarray(offsets[kind], dtype=np.int64)
+            # Copy every payload out of the map, one row per record
+            rows = raw[starts[:, None] + np.arange(dtype.itemsize)]
+            packed = rows.view(dtype).reshape(-1)
+            fields = [("time", "<f8")] + [
+                (field, dtype.fields[field][0].base.newbyteorder("="), dtype.fields[field][0].shape)
+                for field in dtype.names[2:]
+            ]
+            array = np.empty(len(starts), dtype=fields)
+            array["time"] = times[kind]
+            for field in dtype.names[2:]:
+                array[field] = packed[field]
+            arrays[name] = array
+        del raw
+    finally:
+        reader.close()
+    return arrays
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+
+import liblog
+import libmetrics
+import libserver as libserver
+
+logger = logging.getLogger(__name__)
+
+
+class TransportSocket:
+    """Lets a Message write to an asyncio transport as if it was its socket.
+
+    The transport buffers whatever it can't send yet, so send always takes
+    everything and the Message never has to wait for write readiness.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def send(self, data):
+        self.transport.write(bytes(data))
+        return len(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class NoSelector:
+    """Readiness is asyncio's job, there is nothing to register or modify."""
+
+    def modify(self, sock, events, data=None):
+        pass
+
+    def unregister(self, sock):
+        pass
+
+
+class RelayProtocol(asyncio.Protocol):
+    def __init__(self, relay):
+        self.relay = relay
+        self.message = None
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info("peername")
+        logger.info("Accepted connection from %s", addr)
+        self.relay.stats.connections += 1
+        self.message = libserver.Message(
+            NoSelector(), TransportSocket(transport), addr,
+            self.relay.robot_state, self.relay.sensor_data, stats=self.relay.stats,
+        )
+
+    def data_received(self, data):
+        message = self.message
+        message.sensor_data = self.relay.sensor_data
+        previous = message.robot_state
+        try:
+            message.receive(data)
+        except Exception:
+            logger.error("Exception for %s", message.addr, exc_info=True)
+            message.close()
+            return
+        if message.robot_state is not previous:
+            self.relay._publish_robot_state(message.robot_state)
+
+    def connection_lost(self, exc):
+        logger.info("Closing connection to %s", self.message.addr)
+
+
+class AsyncRelay:
+    """asyncio version of RelayThread.
+
+    Keeps the same set_/get_ methods, adds awaitable ones for code that is
+    already async, and serves any number of clients from one event loop, so
+    it can share that loop with other sockets and timers. begin_thread runs
+    it on a loop of its own for code that isn't. set_IMU_data may be called
+    from any thread, it publishes a new sensor_data dict instead of changing
+    the one the loop is sending.
+    """
+
+    def __init__(self, host='localhost', port=65432):
+        self.sensor_data = {"IMU": (0.0, 0.0, 0.0)}
+        self.robot_state = {"horizontal_motors": (0, 0, 0, 0), "vertical_motors": (0, 0), "enabled": False}
+
+        self.host = host
+        self.port = port
+        self._server = None
+        self._waiters = []
+        self.stats = libmetrics.LinkStats()
+        # Setters on different threads would otherwise lose each other's fields
+        self._state_lock = threading.Lock()
+
+    def set_IMU_data(self, x : float, y : float, z : float):
+        with self._state_lock:
+            self.sensor_data = {**self.sensor_data, "IMU": (x, y, z)}
+
+    def get_horizontal_motors(self):
+        return self.robot_state["horizontal_motors"]
+
+    def get_vertical_motors(self):
+        return self.robot_state["vertical_motors"]
+
+    def get_enabled(self):
+        return self.robot_state["enabled"]
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    async def next_robot_state(self):
+        """Wait for the next robot state from any client."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return await waiter
+
+    def _publish_robot_state(self, robot_state):
+        self.robot_state = dict(robot_state)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(self.robot_state)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: RelayProtocol(self), self.host, self.port, reuse_address=True
+        )
+        logger.info("Listening on %s", (self.host, self.port))
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever() # type: ignore
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def begin_thread(self):
+        # Must not keep the program alive once the code that started it is done
+        thread = threading.Thread(target=asyncio.run, args=(self.serve_forever(),), daemon=True)
+        thread.start()
+
+
+if __name__ == "__main__":
+    liblog.configure()
+    asyncio.run(AsyncRelay().serve_forever())
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
 
+import logging
 import selectors
 import socket
 import threading
-import traceback
+import time
 
+import libchannel
+import libcodec
+import libdatagram
+import liblog
+import libmetrics
+import librecord
+import libshm
+import libstate
+import libtcp
 import libserver as libserver
 
+logger = logging.getLogger(__name__)
+
 
 class RelayThread:
     _instance = None
@@ -22,14 +34,55 @@ class RelayThread:
     
     def _start(self):
         self.sel = selectors.DefaultSelector()
-        self.sensor_data = {"IMU": (0.0, 0.0, 0.0)}
-        self.robot_state = {"horizontal_motors": (0, 0, 0, 0), "vertical_motors": (0, 0), "enabled": False}
+        # set_IMU_data publishes a new sensor data version, the network thread
+        # publishes every robot state a client sends
+        self._sensor_data = libstate.StateCell({"IMU": (0.0, 0.0, 0.0)})
+        self._robot_state = libstate.StateCell({"horizontal_motors": (0, 0, 0, 0), "vertical_motors": (0, 0), "enabled": False})
         
         self.host = 'localhost'
         self.port = 65432
+        # "tcp" or "udp", with udp every state frame is a datagram of its own and
+        # late or out of order frames are dropped instead of delivered after newer ones
+        self.transport = "tcp"
+        self.udp_max_age = libdatagram.DEFAULT_MAX_AGE
+        # Seconds between link stats lines in the log, None never logs them
+        self.stats_interval = None
+        # Seconds without a frame from any client before the link counts as lost,
+        # silent connections are closed and the robot state is set to
+        # failsafe_state, motors stopped and disarmed for drivers that check
+        # get_enabled. None leaves it all to the kernel
+        self.link_timeout = 0.3
+        self.failsafe_state = {"horizontal_motors": (0, 0, 0, 0), "vertical_motors": (0, 0), "enabled": False}
+        # Called on the relay thread after the failsafe state was published
+        self.on_link_lost = None
+        self._link_up = False
+        # Message channels next to the sensor data, send_channel goes to every client
+        self.channels = libchannel.ChannelRouter()
+        self._recorder = None
+        # Segment other processes on this machine read and write the states in
+        self._shared = None
+        self._shared_subscription = None
+        self._shared_sensor_version = 0
+        # Link counters shared by every connection, the round trip times are
+        # measured on the client
+        self.stats = libmetrics.LinkStats()
+        self._stats_logged = None
+        self._frame_log = liblog.SampledLogger(logger)
+    
+    @property
+    def robot_state(self):
+        return self._robot_state.get().state
+    
+    @property
+    def sensor_data(self):
+        return self._sensor_data.get().state
     
     def set_IMU_data(self, x : float, y : float, z : float):
-        self.sensor_data["IMU"] = (x, y, z)
+        return self._sensor_data.update(IMU=(x, y, z))
+    
+    def set_sensor_data(self, **fields):
+        """Publish new values for any sensor data fields, e.g. when replaying a log."""
+        return self._sensor_data.update(**fields)
         
     def get_horizontal_motors(self):
         return self.robot_state["horizontal_motors"]
@@ -39,6 +92,97 @@ class RelayThread:
     
     def get_enabled(self):
         return self.robot_state["enabled"]
+    
+    def get_robot_snapshot(self):
+        """Newest robot state with its version, every field from the same frame."""
+        return self._robot_state.get()
+    
+    def wait_for_robot_state(self, version, timeout=None):
+        """Block until a robot state newer than version arrives, None on timeout."""
+        return self._robot_state.wait_newer(version, timeout)
+    
+    def subscribe(self, callback, field=None, threshold=None, executor=None):
+        """Call callback on the relay thread as soon as a new robot state is decoded.
+
+        It gets the whole robot state, or with a field like "horizontal_motors"
+        only that field and only when it moved by more than threshold.
+        Callbacks that take a while should pass an executor to keep the link running.
+        """
+        return self._robot_state.subscribe(callback, field, threshold, executor)
+    
+    def unsubscribe(self, subscription):
+        self._robot_state.unsubscribe(subscription)
+
+    def start_recording(self, path):
+        """Append every robot state received and all sensor data set to a log at path."""
+        self.stop_recording()
+        recorder = librecord.Recorder(path)
+        recorder.attach(self._robot_state, libcodec.KIND_ROBOT_STATE)
+        recorder.attach(self._sensor_data, libcodec.KIND_SENSOR_DATA)
+        self._recorder = recorder
+    
+    def stop_recording(self):
+        """Write out what is still buffered and close the log."""
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+    
+    def share_state(self, name=libshm.DEFAULT_NAME):
+        """Mirror the states into shared memory for processes on this machine.
+
+        Every robot state is written to the segment's robot_state, a motor
+        driver attaches with libshm.SharedState(name) and reads it without
+        sockets. Sensor data a process publishes in the segment's
+        sensor_data becomes the relay's, next time it answers a client.
+        """
+        self.stop_sharing()
+        shared = libshm.SharedState(name, create=True)
+        shared.robot_state.publish(self.robot_state)
+        self._shared_sensor_version = shared.sensor_data.version
+        self._shared_subscription = self._robot_state.subscribe(shared.robot_state.publish)
+        self._shared = shared
+        logger.info("Sharing the robot state in %s", name)
+
+    def stop_sharing(self):
+        """Stop mirroring the states and remove the segment."""
+        if self._shared is not None:
+            self._robot_state.unsubscribe(self._shared_subscription)
+            self._shared.close()
+            self._shared = self._shared_subscription = None
+
+    def _poll_shared(self):
+        shared = self._shared
+        if shared is None or shared.sensor_data.version == self._shared_sensor_version:
+            return
+        snapshot = shared.sensor_data.get()
+        self._shared_sensor_version = snapshot.version
+        self._sensor_data.publish(snapshot.state)
+
+    def register_channel(self, name, channel_id, priority=0, codec=libchannel.JSON_CODEC, on_receive=None, queue_limit=100):
+        """Add a message channel, clients have to register the same name and id.
+
+        Higher priorities go out first, the sensor data always goes ahead of
+        every channel. on_receive is called on the relay thread with each
+        decoded message. queue_limit=1 keeps only the newest unsent message.
+        """
+        return self.channels.register(name, channel_id, priority, codec, on_receive, queue_limit)
+    
+    def send_channel(self, name, obj):
+        """Queue obj on a channel for every client, it goes out behind their next sensor data frame."""
+        self.channels.send(name, obj)
+    
+    def get_channel_stats(self):
+        """Messages sent, received and dropped per channel."""
+        return self.channels.get_stats()
+
+    def get_stats(self):
+        """Snapshot of the link counters."""
+        return self.stats.snapshot()
+    
+    def _log_stats(self):
+        stats = self.get_stats()
+        logger.info("Link stats: %s", libmetrics.format_stats(stats, self._stats_logged))
+        self._stats_logged = stats
 
     def begin_thread(self):
         thread = threading.Thread(target=self.run_server_socket)
@@ -46,41 +190,117 @@ class RelayThread:
 
     def accept_wrapper(self, sock):
         conn, addr = sock.accept()  # Should be ready to read
-        print(f"Accepted connection from {addr}")
+        logger.info("Accepted connection from %s", addr)
+        libtcp.tune_socket(conn)
         conn.setblocking(False)
-        message = libserver.Message(self.sel, conn, addr, self.robot_state, self.sensor_data)
+        self.stats.connections += 1
+        message = libserver.Message(
+            self.sel, conn, addr, self.robot_state, self.sensor_data, stats=self.stats,
+            channels=self.channels.open_link(),
+        )
         self.sel.register(conn, selectors.EVENT_READ, data=message)
     
+    def _listen_datagram(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        logger.info("Listening for datagrams on %s", (self.host, self.port))
+        sock.setblocking(False)
+        message = libserver.DatagramMessage(
+            self.sel, sock, self.robot_state, self.sensor_data, max_age=self.udp_max_age,
+            stats=self.stats,
+        )
+        self.sel.register(sock, selectors.EVENT_READ, data=message)
+    
+    def _check_links(self):
+        """Close silent connections and fail safe once no client is heard from anymore."""
+        now = time.monotonic()
+        alive = False
+        for key in list(self.sel.get_map().values()):
+            message = key.data
+            if message is None:
+                continue
+            if message.last_received is not None and now - message.last_received <= self.link_timeout:
+                alive = True
+            elif isinstance(message, libserver.Message):
+                silent = now - (message.last_received or message.connected_at)
+                if silent > self.link_timeout:
+                    logger.warning("Nothing from %s for %.0f ms, closing", message.addr, silent * 1000)
+                    message.close()
+        if alive:
+            self._link_up = True
+        elif self._link_up:
+            self._link_up = False
+            self._link_lost()
+    
+    def _link_lost(self):
+        logger.warning("Link lost, robot state set to %s", self.failsafe_state)
+        self._robot_state.update(**self.failsafe_state)
+        if self.on_link_lost is not None:
+            try:
+                self.on_link_lost()
+            except Exception:
+                logger.error("Link lost hook failed", exc_info=True)
+
     def run_server_socket(self):
-        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind((self.host, self.port))
-        lsock.listen()
-        print(f"Listening on {(self.host, self.port)}")
-        lsock.setblocking(False)
-        self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        if self.transport == "udp":
+            self._listen_datagram()
+        else:
+            lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            lsock.bind((self.host, self.port))
+            lsock.listen()
+            logger.info("Listening on %s", (self.host, self.port))
+            lsock.setblocking(False)
+            self.sel.register(lsock, selectors.EVENT_READ, data=None)
         
         try:
+            next_stats = time.monotonic() + (self.stats_interval or 0)
+            next_check = time.monotonic()
             while True:
-                events = self.sel.select(timeout=None)
+                timeout = None
+                if self.stats_interval:
+                    timeout = max(next_stats - time.monotonic(), 0)
+                if self.link_timeout:
+                    check_timeout = max(next_check - time.monotonic(), 0)
+                    timeout = check_timeout if timeout is None else min(timeout, check_timeout)
+                events = self.sel.select(timeout=timeout)
+                # Clients get the sensor data in answers, new shared values only matter from here on
+                self._poll_shared()
                 for key, mask in events:
                     if key.data is None:
                         self.accept_wrapper(key.fileobj)
                     else:
                         message = key.data
+                        previous = message.robot_state
                         try:
                             message.process_events(mask, self.sensor_data)
-                            print(f"Received: {message.robot_state}")
+                            self._frame_log.log("Received: %s", message.robot_state)
+                        except libserver.PeerClosedError:
+                            logger.info("%s closed the connection", message.addr)
+                            message.close()
+                        except ConnectionError as e:
+                            logger.warning("Connection to %s failed: %s", message.addr, e)
+                            message.close()
                         except Exception:
-                            print(
-                                f"Main: Error: Exception for {message.addr}:\n"
-                                f"{traceback.format_exc()}"
-                            )
+                            logger.error("Exception for %s", message.addr, exc_info=True)
                             message.close()
+                        # Messages replace their robot state instead of changing it, and
+                        # waiters only wake up for a state that actually changed
+                        if message.robot_state is not previous and message.robot_state != self.robot_state:
+                            self._robot_state.publish(message.robot_state)
+                if self.link_timeout and time.monotonic() >= next_check:
+                    self._check_links()
+                    next_check = time.monotonic() + self.link_timeout / 4
+                if self.stats_interval and time.monotonic() >= next_stats:
+                    self._log_stats()
+                    next_stats = time.monotonic() + self.stats_interval
         except KeyboardInterrupt:
-            print("Caught keyboard interrupt, exiting")
+            logger.info("Caught keyboard interrupt, exiting")
         finally:
+            self.stop_sharing()
             self.sel.close()
 
+liblog.configure()
 transmission = RelayThread()
 transmission.begin_thread()
@@ -0,0 +1,131 @@
+import collections
+import json
+import random
+import struct
+import time
+
+import libcodec
+
+# Every UDP datagram is one self-contained state frame:
+# version, content type id, sender session, sequence number, send timestamp
+DATAGRAM_VERSION = 1
+DATAGRAM_HEADER = struct.Struct(">BBHId")
+# Plenty for a state frame and below the usual tether MTU
+MAX_DATAGRAM_SIZE = 1400
+
+TYPE_JSON = 0
+TYPE_ROV_STATE = 1
+
+# Frames that spent this much longer in flight than the fastest one are dropped
+DEFAULT_MAX_AGE = 0.2
+# Seconds of frames the fastest one is taken from, clocks that drift apart
+# move the baseline along instead of making every frame look stale
+DEFAULT_DELAY_WINDOW = 5.0
+# Frames in a row at a new, constant offset after which the clocks count as
+# stepped, say by an NTP correction, and the baseline starts over. Recovers
+# well within the link timeout
+DEFAULT_STALE_RESET = 5
+# Share of max_age the delays after a step may spread, a queue that builds
+# up or drains spreads them more and stays stale
+STEP_SPREAD = 0.25
+
+
+def new_session():
+    """Random id for a sender, lets the receiver notice a restart."""
+    return random.getrandbits(16)
+
+
+def pack_datagram(session, seq, content, fits, pack):
+    if fits(content):
+        content_type, content_bytes = TYPE_ROV_STATE, pack(content)
+    else:
+        content_type, content_bytes = TYPE_JSON, json.dumps(content, ensure_ascii=False).encode("utf-8")
+    header = DATAGRAM_HEADER.pack(DATAGRAM_VERSION, content_type, session, seq, time.time())
+    return header + content_bytes
+
+
+def unpack_datagram(data):
+    """Split a datagram into (session, seq, timestamp, content_type, content view)."""
+    if len(data) < DATAGRAM_HEADER.size:
+        raise ValueError("Truncated datagram.")
+    version, content_type, session, seq, timestamp = DATAGRAM_HEADER.unpack_from(data)
+    if version != DATAGRAM_VERSION:
+        raise ValueError(f"Unsupported datagram version {version}.")
+    return session, seq, timestamp, content_type, memoryview(data)[DATAGRAM_HEADER.size:]
+
+
+def decode_content(content_type, content):
+    if content_type == TYPE_ROV_STATE:
+        return libcodec.unpack(content)
+    if content_type == TYPE_JSON:
+        return json.loads(bytes(content))
+    raise ValueError(f"Unsupported datagram content type {content_type}.")
+
+
+class SequenceFilter:
+    """Drops datagrams that arrive out of order or too late to still matter.
+
+    Staleness is judged on the one-way delay relative to the fastest frame
+    of the last window seconds, so the two ends don't need synchronized
+    clocks. A clock step moves every delay by the same amount from one
+    frame to the next: when the delay jumps by more than max_age at once
+    and stale_reset frames in a row stay at the new offset, it becomes
+    the baseline. Frames that are late because of queueing stay dropped,
+    their delays build up or drain instead of jumping to a constant.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, window=DEFAULT_DELAY_WINDOW, stale_reset=DEFAULT_STALE_RESET):
+        self.max_age = max_age
+        self.window = window
+        self.stale_reset = stale_reset
+        self.session = None
+        self.last_seq = 0
+        # (arrival, delay) with growing delays, the first is the fastest of the window
+        self._delays = collections.deque()
+        self._stale_run = 0
+        # Delay of the last accepted frame, and of the first of a stale run that looks like a clock step
+        self._last_delay = None
+        self._step = None
+        self.accepted = 0
+        self.out_of_order = 0
+        self.stale = 0
+
+    def accept(self, session, seq, timestamp):
+        if session != self.session:
+            # The sender restarted, its sequence numbers start over
+            self.session = session
+            self.last_seq = 0
+            self._delays.clear()
+            self._stale_run = 0
+            self._last_delay = None
+            self._step = None
+        if seq <= self.last_seq:
+            self.out_of_order += 1
+            return False
+        self.last_seq = seq
+        delay = time.time() - timestamp
+        arrival = time.monotonic()
+        delays = self._delays
+        while delays and delays[-1][1] >= delay:
+            delays.pop()
+        delays.append((arrival, delay))
+        while delays[0][0] < arrival - self.window:
+            delays.popleft()
+        if self.max_age is not None and delay - delays[0][1] > self.max_age:
+            if not self._stale_run:
+                jumped = self._last_delay is not None and delay - self._last_delay > self.max_age
+                self._step = delay if jumped else None
+            elif self._step is not None and abs(delay - self._step) > self.max_age * STEP_SPREAD:
+                self._step = None
+            self._stale_run += 1
+            if self._step is None or self._stale_run < self.stale_reset:
+                self.stale += 1
+                return False
+            # The clocks stepped, the delays from here on are the new normal
+            delays.clear()
+            delays.append((arrival, delay))
+        self._stale_run = 0
+        self._step = None
+        self._last_delay = delay
+        self.accepted += 1
+        return True
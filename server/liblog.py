@@ -0,0 +1,37 @@
+import logging
+import time
+
+# Seconds between two log lines for an event that happens every frame
+FRAME_LOG_INTERVAL = 1.0
+
+
+class SampledLogger:
+    """Logs at most one line per interval for events that happen every frame.
+
+    Nothing is formatted unless the level is enabled and a sample is due, the
+    arguments are only turned into text by logging itself. Each line says how
+    many similar ones were skipped since the last.
+    """
+
+    def __init__(self, logger, level=logging.DEBUG, interval=FRAME_LOG_INTERVAL):
+        self.logger = logger
+        self.level = level
+        self.interval = interval
+        self._next = 0.0
+        self._skipped = 0
+
+    def log(self, msg, *args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        now = time.monotonic()
+        if now < self._next:
+            self._skipped += 1
+            return
+        self._next = now + self.interval
+        skipped, self._skipped = self._skipped, 0
+        self.logger.log(self.level, msg + " (%d skipped)", *args, skipped)
+
+
+def configure(level=logging.INFO):
+    """Log lifecycle events to stderr unless the application set up logging itself."""
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
@@ -0,0 +1,110 @@
+import bisect
+import time
+
+# Upper bounds of the RTT histogram buckets in seconds, four per octave from
+# 50us to about 13s, so every percentile is within 19% of the real value
+RTT_BUCKETS = tuple(50e-6 * 2 ** (i / 4) for i in range(73))
+
+COUNTERS = ("frames_sent", "frames_received", "bytes_sent", "bytes_received", "decode_errors")
+
+
+class LatencyHistogram:
+    """Fixed log-spaced buckets, recording a sample is one bisect and one increment."""
+
+    def __init__(self, buckets=RTT_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts samples above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p, counts=None):
+        """Upper bound of the bucket holding the p-th percentile, at most the largest
+        sample and None without samples."""
+        if counts is None:
+            counts = list(self.counts)
+        count = sum(counts)
+        if not count:
+            return None
+        rank = p / 100 * count
+        seen = 0
+        for i, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        counts = list(self.counts)
+        count = sum(counts)
+        return {
+            "count": count,
+            "mean": self.total / count if count else None,
+            "p50": self.percentile(50, counts),
+            "p95": self.percentile(95, counts),
+            "p99": self.percentile(99, counts),
+            "max": self.max if count else None,
+        }
+
+
+class LinkStats:
+    """Counters for one side of the control link.
+
+    Only the relay thread updates them, plain ints keep that cheap. Readers
+    on other threads go through snapshot, which copies everything first.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.decode_errors = 0
+        self.connections = 0
+        # Request to response round trip, fed by the "ts" header the server echoes back
+        self.rtt = LatencyHistogram()
+
+    def snapshot(self):
+        stats = {name: getattr(self, name) for name in COUNTERS}
+        stats["reconnects"] = max(self.connections - 1, 0)
+        stats["uptime"] = time.monotonic() - self.started
+        stats["rtt"] = self.rtt.snapshot()
+        return stats
+
+
+def rates(before, after):
+    """Per second rates of every counter between two snapshots."""
+    elapsed = after["uptime"] - before["uptime"]
+    if elapsed <= 0:
+        return {name: 0.0 for name in COUNTERS}
+    return {name: (after[name] - before[name]) / elapsed for name in COUNTERS}
+
+
+def format_stats(stats, previous=None):
+    """One log line, with rates since previous when there is one."""
+    rtt = stats["rtt"]
+    parts = []
+    if previous is not None:
+        rate = rates(previous, stats)
+        parts.append(
+            f"{rate['frames_sent']:.0f}/{rate['frames_received']:.0f} frames/s out/in, "
+            f"{rate['bytes_sent'] / 1024:.1f}/{rate['bytes_received'] / 1024:.1f} KiB/s"
+        )
+    else:
+        parts.append(f"{stats['frames_sent']}/{stats['frames_received']} frames out/in")
+    if rtt["count"]:
+        parts.append(
+            f"rtt p50 {rtt['p50'] * 1000:.2f}ms p95 {rtt['p95'] * 1000:.2f}ms "
+            f"p99 {rtt['p99'] * 1000:.2f}ms max {rtt['max'] * 1000:.2f}ms"
+        )
+    parts.append(f"{stats['decode_errors']} decode errors, {stats['reconnects']} reconnects")
+    return ", ".join(parts)
@@ -1,20 +1,71 @@
-import io
 import json
+import logging
 import selectors
 import struct
 import sys
+import time
+
+import libbuffer
+import libchannel
+import libcodec
+import libdatagram
+import libdelta
+import libframe
+import liblog
+import libmetrics
+
+logger = logging.getLogger(__name__)
+
+# Content types this side can decode, in order of preference
+SUPPORTED_CONTENT_TYPES = (libdelta.DELTA_CONTENT_TYPE, libcodec.ROV_STATE_CONTENT_TYPE, "text/json")
+
+
+class PeerClosedError(ConnectionError):
+    """The other side closed the connection, an ordinary way for it to end."""
 
 
 class Message:
-    def __init__(self, selector, sock, addr, default_robot_state, default_sensor_data):
+    def __init__(self, selector, sock, addr, default_robot_state, default_sensor_data, stats=None, channels=None):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = libbuffer.RecvBuffer()
+        self._send_buffer = bytearray()
+        # Switched on once both peers agreed on libframe.FRAMING, every later
+        # frame then has a fixed binary header packed into _frame_header
+        self.binary_framing = False
+        self._frame_header = bytearray(libframe.FRAME_HEADER.size)
+        self._frame_log = liblog.SampledLogger(logger)
+        # RelayThread shares one between all connections, one counter set per link
+        self.stats = stats if stats is not None else libmetrics.LinkStats()
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
+        # Highest "seq" drained from the client, echoed back as "ack"
+        self._last_seq = None
+        # "ts" of that request, echoed back as "echo" for the client's round trip time
+        self._last_ts = None
+        # Our own response counter, the client acks it back for delta sync
+        self.seq = 0
+        self._delta_encoder = libdelta.DeltaEncoder()
+        self._delta_decoder = libdelta.DeltaDecoder()
+        # Set when a delta frame's base was missing, asks the client for a keyframe
+        self._keyframe_wanted = False
+        # RelayThread registers new connections for read events
+        self._events_mode = "r"
+        # Content type used for responses, settled by the client's "accept" header
+        self.response_type = "text/json"
+        # Set when the client offered binary framing, confirmed in our next response
+        self._framing_offered = False
+        # libchannel.ChannelLink of this connection, enabled together with
+        # binary framing when the client offered channels too
+        self.channels = channels
+        self._channels_offered = False
+        self.channels_enabled = False
+        # When the client connected and its last frame arrived, RelayThread
+        # closes connections that stay silent for too long
+        self.connected_at = time.monotonic()
+        self.last_received = None
         
         self.sensor_data = default_sensor_data
         self.robot_state = default_robot_state
@@ -29,24 +80,27 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
+        if mode == self._events_mode:
+            # Already listening for these, skip the syscall
+            return
         self.selector.modify(self.sock, events, data=self)
+        self._events_mode = mode
 
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096) # type: ignore
+            received = self._recv_buffer.recv_into(self.sock, 4096)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            if not received:
+                raise PeerClosedError("Peer closed.")
+            self.stats.bytes_received += received
 
     def _write(self):
         if self._send_buffer:
-            print(f"Sending {self._send_buffer!r} to {self.addr}")
+            self._frame_log.log("Sending %r to %s", self._send_buffer, self.addr)
             try:
                 # Should be ready to write
                 sent = self.sock.send(self._send_buffer) # type: ignore
@@ -54,22 +108,18 @@ class Message:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                del self._send_buffer[:sent]
+                self.stats.bytes_sent += sent
 
 
     def _json_encode(self, obj, encoding):
         return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        return json.loads(str(json_bytes, encoding))
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, headers=None
     ):
         jsonheader = {
             "byteorder": sys.byteorder,
@@ -77,11 +127,39 @@ class Message:
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        if headers:
+            jsonheader.update(headers)
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
         message = message_hdr + jsonheader_bytes + content_bytes
         return message
 
+    def _queue_message(
+        self, *, content_bytes, content_type, content_encoding, headers
+    ):
+        if self.binary_framing:
+            libframe.pack_header_into(
+                self._frame_header, 0, content_type, len(content_bytes), headers
+            )
+            self._send_buffer += self._frame_header
+            self._send_buffer += content_bytes
+        else:
+            self._send_buffer += self._create_message(
+                content_bytes=content_bytes,
+                content_type=content_type,
+                content_encoding=content_encoding,
+                headers=headers,
+            )
+
+    def _queue_channel_frame(self, channel_id, flags, chunk):
+        libframe.pack_header_into(
+            self._frame_header, 0, libchannel.CHANNEL_CONTENT_TYPE,
+            libchannel.CHANNEL_HEADER.size + len(chunk), {"seq": 0},
+        )
+        self._send_buffer += self._frame_header
+        self._send_buffer += libchannel.CHANNEL_HEADER.pack(channel_id, flags)
+        self._send_buffer += chunk
+
     def _create_response_json_content(self):
         # sent the content of the message to be the sensor data
         content = self.sensor_data
@@ -95,6 +173,37 @@ class Message:
         }
         return response
 
+    def _create_response_binary_content(self):
+        response = {
+            "content_bytes": libcodec.pack_sensor_data(self.sensor_data),
+            "content_type": libcodec.ROV_STATE_CONTENT_TYPE,
+            "content_encoding": "binary",
+        }
+        return response
+
+    def _create_response_delta_content(self):
+        content_encoding = "utf-8"
+        frame = self._delta_encoder.encode(self.sensor_data, self.seq)
+        response = {
+            "content_bytes": self._json_encode(frame, content_encoding),
+            "content_type": libdelta.DELTA_CONTENT_TYPE,
+            "content_encoding": content_encoding,
+        }
+        return response
+
+    def _negotiate_content_type(self):
+        accept = self.jsonheader.get("accept") # type: ignore
+        if accept is None:
+            # Peer does not negotiate, answer in the type it sent us
+            if self.jsonheader["content-type"] in SUPPORTED_CONTENT_TYPES: # type: ignore
+                self.response_type = self.jsonheader["content-type"] # type: ignore
+            return
+        for content_type in accept:
+            if content_type in SUPPORTED_CONTENT_TYPES:
+                self.response_type = content_type
+                return
+        raise ValueError(f"No supported content type in {accept!r}.")
+
     def process_events(self, mask, sensor_data):
         self.sensor_data = sensor_data
         
@@ -108,57 +217,99 @@ class Message:
 
     def read(self):
         self._read()
+        self.process_received()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+    def receive(self, data):
+        """Handle bytes that arrived some other way than through our socket, e.g. asyncio."""
+        self._recv_buffer.feed(data)
+        self.stats.bytes_received += len(data)
+        self.process_received()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+    def process_received(self):
+        try:
+            self._process_frames()
+        except ValueError:
+            # Garbled header or content, RelayThread drops the connection
+            self.stats.decode_errors += 1
+            raise
 
-        if self.jsonheader:
-            if self.request is None:
-                self.process_request()
+    def _process_frames(self):
+        # Drain every complete frame, a burst of requests only needs the
+        # newest robot state and a single response
+        latest = None
+        while True:
+            if self.binary_framing:
+                if self.jsonheader is None:
+                    self.process_frameheader()
+            else:
+                if self._jsonheader_len is None:
+                    self.process_protoheader()
 
-    def write(self):
-        if self.request:
+                if self._jsonheader_len is not None:
+                    if self.jsonheader is None:
+                        self.process_jsonheader()
+
+            if not self.jsonheader:
+                break
+            if self.jsonheader["content-type"] == libchannel.CHANNEL_CONTENT_TYPE:
+                if not self.take_channel_frame():
+                    break
+                continue
+            frame = self.take_request()
+            if frame is None:
+                break
+            latest = frame
+
+        if latest is not None:
+            self.last_received = time.monotonic()
+            self.process_request(*latest)
             self.create_response()
 
+    def write(self):
         self._write()
 
+        if not self._send_buffer:
+            # Set selector to listen for read events, we're done writing.
+            self._set_selector_events_mask("r")
+
     def close(self):
-        print(f"Closing connection to {self.addr}")
+        logger.info("Closing connection to %s", self.addr)
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
-            print(
-                f"Error: selector.unregister() exception for "
-                f"{self.addr}: {e!r}"
-            )
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close() # type: ignore
         except OSError as e:
-            print(f"Error: socket.close() exception for {self.addr}: {e!r}")
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+            if self.channels is not None:
+                self.channels.close()
 
     def process_protoheader(self):
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
             self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
+                ">H", self._recv_buffer.consume(hdrlen)
             )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+
+    def process_frameheader(self):
+        hdrlen = libframe.FRAME_HEADER.size
+        if len(self._recv_buffer) >= hdrlen:
+            fields = self._recv_buffer.unpack_from(libframe.FRAME_HEADER)
+            self._recv_buffer.consume(hdrlen)
+            # Same shape as a json header so the rest of the parsing doesn't care
+            self.jsonheader = libframe.header_from_fields(*fields)
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen: # type: ignore
             self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
+                self._recv_buffer.consume(hdrlen), "utf-8" # type: ignore
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -167,37 +318,209 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            self._negotiate_content_type()
 
-    def process_request(self):
+    def take_channel_frame(self):
+        """Hand the current channel frame to our ChannelLink, False until it is complete."""
         content_len = self.jsonheader["content-length"] # type: ignore
         if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json": # type: ignore
-            encoding = self.jsonheader["content-encoding"] # type: ignore
+            return False
+        if not self.channels_enabled:
+            raise ValueError("Channel frame before channels were confirmed.")
+        # Decoded or copied by receive before the next read
+        self.channels.receive(self._recv_buffer.consume(content_len))
+        self._jsonheader_len = None
+        self.jsonheader = None
+        return True
+
+    def take_request(self):
+        """Take the content of the current frame off the receive buffer without decoding it."""
+        content_len = self.jsonheader["content-length"] # type: ignore
+        if not len(self._recv_buffer) >= content_len:
+            return None
+        jsonheader = self.jsonheader
+        if jsonheader["content-type"] not in SUPPORTED_CONTENT_TYPES: # type: ignore
+            raise ValueError(f"Unsupported content type: {jsonheader['content-type']!r}") # type: ignore
+        # A view into the receive buffer, decode it before the next read
+        data = self._recv_buffer.consume(content_len)
+        self.stats.frames_received += 1
+        self._last_seq = jsonheader.get("seq", self._last_seq) # type: ignore
+        self._last_ts = jsonheader.get("ts") # type: ignore
+        if libframe.FRAMING in jsonheader.get("framing", ()): # type: ignore
+            self._framing_offered = True
+        if jsonheader.get("channels") == libchannel.CHANNELS and self.channels is not None: # type: ignore
+            self._channels_offered = True
+        if "ack" in jsonheader: # type: ignore
+            self._delta_encoder.ack(jsonheader["ack"]) # type: ignore
+        if jsonheader.get("keyframe"): # type: ignore
+            self._delta_encoder.request_keyframe()
+        
+        # Reset state to read the next message
+        self._jsonheader_len = None
+        self.jsonheader = None
+        return jsonheader, data
+
+    def process_request(self, jsonheader, data):
+        if jsonheader["content-type"] == "text/json":
+            encoding = jsonheader["content-encoding"]
             self.request = self._json_decode(data, encoding)
             
             self.robot_state = dict(self.request)
+        elif jsonheader["content-type"] == libcodec.ROV_STATE_CONTENT_TYPE:
+            self.request = libcodec.unpack(data)
+            
+            self.robot_state = dict(self.request)
+        elif jsonheader["content-type"] == libdelta.DELTA_CONTENT_TYPE:
+            encoding = jsonheader["content-encoding"]
+            self.request = self._delta_decoder.decode(self._json_decode(data, encoding))
+            
+            # Keep the old state until a keyframe arrives, the client only
+            # sends one early when asked to
+            if self.request is not None:
+                self.robot_state = dict(self.request)
+            else:
+                self._keyframe_wanted = True
         else:
-            raise ValueError(f"Unsupported content type: {self.jsonheader['content-type']!r}") # type: ignore
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
+            raise ValueError(f"Unsupported content type: {jsonheader['content-type']!r}")
 
     def create_response(self):
-        if self.jsonheader["content-type"] == "text/json": # type: ignore
+        self.seq += 1
+        if self.response_type == libdelta.DELTA_CONTENT_TYPE:
+            response = self._create_response_delta_content()
+        elif (
+            self.response_type == libcodec.ROV_STATE_CONTENT_TYPE
+            and libcodec.fits_sensor_data(self.sensor_data)
+        ):
+            response = self._create_response_binary_content()
+        else:
+            # sensor data the binary layout can't hold always goes out as json
             response = self._create_response_json_content()
+        response["headers"] = {"seq": self.seq}
+        if self._last_seq is not None:
+            # Tells a pipelining client how many of its requests we have drained
+            response["headers"]["ack"] = self._last_seq
+        if self._last_ts is not None:
+            response["headers"]["echo"] = self._last_ts
+        if self._keyframe_wanted:
+            response["headers"]["keyframe"] = True
+            self._keyframe_wanted = False
+        if self._framing_offered and not self.binary_framing:
+            response["headers"]["framing"] = libframe.FRAMING
+            if self._channels_offered:
+                response["headers"]["channels"] = libchannel.CHANNELS
+            self._queue_message(**response)
+            # The client waits for this response before it sends again, so
+            # both directions can switch right here
+            self.binary_framing = True
+            self.channels_enabled = self._channels_offered
         else:
-            # Binary or unknown content-type
-            raise ValueError(f"Unsupported content type: {self.jsonheader['content-type']!r}") # type: ignore
-        message = self._create_message(**response)
-        self._send_buffer += message
-        
-        # Set selector to listen for read events, we're done writing.
-        self._set_selector_events_mask("r")
+            self._queue_message(**response)
+        self.stats.frames_sent += 1
+        # Channel messages only ever go out behind a control frame
+        if self.channels_enabled:
+            self.channels.fill(self._queue_channel_frame, self.channels.router.frame_budget)
+        self.request = None
         
-        # Reset state to read the next message
-        self._jsonheader_len = None
-        self.jsonheader = None
+        # Try to send straight away, only wait for write events if the socket is full
+        self._write()
+        if self._send_buffer:
+            self._set_selector_events_mask("rw")
+
+
+class DatagramMessage:
+    """UDP counterpart of Message, one socket serves every client.
+
+    Each batch of datagrams from a client is answered with one sensor data
+    datagram. Robot states that arrive out of order or late are dropped
+    instead of being applied over newer commands.
+    """
+
+    def __init__(self, selector, sock, default_robot_state, default_sensor_data, max_age=libdatagram.DEFAULT_MAX_AGE, stats=None):
+        self.selector = selector
+        self.sock = sock
+        self.addr = sock.getsockname()
+        self.session = libdatagram.new_session()
+        self.seq = 0
+        # Every client gets its own sequence filter, keyed by address
+        self.filters = {}
+        self.max_age = max_age
+        self.send_dropped = 0
+        self.stats = stats if stats is not None else libmetrics.LinkStats()
+        self.connected_at = time.monotonic()
+        self.last_received = None
         self.request = None
         
+        self.sensor_data = default_sensor_data
+        self.robot_state = default_robot_state
+
+    def process_events(self, mask, sensor_data):
+        self.sensor_data = sensor_data
+        
+        if mask & selectors.EVENT_READ:
+            self.read()
+        
+        # returns the robot state if you want to grab it through this function
+        return self.robot_state
+
+    def read(self):
+        # Drain every queued datagram, only the newest accepted one is decoded
+        latest = None
+        peers = set()
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(libdatagram.MAX_DATAGRAM_SIZE) # type: ignore
+            except BlockingIOError:
+                break
+            self.stats.frames_received += 1
+            self.stats.bytes_received += len(data)
+            try:
+                session, seq, timestamp, content_type, content = libdatagram.unpack_datagram(data)
+            except ValueError as e:
+                self.stats.decode_errors += 1
+                # Don't let one bad datagram take the socket down for everyone
+                logger.warning("Dropping datagram from %s: %r", addr, e)
+                continue
+            seq_filter = self.filters.get(addr)
+            if seq_filter is None:
+                logger.info("Receiving datagrams from %s", addr)
+                self.stats.connections += 1
+                seq_filter = self.filters[addr] = libdatagram.SequenceFilter(self.max_age)
+            if seq_filter.accept(session, seq, timestamp):
+                latest = (content_type, content)
+                peers.add(addr)
+        
+        if latest is not None:
+            self.last_received = time.monotonic()
+            self.request = libdatagram.decode_content(*latest)
+            self.robot_state = dict(self.request)
+        for addr in peers:
+            self.send_response(addr)
+
+    def send_response(self, addr):
+        self.seq += 1
+        datagram = libdatagram.pack_datagram(
+            self.session, self.seq, self.sensor_data,
+            libcodec.fits_sensor_data, libcodec.pack_sensor_data,
+        )
+        try:
+            self.sock.sendto(datagram, addr) # type: ignore
+        except BlockingIOError:
+            self.send_dropped += 1
+        else:
+            self.stats.frames_sent += 1
+            self.stats.bytes_sent += len(datagram)
+
+    def close(self):
+        logger.info("Closing datagram socket %s", self.addr)
+        try:
+            self.selector.unregister(self.sock)
+        except Exception as e:
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
+
+        try:
+            self.sock.close() # type: ignore
+        except OSError as e:
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
+        finally:
+            # Delete reference to socket object for garbage collection
+            self.sock = None
@@ -0,0 +1,201 @@
+import json
+import logging
+import struct
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+import libcodec
+import libstate
+
+logger = logging.getLogger(__name__)
+
+# Start of the segment, the number is the layout version
+MAGIC = b"ROVSHM\x00\x01"
+# Name RelayThread.share_state uses unless told otherwise
+DEFAULT_NAME = "rov-state"
+# Bytes of encoded state a slot holds, plenty for the json fallback
+DEFAULT_CAPACITY = 1024
+
+# Sequence number, crc32 of the payload, payload encoding, payload length.
+# The sequence number is odd while the writer is in the middle of a write
+SLOT_HEADER = struct.Struct("<QIBxH")
+_SEQ = struct.Struct("<Q")
+
+# Payloads are libcodec frames, states the binary layout can't hold are json
+ENCODING_CODEC = 0
+ENCODING_JSON = 1
+
+# Seconds a reader keeps retrying while the writer is mid-write
+READ_TIMEOUT = 0.1
+# Seconds between looks at the sequence number while waiting for a new state
+DEFAULT_POLL_INTERVAL = 0.0005
+
+
+def open_segment(name, size=0, create=False):
+    """SharedMemory name, attached ones are left alone by this process' resource tracker.
+
+    Only the creator should remove a segment. Before Python 3.13 every
+    process that attaches registers it too and unlinks it when it exits.
+    Children started by multiprocessing share their parent's tracker, the
+    states are meant for separate programs, attach from one of those.
+    """
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=create)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name, create, size)
+        if not create:
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+class SharedSlot:
+    """One seqlock protected value in shared memory, with a single writer.
+
+    The writer makes the sequence number odd, writes the payload and makes
+    it even again. A reader copies the payload and retries if the sequence
+    number was odd or changed meanwhile. Python has no memory barriers, so
+    on CPUs that reorder stores, like the ARM ones on the robot, a reader
+    could still see a half written payload with an even number. The crc32
+    catches that, it's cheap at these sizes and a torn motor command must
+    never get through.
+    """
+
+    def __init__(self, buffer, offset, capacity):
+        self._buffer = buffer
+        self._offset = offset
+        self.capacity = capacity
+        self._payload = offset + SLOT_HEADER.size
+
+    @property
+    def version(self):
+        """Number of writes so far, without waiting for one in progress."""
+        return _SEQ.unpack_from(self._buffer, self._offset)[0] // 2
+
+    def write(self, encoding, payload):
+        if len(payload) > self.capacity:
+            raise ValueError(f"Payload of {len(payload)} bytes does not fit a slot of {self.capacity}.")
+        seq = _SEQ.unpack_from(self._buffer, self._offset)[0]
+        _SEQ.pack_into(self._buffer, self._offset, seq + 1)
+        self._buffer[self._payload:self._payload + len(payload)] = payload
+        SLOT_HEADER.pack_into(self._buffer, self._offset, seq + 1, zlib.crc32(payload), encoding, len(payload))
+        _SEQ.pack_into(self._buffer, self._offset, seq + 2)
+        return seq // 2 + 1
+
+    def read(self):
+        """(version, encoding, payload) of the last complete write, version 0 if there was none."""
+        deadline = None
+        while True:
+            seq, crc, encoding, length = SLOT_HEADER.unpack_from(self._buffer, self._offset)
+            if not seq & 1 and length <= self.capacity:
+                payload = bytes(self._buffer[self._payload:self._payload + length])
+                if _SEQ.unpack_from(self._buffer, self._offset)[0] == seq and zlib.crc32(payload) == crc:
+                    return seq // 2, encoding, payload
+            if deadline is None:
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise TimeoutError("The writer of a shared slot stopped in the middle of a write.")
+            # Let the writer finish
+            time.sleep(0)
+
+
+class SharedCell:
+    """A StateCell that lives in shared memory, for processes that share a machine.
+
+    get, publish, update and wait_newer work like those of
+    libstate.StateCell, but across processes and without sockets or
+    pickling: states are libcodec frames, json when they don't fit its
+    layout. Only one process may write a cell, every other one reads.
+    Readers poll the sequence number, there is no cross process wakeup.
+    """
+
+    def __init__(self, slot, kind):
+        self.slot = slot
+        self.kind = kind
+        # Decoded state of the last version read, most reads find nothing new
+        self._snapshot = libstate.Snapshot(-1, None)
+
+    @property
+    def version(self):
+        return self.slot.version
+
+    def _encode(self, state):
+        if self.kind == libcodec.KIND_ROBOT_STATE and libcodec.fits_robot_state(state):
+            return ENCODING_CODEC, libcodec.pack_robot_state(state)
+        if self.kind == libcodec.KIND_SENSOR_DATA and libcodec.fits_sensor_data(state):
+            return ENCODING_CODEC, libcodec.pack_sensor_data(state)
+        return ENCODING_JSON, json.dumps(state).encode("utf-8")
+
+    def get(self):
+        """Snapshot of the newest state, version 0 and None before the first publish."""
+        snapshot = self._snapshot
+        if snapshot.version == self.slot.version:
+            return snapshot
+        version, encoding, payload = self.slot.read()
+        if version == 0:
+            state = None
+        elif encoding == ENCODING_CODEC:
+            state = libcodec.unpack(payload)
+        else:
+            state = json.loads(str(payload, "utf-8"))
+        snapshot = self._snapshot = libstate.Snapshot(version, state)
+        return snapshot
+
+    def publish(self, state):
+        """Write state as the new version and return it."""
+        return self.slot.write(*self._encode(state))
+
+    def update(self, **fields):
+        """Publish a copy of the current state with fields replaced, returns its version."""
+        state = dict(self.get().state or {})
+        state.update(fields)
+        return self.publish(state)
+
+    def wait_newer(self, version, timeout=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        """Snapshot newer than version, None if there was none within timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.slot.version <= version:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+        return self.get()
+
+
+class SharedState:
+    """robot_state and sensor_data of the relay in one shared memory segment.
+
+    RelayThread.share_state creates it and writes every robot state into
+    robot_state. A motor driver process attaches by name and reads it, a
+    sensor process attaches and publishes into sensor_data, which the
+    relay picks up. Every process runs its own interpreter on its own core.
+    """
+
+    def __init__(self, name=DEFAULT_NAME, create=False, capacity=DEFAULT_CAPACITY):
+        slot_size = SLOT_HEADER.size + capacity
+        # Header and slots start on 8 byte boundaries
+        slot_size += -slot_size % 8
+        layout = struct.Struct("<8sII")
+        self.name = name
+        self._created = create
+        self._segment = open_segment(name, layout.size + 2 * slot_size, create)
+        buffer = self._segment.buf
+        if create:
+            buffer[:len(buffer)] = bytes(len(buffer))
+            layout.pack_into(buffer, 0, MAGIC, capacity, slot_size)
+        else:
+            magic, capacity, slot_size = layout.unpack_from(buffer)
+            if magic != MAGIC:
+                self._segment.close()
+                raise ValueError(f"Shared memory {name!r} does not hold the relay state.")
+        self.robot_state = SharedCell(SharedSlot(buffer, layout.size, capacity), libcodec.KIND_ROBOT_STATE)
+        self.sensor_data = SharedCell(
+            SharedSlot(buffer, layout.size + slot_size, capacity), libcodec.KIND_SENSOR_DATA
+        )
+
+    def close(self):
+        """Detach, the creator also removes the segment."""
+        # The cells hold views into the buffer, those have to go first
+        self.robot_state = self.sensor_data = None
+        self._segment.close()
+        if self._created:
+            self._segment.unlink()
@@ -0,0 +1,136 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+Snapshot = collections.namedtuple("Snapshot", ["version", "state"])
+
+_UNSET = object()
+
+
+def _exceeds(value, last, threshold):
+    """True if a number, or any number in a tuple, moved by more than threshold."""
+    if isinstance(value, (tuple, list)) and isinstance(last, (tuple, list)) and len(value) == len(last):
+        return any(abs(a - b) > threshold for a, b in zip(value, last))
+    if isinstance(value, (int, float)) and isinstance(last, (int, float)):
+        return abs(value - last) > threshold
+    return value != last
+
+
+class Subscription:
+    """A callback on a StateCell, for the whole state or for one field.
+
+    A field subscription is only called when that field changed, with a
+    threshold it has to move by more than that since the value last passed
+    to the callback, so sensor noise doesn't wake it up. Without an executor
+    the callback runs on the thread that published the state.
+    """
+
+    def __init__(self, callback, field=None, threshold=None, executor=None):
+        self.callback = callback
+        self.field = field
+        self.threshold = threshold
+        self.executor = executor
+        self._last = _UNSET
+
+    def deliver(self, state):
+        if self.field is None:
+            value = state
+        else:
+            if self.field not in state:
+                return
+            value = state[self.field]
+            if self._last is not _UNSET:
+                if self.threshold is None:
+                    if value == self._last:
+                        return
+                elif not _exceeds(value, self._last, self.threshold):
+                    return
+            self._last = value
+        if self.executor is None:
+            self._call(value)
+        else:
+            self.executor.submit(self._call, value)
+
+    def _call(self, value):
+        try:
+            self.callback(value)
+        except Exception:
+            # One broken subscriber must not take the relay loop down
+            logger.error("Subscriber %r failed", self.callback, exc_info=True)
+
+
+class StateCell:
+    """Versioned state dict shared between the application and the relay thread.
+
+    A published dict is never changed again, writers build a new one and swap
+    it in together with the next version number. Readers just take the
+    current snapshot without locking and always see every field of the same
+    version. Writers are serialized by a condition that also lets readers
+    block until a version newer than the one they have is published.
+
+    Subscribers are called after every publish, outside the lock. With more
+    than one writer thread they can see versions out of order, both relays
+    only ever publish incoming state from their network thread.
+    """
+
+    def __init__(self, state):
+        self._snapshot = Snapshot(0, dict(state))
+        self._cond = threading.Condition()
+        # Replaced instead of changed so publishers can loop over it unlocked
+        self._subscribers = ()
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def get(self):
+        return self._snapshot
+
+    def update(self, **fields):
+        """Publish a copy of the current state with fields replaced, returns its version."""
+        with self._cond:
+            state = dict(self._snapshot.state)
+            state.update(fields)
+            version = self._swap(state)
+        self._dispatch(state)
+        return version
+
+    def publish(self, state):
+        """Publish state as the new version, the caller must not change it afterwards."""
+        with self._cond:
+            version = self._swap(state)
+        self._dispatch(state)
+        return version
+
+    def _swap(self, state):
+        version = self._snapshot.version + 1
+        self._snapshot = Snapshot(version, state)
+        self._cond.notify_all()
+        return version
+
+    def _dispatch(self, state):
+        for subscription in self._subscribers:
+            subscription.deliver(state)
+
+    def subscribe(self, callback, field=None, threshold=None, executor=None):
+        """Call callback with every new state, or with field whenever it changes."""
+        subscription = Subscription(callback, field, threshold, executor)
+        with self._cond:
+            self._subscribers += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._cond:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+
+    def wait_newer(self, version, timeout=None):
+        """Snapshot newer than version, None if there was none within timeout."""
+        snapshot = self._snapshot
+        if snapshot.version > version:
+            return snapshot
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._snapshot.version > version, timeout):
+                return None
+            return self._snapshot
@@ -0,0 +1,29 @@
+import socket
+
+# Seconds the kernel waits on a silent connection before probing it, the
+# seconds between probes and how many unanswered probes mean it is dead
+KEEPALIVE_IDLE = 1
+KEEPALIVE_INTERVAL = 1
+KEEPALIVE_COUNT = 3
+# Milliseconds sent data may stay unacknowledged before the kernel gives up
+USER_TIMEOUT = 3000
+
+
+def tune_socket(sock):
+    """Send small control frames right away and let the kernel notice a dead tether.
+
+    The relays' own link timeout notices a dead link much sooner, keepalive
+    also cleans up connections nobody reads anymore. Options a platform
+    doesn't have are skipped.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+        ("TCP_USER_TIMEOUT", USER_TIMEOUT),
+    ):
+        option = getattr(socket, name, None)
+        if option is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
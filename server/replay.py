@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Replay a telemetry log written by RelayThread.start_recording.
+
+By default the sensor data of the log is fed through the RelayThread
+server, so a client connected to it sees the dive again at --speed times
+the recorded pace, 0 replays as fast as possible. --summary loads the
+log into NumPy arrays instead and prints what is in it.
+
+    python server/replay.py dive.rovlog [--speed 1] [--summary]
+"""
+
+import argparse
+import os
+import time
+
+import libcodec
+import librecord
+
+
+def summarize(path):
+    arrays = librecord.load_arrays(path)
+    for name, array in arrays.items():
+        if not len(array):
+            print(f"{name}: no records")
+            continue
+        duration = array["time"][-1] - array["time"][0]
+        rate = (len(array) - 1) / duration if duration else 0.0
+        print(f"{name}: {len(array)} records over {duration:.1f} s, {rate:.1f}/s")
+        for field in array.dtype.names[1:]:
+            values = array[field]
+            print(f"    {field:<18} min {values.min(axis=0)} max {values.max(axis=0)}")
+
+
+def replay(path, speed):
+    # Importing it starts the server
+    import RelayThread
+
+    relay = RelayThread.transmission
+    reader = librecord.LogReader(path)
+    start = None
+    try:
+        for timestamp, kind, state in reader:
+            if kind != libcodec.KIND_SENSOR_DATA:
+                continue
+            if start is None:
+                start = (time.monotonic(), timestamp)
+            if speed:
+                delay = start[0] + (timestamp - start[1]) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            relay.set_sensor_data(**state)
+    finally:
+        reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--summary", action="store_true")
+    args = parser.parse_args()
+    if args.summary:
+        summarize(args.path)
+    else:
+        replay(args.path, args.speed)
+        # The relay thread has no way to stop, clients see the end of the log as a disconnect
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
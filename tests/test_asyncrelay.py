@@ -0,0 +1,70 @@
+import importlib.util
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    # The libraries are the same in client/ and server/, either copy serves both relays
+    sys.path.insert(0, os.path.join(ROOT, side))
+    try:
+        spec = importlib.util.spec_from_file_location(f"AsyncRelay_{side}", os.path.join(ROOT, side, "AsyncRelay.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.pop(0)
+    return module
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.mark.parametrize("control_rate", [None, 50])
+def test_setters_from_other_threads_reach_the_server(control_rate):
+    port = _free_port()
+    server = _load("server").AsyncRelay(port=port)
+    server.begin_thread()
+    client = _load("client").AsyncRelay(port=port)
+    client.control_rate = control_rate
+    client.begin_thread()
+
+    def set_motors(n):
+        for _ in range(200):
+            if n:
+                client.set_horizontal_motors(0.25, 0.25, 0.25, 0.25)
+            else:
+                client.set_vertical_motors(0.5, -0.5)
+
+    threads = [threading.Thread(target=set_motors, args=(n,)) for n in (0, 1)]
+    for thread in threads:
+        thread.start()
+    client.set_enabled(True)
+    for thread in threads:
+        thread.join()
+    server.set_IMU_data(1.0, 2.0, 3.0)
+
+    # Neither setter lost the other's fields
+    assert client.robot_state == {
+        "horizontal_motors": (0.25, 0.25, 0.25, 0.25), "vertical_motors": (0.5, -0.5), "enabled": True,
+    }
+    assert _wait_for(lambda: list(server.get_horizontal_motors()) == [0.25] * 4 and server.get_enabled())
+    assert list(server.get_vertical_motors()) == [0.5, -0.5]
+    assert _wait_for(lambda: list(client.get_imu_data()) == [1.0, 2.0, 3.0])
@@ -0,0 +1,48 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    spec = importlib.util.spec_from_file_location(f"libchannel_{side}", os.path.join(ROOT, side, "libchannel.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=["client", "server"])
+def libchannel(request):
+    return _load(request.param)
+
+
+def test_pending_waits_for_sends_in_progress(libchannel):
+    router = libchannel.ChannelRouter()
+    link = router.open_link()
+    router.register("log", 1)
+    result = []
+    with router.lock:
+        # As if send were adding the first queue of a channel right now
+        thread = threading.Thread(target=lambda: result.append(link.pending()))
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive()
+        link._push(router.channels["log"], b"hello")
+    thread.join()
+    assert result == [True]
+
+
+def test_fill_sends_by_priority(libchannel):
+    router = libchannel.ChannelRouter()
+    link = router.open_link()
+    router.register("log", 1, priority=0)
+    router.register("alarm", 2, priority=5)
+    router.send("log", "a")
+    router.send("alarm", "b")
+    sent = []
+    link.fill(lambda channel_id, flags, chunk: sent.append((channel_id, bytes(chunk))), libchannel.MAX_FRAGMENT)
+    assert sent == [(2, b'"b"'), (1, b'"a"')]
+    assert not link.pending()
@@ -0,0 +1,56 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ROBOT_STATE = {"horizontal_motors": (0.25, -0.5, 0.75, -1.0), "vertical_motors": (0.5, -0.5), "enabled": True}
+SENSOR_DATA = {"IMU": (0.25, -0.5, 9.75)}
+
+
+def _load(side):
+    spec = importlib.util.spec_from_file_location(f"libcodec_{side}", os.path.join(ROOT, side, "libcodec.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=["client", "server"])
+def libcodec(request):
+    return _load(request.param)
+
+
+def test_round_trip(libcodec):
+    assert libcodec.unpack(libcodec.pack_robot_state(ROBOT_STATE)) == ROBOT_STATE
+    assert libcodec.unpack(libcodec.pack_sensor_data(SENSOR_DATA)) == SENSOR_DATA
+
+
+@pytest.mark.parametrize("kind", ["robot_state", "sensor_data"])
+def test_truncated_frames_are_decode_errors(libcodec, kind):
+    if kind == "robot_state":
+        frame = libcodec.pack_robot_state(ROBOT_STATE)
+    else:
+        frame = libcodec.pack_sensor_data(SENSOR_DATA)
+    for length in range(len(frame)):
+        with pytest.raises(ValueError):
+            libcodec.unpack(frame[:length])
+
+
+@pytest.mark.parametrize("fields", [
+    {"horizontal_motors": (0.0, 0.0, 0.0)},
+    {"horizontal_motors": (0.0, 0.0, 0.0, 0.0, 0.0)},
+    {"vertical_motors": 0.5},
+    {"vertical_motors": ("up", "down")},
+    {"vertical_motors": (0.5, None)},
+    {"enabled": "yes"},
+])
+def test_robot_states_the_layout_cannot_hold_do_not_fit(libcodec, fields):
+    assert libcodec.fits_robot_state(ROBOT_STATE)
+    assert not libcodec.fits_robot_state(dict(ROBOT_STATE, **fields))
+
+
+@pytest.mark.parametrize("imu", [(0.0, 0.0), (0.0, 0.0, 0.0, 0.0), "xyz", ("x", 0.0, 0.0), None])
+def test_sensor_data_the_layout_cannot_hold_does_not_fit(libcodec, imu):
+    assert libcodec.fits_sensor_data(SENSOR_DATA)
+    assert not libcodec.fits_sensor_data({"IMU": imu})
@@ -0,0 +1,125 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    # libdatagram imports libcodec from its own directory
+    sys.path.insert(0, os.path.join(ROOT, side))
+    try:
+        spec = importlib.util.spec_from_file_location(f"libdatagram_{side}", os.path.join(ROOT, side, "libdatagram.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.pop(0)
+    return module
+
+
+class Clock:
+    """Receiver wall clock and monotonic clock, the wall clock can step."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.offset = 0.0
+
+    def time(self):
+        return self.now + self.offset
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture(params=["client", "server"])
+def libdatagram(request, monkeypatch):
+    module = _load(request.param)
+    clock = Clock()
+    monkeypatch.setattr(module.time, "time", clock.time)
+    monkeypatch.setattr(module.time, "monotonic", clock.monotonic)
+    module.clock = clock
+    return module
+
+
+def _send(libdatagram, seq_filter, seq, delay, sender_offset=0.0):
+    """Frame seq sent delay seconds before now by a sender whose clock is sender_offset ahead."""
+    clock = libdatagram.clock
+    return seq_filter.accept(1, seq, clock.now - delay + sender_offset)
+
+
+def test_late_frames_are_dropped(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2)
+    assert _send(libdatagram, seq_filter, 1, 0.01)
+    assert not _send(libdatagram, seq_filter, 2, 0.5)
+    assert _send(libdatagram, seq_filter, 3, 0.02)
+
+
+def test_recovers_from_a_clock_step(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2, stale_reset=5)
+    clock = libdatagram.clock
+    seq = 0
+    for seq in range(1, 11):
+        clock.now += 0.02
+        assert _send(libdatagram, seq_filter, seq, 0.01)
+    # NTP moves the receiver's wall clock a second ahead
+    clock.offset = 1.0
+    accepted = []
+    for seq in range(seq + 1, seq + 21):
+        clock.now += 0.02
+        accepted.append(_send(libdatagram, seq_filter, seq, 0.01))
+    # The fifth frame at the new offset becomes the baseline
+    assert accepted[:4] == [False] * 4
+    assert all(accepted[4:])
+
+
+def test_lasting_queueing_stays_dropped(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2, stale_reset=5)
+    clock = libdatagram.clock
+    seq = 0
+    for seq in range(1, 11):
+        clock.now += 0.02
+        assert _send(libdatagram, seq_filter, seq, 0.01)
+    # A queue builds up to 300 ms over half a second and stays for two seconds
+    delays = [0.01 + 0.29 * n / 25 for n in range(1, 26)] + [0.3] * 100
+    accepted = []
+    for seq, delay in enumerate(delays, seq + 1):
+        clock.now += 0.02
+        accepted.append((delay, _send(libdatagram, seq_filter, seq, delay)))
+    assert all(not ok for delay, ok in accepted if delay > 0.21)
+    assert all(ok for delay, ok in accepted if delay <= 0.2)
+
+
+def test_a_jump_that_keeps_spreading_is_not_a_clock_step(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2, stale_reset=5)
+    clock = libdatagram.clock
+    for seq in range(1, 11):
+        clock.now += 0.02
+        assert _send(libdatagram, seq_filter, seq, 0.01)
+    # A link stall releases a burst, the delays drain but stay too old
+    for seq, delay in enumerate([0.5, 0.45, 0.4, 0.35, 0.3, 0.25], 11):
+        assert not _send(libdatagram, seq_filter, seq, delay)
+
+
+def test_new_session_starts_over(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2, stale_reset=5)
+    clock = libdatagram.clock
+    assert seq_filter.accept(1, 1, clock.now - 0.01)
+    for seq in range(2, 5):
+        clock.now += 0.02
+        assert not seq_filter.accept(1, seq, clock.now - 1.0)
+    # A restarted sender with an unrelated clock gets a fresh baseline
+    clock.now += 0.02
+    assert seq_filter.accept(2, 1, clock.now - 3.0)
+    assert seq_filter.accept(2, 2, clock.now - 3.01)
+
+
+def test_follows_clocks_drifting_apart(libdatagram):
+    seq_filter = libdatagram.SequenceFilter(max_age=0.2, window=5.0)
+    clock = libdatagram.clock
+    # 50 frames/s for two minutes, the clocks drift 10 ms apart every second
+    for seq in range(1, 6001):
+        clock.now += 0.02
+        assert _send(libdatagram, seq_filter, seq, 0.01, sender_offset=-0.01 * seq * 0.02)
+    assert seq_filter.stale == 0
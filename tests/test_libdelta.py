@@ -0,0 +1,66 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    spec = importlib.util.spec_from_file_location(f"libdelta_{side}", os.path.join(ROOT, side, "libdelta.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=["client", "server"])
+def libdelta(request):
+    return _load(request.param)
+
+
+def test_pipelined_revert_reaches_the_peer(libdelta):
+    encoder = libdelta.DeltaEncoder()
+    decoder = libdelta.DeltaDecoder()
+    state = {"enabled": False, "vertical_motors": [0.0, 0.0]}
+    decoder.decode(encoder.encode(state, 1))
+    encoder.ack(1)
+
+    # Both go out before the peer acks either of them
+    first = encoder.encode(dict(state, enabled=True), 2)
+    second = encoder.encode(state, 3)
+    assert decoder.decode(first)["enabled"] is True
+    assert decoder.decode(second)["enabled"] is False
+
+    encoder.ack(2)
+    assert decoder.decode(encoder.encode(dict(state, vertical_motors=[0.5, 0.5]), 4)) == {
+        "enabled": False, "vertical_motors": [0.5, 0.5],
+    }
+
+
+def test_frame_on_an_unknown_base_waits_for_a_keyframe(libdelta):
+    encoder = libdelta.DeltaEncoder(keyframe_interval=3)
+    decoder = libdelta.DeltaDecoder()
+    encoder.encode({"enabled": False}, 1)
+    encoder.ack(1)
+    # The keyframe was lost, the decoder never saw seq 1
+    assert decoder.decode(encoder.encode({"enabled": True}, 2)) is None
+    assert decoder.decode(encoder.encode({"enabled": True}, 3)) is None
+    assert decoder.decode(encoder.encode({"enabled": False}, 4)) == {"enabled": False}
+
+
+def test_keyframe_request_ignores_acks_of_frames_the_peer_dropped(libdelta):
+    encoder = libdelta.DeltaEncoder()
+    decoder = libdelta.DeltaDecoder()
+    encoder.encode({"enabled": False}, 1)
+    encoder.ack(1)
+    # The keyframe was lost, the peer acks the delta it could not apply along with a keyframe request
+    assert decoder.decode(encoder.encode({"enabled": True}, 2)) is None
+    encoder.ack(2)
+    encoder.request_keyframe()
+    assert decoder.decode(encoder.encode({"enabled": True}, 3)) == {"enabled": True}
+    # Sent before the peer's ack of the keyframe came back, still a keyframe
+    assert decoder.decode(encoder.encode({"enabled": False}, 4)) == {"enabled": False}
+    encoder.ack(2)
+    encoder.ack(4)
+    assert decoder.decode(encoder.encode({"enabled": True}, 5)) == {"enabled": True}
+    assert encoder.encode({"enabled": True}, 6)["base"] == 4
@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    directory = os.path.join(ROOT, side)
+    # libframe imports the codec modules next to it
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"libframe_{side}", os.path.join(directory, "libframe.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    return module
+
+
+@pytest.fixture(params=["client", "server"])
+def libframe(request):
+    return _load(request.param)
+
+
+@pytest.mark.parametrize("keyframe", [False, True])
+def test_keyframe_request_survives_binary_framing(libframe, keyframe):
+    buffer = bytearray(libframe.FRAME_HEADER.size)
+    headers = {"seq": 7, "ack": 3, "echo": 1.5}
+    if keyframe:
+        headers["keyframe"] = True
+    libframe.pack_header_into(buffer, 0, "text/json", 10, headers)
+    header = libframe.header_from_fields(*libframe.FRAME_HEADER.unpack(buffer))
+    assert header["seq"] == 7 and header["ack"] == 3 and header["echo"] == 1.5
+    assert header.get("keyframe", False) is keyframe
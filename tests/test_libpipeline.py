@@ -0,0 +1,52 @@
+import os
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("imutils")
+np = pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "camera-server"))
+
+import libpipeline
+import libvideo
+
+
+class FailingCapture:
+    """A camera that delivers a few frames and then fails every read while it stays open."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.reads = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        self.reads += 1
+        if self.reads <= self.frames:
+            return True, np.zeros((48, 64, 3), np.uint8)
+        return False, None
+
+    def release(self):
+        pass
+
+
+def test_failing_reads_back_off_and_stop_the_pipeline(monkeypatch):
+    monkeypatch.setattr(libpipeline, "READ_BACKOFF_MAX", 0.02)
+    monkeypatch.setattr(libpipeline, "MAX_READ_FAILURES", 10)
+    capture = FailingCapture(frames=3)
+    pipeline = libpipeline.VideoPipeline(capture, libvideo.FrameEncoder(), width=64, workers=1)
+    start = time.monotonic()
+    pipeline.start()
+    deadline = start + 5
+    while pipeline.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    pipeline.stop()
+    assert not pipeline.running
+    assert capture.reads == 3 + libpipeline.MAX_READ_FAILURES
+    # 10 + 20 ms and then the 20 ms cap, not a busy loop
+    assert elapsed >= 0.1
@@ -0,0 +1,55 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    # librecord imports libcodec from its own directory
+    sys.path.insert(0, os.path.join(ROOT, side))
+    try:
+        spec = importlib.util.spec_from_file_location(f"librecord_{side}", os.path.join(ROOT, side, "librecord.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.pop(0)
+    return module
+
+
+@pytest.fixture(params=["client", "server"])
+def librecord(request):
+    return _load(request.param)
+
+
+def _write(librecord, path, count, start=0):
+    recorder = librecord.Recorder(path)
+    for n in range(start, start + count):
+        recorder.record(librecord.libcodec.KIND_SENSOR_DATA, {"IMU": (float(n), 0.0, 0.0)})
+    recorder.close()
+
+
+def test_recording_again_after_a_crash_drops_the_truncated_record(librecord, tmp_path):
+    path = str(tmp_path / "flight.rovlog")
+    _write(librecord, path, 2)
+    # A crash in the middle of the second record
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 5)
+    _write(librecord, path, 5, start=2)
+
+    reader = librecord.LogReader(path)
+    try:
+        imu = [state["IMU"][0] for timestamp, kind, state in reader]
+    finally:
+        reader.close()
+    assert imu == [0.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+
+def test_recording_to_a_file_that_is_not_a_log_fails(librecord, tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"not a log at all")
+    with pytest.raises(ValueError):
+        librecord.Recorder(str(path))
+    assert path.read_bytes() == b"not a log at all"
@@ -0,0 +1,59 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("cv2")
+pytest.importorskip("numpy")
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def _load(side):
+    # libvideorecord imports libvideo from its own directory
+    sys.path.insert(0, os.path.join(ROOT, side))
+    try:
+        name = "libvideorecord_" + side.replace("-", "_")
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, side, "libvideorecord.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.pop(0)
+    return module
+
+
+@pytest.fixture(params=["camera-server", "camera-client"])
+def libvideorecord(request):
+    return _load(request.param)
+
+
+def _record(libvideorecord, path, seqs):
+    recorder = libvideorecord.VideoRecorder(path)
+    for seq in seqs:
+        payload = bytes([seq]) * (100 + seq)
+        recorder.record(seq, float(seq), libvideorecord.libvideo.pack_frame("jpeg", 4, 4, seq, float(seq), payload))
+    recorder.close()
+
+
+@pytest.mark.parametrize("index_cut, data_cut", [(5, 0), (0, 7), (5, 7)])
+def test_recording_again_after_a_crash_lines_up(libvideorecord, tmp_path, index_cut, data_cut):
+    path = str(tmp_path / "dive.rovvid")
+    _record(libvideorecord, path, [1, 2, 3])
+    # A crash in the middle of the last index entry, of the last frame or both
+    for name, cut in ((path + libvideorecord.INDEX_SUFFIX, index_cut), (path, data_cut)):
+        with open(name, "r+b") as f:
+            f.truncate(os.path.getsize(name) - cut)
+    _record(libvideorecord, path, [4, 5])
+
+    reader = libvideorecord.VideoReader(path)
+    try:
+        seqs = [reader.entry(n)[1] for n in range(len(reader))]
+        payloads = [bytes(reader.read(n)[1]) for n in range(len(reader))]
+        found = reader.find(4.5)
+    finally:
+        reader.close()
+    kept = [1, 2] if index_cut or data_cut else [1, 2, 3]
+    assert seqs == kept + [4, 5]
+    assert payloads == [bytes([seq]) * (100 + seq) for seq in seqs]
+    assert seqs[found] == 4
@@ -0,0 +1,45 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bench"))
+
+import harness
+
+
+def test_link_loss_stops_and_disarms_the_robot():
+    relay_module = harness.load_relay("server")
+    relay = relay_module.RelayThread()
+    relay._robot_state.update(horizontal_motors=(1, 1, 1, 1), vertical_motors=(1, 1), enabled=True)
+    relay._link_up = True
+    # No connection is open, the link counts as lost straight away
+    relay._check_links()
+    assert relay.get_horizontal_motors() == (0, 0, 0, 0)
+    assert relay.get_vertical_motors() == (0, 0)
+    assert relay.get_enabled() is False
+
+
+def test_client_hanging_up_is_not_an_error(caplog):
+    relay_module = harness.load_relay("server")
+    relay = relay_module.RelayThread()
+    relay.port = harness.free_port()
+    relay.link_timeout = None
+    # begin_thread's thread would keep the test run alive
+    threading.Thread(target=relay.run_server_socket, daemon=True).start()
+    caplog.set_level(logging.INFO)
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            sock = socket.create_connection(("localhost", relay.port))
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    sock.close()
+    while not any("closed the connection" in r.getMessage() for r in caplog.records):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert not [r for r in caplog.records if r.levelno >= logging.WARNING]
@@ -0,0 +1,65 @@
+import os
+import selectors
+import socket
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path[:0] = [os.path.join(ROOT, "server"), os.path.join(ROOT, "client"), os.path.join(ROOT, "bench")]
+
+import libclient
+import libserver
+from lossy_proxy import LossyUdpProxy
+
+
+def test_lossy_reordering_link_applies_commands_in_order():
+    sel = selectors.DefaultSelector()
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("localhost", 0))
+    server_sock.setblocking(False)
+    server = libserver.DatagramMessage(sel, server_sock, {}, {"IMU": (0.0, 0.0, 0.0)}, max_age=0.2)
+    sel.register(server_sock, selectors.EVENT_READ, data=server)
+
+    # Jitter ten times the send interval reorders plenty of datagrams
+    proxy = LossyUdpProxy(server_sock.getsockname(), loss=0.1, delay=0.005, jitter=0.05, seed=1).start()
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client_sock.connect(proxy.address)
+    client_sock.setblocking(False)
+    state = {"horizontal_motors": (0.0, 0.0, 0.0, 0.0), "vertical_motors": (0.0, 0.0), "enabled": True}
+    client = libclient.DatagramMessage(
+        sel, client_sock, proxy.address, {}, state, {"IMU": (0.0, 0.0, 0.0)}, max_age=0.2,
+    )
+    sel.register(client_sock, selectors.EVENT_READ, data=client)
+
+    applied = []
+    sent = 0
+    end = time.monotonic() + 1.0
+    next_tick = time.monotonic()
+    try:
+        while time.monotonic() < end + 0.2:
+            for key, mask in sel.select(max(next_tick - time.monotonic(), 0)):
+                before = server.robot_state
+                key.data.process_events(mask, state if key.data is client else server.sensor_data)
+                if key.data is server and server.robot_state is not before:
+                    applied.append(server.robot_state["horizontal_motors"][0])
+            now = time.monotonic()
+            if now >= next_tick and now < end:
+                sent += 1
+                state = dict(state, horizontal_motors=(float(sent), 0.0, 0.0, 0.0))
+                client.robot_state = state
+                client.send_request()
+                next_tick += 1 / 200
+    finally:
+        proxy.stop()
+        sel.close()
+        client_sock.close()
+        server_sock.close()
+
+    (seq_filter,) = server.filters.values()
+    assert applied
+    assert all(a < b for a, b in zip(applied, applied[1:]))
+    assert proxy.lost > 0
+    assert seq_filter.out_of_order > 0
+    # Every datagram that reached the server was either applied or counted as dropped
+    assert seq_filter.accepted + seq_filter.out_of_order + seq_filter.stale <= sent
+    assert seq_filter.accepted >= len(applied)